@@ -1,24 +1,35 @@
-from flask import Flask, render_template, jsonify, request, redirect, url_for, flash, session
-from flask_login import LoginManager, UserMixin, login_user, logout_user, login_required, current_user
+from flask import Flask, render_template, jsonify, request, redirect, url_for, flash, session, g, has_app_context, has_request_context, Response, stream_with_context
+from flask.sessions import SessionInterface, SessionMixin, session_json_serializer
+from flask_login import LoginManager, UserMixin, login_user, logout_user, login_required, current_user, user_logged_in
 from flask_mail import Mail, Message
 from flask_wtf import FlaskForm
 from wtforms import StringField, PasswordField, SubmitField, EmailField, FloatField, SelectField, TextAreaField, SelectMultipleField, RadioField, HiddenField
 from wtforms.validators import DataRequired, Email, Length, EqualTo, NumberRange
 from wtforms.widgets import CheckboxInput, ListWidget
+from werkzeug.datastructures import CallbackDict
 from werkzeug.security import generate_password_hash, check_password_hash
 import sqlite3
 import os
 import uuid
+import threading
+import time
+import traceback
 from datetime import datetime, timedelta
-from collections import defaultdict
+from contextlib import contextmanager
+from collections import Counter, defaultdict, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal, ROUND_HALF_UP
 import json
+import csv
+import importlib
+import re
+import hashlib
+import click
 from werkzeug.utils import secure_filename
-import google.generativeai as genai
 from dotenv import load_dotenv
-import qrcode
-import qrcode.image.svg
-from io import BytesIO
+from io import BytesIO, StringIO, TextIOWrapper
 import base64
+import binascii
 import secrets
 import string
 
@@ -29,6 +40,67 @@ app = Flask(__name__)
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'your-secret-key-change-in-production')
 app.config['DATABASE'] = os.environ.get('DATABASE', 'splitwise.db')
 
+# SQLite connection pool configuration
+app.config['SQLITE_POOL_SIZE'] = int(os.environ.get('SQLITE_POOL_SIZE', 8))  # idle connections kept per worker
+app.config['SQLITE_BUSY_TIMEOUT_MS'] = int(os.environ.get('SQLITE_BUSY_TIMEOUT_MS', 5000))
+app.config['SQLITE_CACHE_SIZE'] = int(os.environ.get('SQLITE_CACHE_SIZE', -16000))  # negative = KiB, so ~16MB
+app.config['SQLITE_MMAP_SIZE'] = int(os.environ.get('SQLITE_MMAP_SIZE', 64 * 1024 * 1024))
+app.config['SQLITE_DEBUG_LEAKS'] = os.environ.get('SQLITE_DEBUG_LEAKS', 'False').lower() == 'true'
+
+# Opt-in per-request SQL profiling: Server-Timing header, one log line per request,
+# and a warning when one statement shape runs at least SQL_PROFILE_REPEAT_THRESHOLD times
+app.config['SQL_PROFILE'] = os.environ.get('SQL_PROFILE', 'False').lower() == 'true'
+app.config['SQL_PROFILE_REPEAT_THRESHOLD'] = int(os.environ.get('SQL_PROFILE_REPEAT_THRESHOLD', 5))
+
+# Opt-in Prometheus metrics: each worker buffers in memory and adds its deltas to the shared
+# metrics table at most every METRICS_FLUSH_INTERVAL seconds. Collecting them profiles every
+# request's SQL, and /metrics is only served to scrapers presenting METRICS_TOKEN
+app.config['METRICS_ENABLED'] = os.environ.get('METRICS_ENABLED', 'False').lower() == 'true'
+app.config['METRICS_FLUSH_INTERVAL'] = int(os.environ.get('METRICS_FLUSH_INTERVAL', 15))
+app.config['METRICS_TOKEN'] = os.environ.get('METRICS_TOKEN')
+
+# Per-worker cache of user records for the Flask-Login user loader
+app.config['USER_CACHE_SIZE'] = int(os.environ.get('USER_CACHE_SIZE', 1024))
+app.config['USER_CACHE_TTL'] = int(os.environ.get('USER_CACHE_TTL', 60))  # seconds
+
+# Receipt analysis cache, keyed by image hash plus prompt/model version
+app.config['RECEIPT_CACHE_TTL'] = int(os.environ.get('RECEIPT_CACHE_TTL', 7 * 24 * 3600))  # seconds
+app.config['RECEIPT_CACHE_MAX_BYTES'] = int(os.environ.get('RECEIPT_CACHE_MAX_BYTES', 20 * 1024 * 1024))
+
+# Background receipt analysis: threads per gunicorn worker, and how long a job may stay unfinished
+app.config['RECEIPT_WORKERS'] = int(os.environ.get('RECEIPT_WORKERS', 2))
+app.config['RECEIPT_JOB_TIMEOUT'] = int(os.environ.get('RECEIPT_JOB_TIMEOUT', 300))  # seconds
+app.config['RECEIPT_JOB_RETENTION'] = int(os.environ.get('RECEIPT_JOB_RETENTION', 24 * 3600))  # seconds
+
+# Receipt images are normalized before they are stored and sent to Gemini
+app.config['RECEIPT_MAX_EDGE'] = int(os.environ.get('RECEIPT_MAX_EDGE', 2048))  # pixels, longest side
+app.config['RECEIPT_GRAYSCALE'] = os.environ.get('RECEIPT_GRAYSCALE', 'False').lower() == 'true'
+app.config['RECEIPT_IMAGE_FORMAT'] = os.environ.get('RECEIPT_IMAGE_FORMAT', 'webp')  # webp | jpeg
+app.config['RECEIPT_IMAGE_QUALITY'] = int(os.environ.get('RECEIPT_IMAGE_QUALITY', 80))
+
+# How long a stored receipt image is kept when it never became part of an expense
+app.config['RECEIPT_UPLOAD_RETENTION'] = int(os.environ.get('RECEIPT_UPLOAD_RETENTION', 7 * 24 * 3600))  # seconds
+
+# Server-side sessions: the cookie only carries an opaque id, the data lives in SQLite
+app.config['SESSION_TTL'] = int(os.environ.get('SESSION_TTL', 14 * 24 * 3600))  # seconds of inactivity
+app.config['SESSION_CLEANUP_INTERVAL'] = int(os.environ.get('SESSION_CLEANUP_INTERVAL', 600))  # seconds, per worker
+
+# Rendered EPC payment QR codes, keyed by payload and image format
+app.config['QR_CACHE_SIZE'] = int(os.environ.get('QR_CACHE_SIZE', 256))
+app.config['QR_CACHE_TTL'] = int(os.environ.get('QR_CACHE_TTL', 24 * 3600))  # seconds
+
+# Group history API: default and maximum number of items per page
+app.config['HISTORY_PAGE_SIZE'] = int(os.environ.get('HISTORY_PAGE_SIZE', 20))
+app.config['HISTORY_MAX_PAGE_SIZE'] = int(os.environ.get('HISTORY_MAX_PAGE_SIZE', 100))
+
+# Ledger export: rows fetched from SQLite per streamed chunk
+app.config['EXPORT_CHUNK_SIZE'] = int(os.environ.get('EXPORT_CHUNK_SIZE', 500))
+
+# Debt simplification: 'optimal' finds the fewest transfers for small groups, 'greedy' is the old matcher
+app.config['SETTLEMENT_SOLVER'] = os.environ.get('SETTLEMENT_SOLVER', 'optimal')
+app.config['SETTLEMENT_OPTIMAL_MAX_BALANCES'] = int(os.environ.get('SETTLEMENT_OPTIMAL_MAX_BALANCES', 20))
+app.config['SETTLEMENT_TIME_BUDGET_MS'] = int(os.environ.get('SETTLEMENT_TIME_BUDGET_MS', 50))
+
 # Set minimum cache TTL for all responses
 @app.after_request
 def add_cache_headers(response):
@@ -39,6 +111,10 @@ def add_cache_headers(response):
         response.headers['Cache-Control'] = 'public, max-age=60, must-revalidate'  # 1 minute
         response.headers['Expires'] = '0'
     
+    # Payment QR images carry a strong ETag and set their own long-lived caching
+    elif request.endpoint == 'payment_qr_image' and response.status_code in (200, 304):
+        return response
+    
     # Service worker - no cache
     elif request.path.endswith('sw.js'):
         response.headers['Cache-Control'] = 'no-cache, no-store, must-revalidate'
@@ -57,8 +133,9 @@ def add_cache_headers(response):
         response.headers['Pragma'] = 'no-cache'
         response.headers['Expires'] = '0'
     
-    # Add ETag for better cache validation
-    if not response.headers.get('ETag'):
+    # Add ETag for better cache validation; hashing a streamed body (ledger exports) would
+    # run its generator to the end and buffer it all before the first byte is sent
+    if not response.headers.get('ETag') and not (response.is_streamed or response.direct_passthrough):
         response.add_etag()
     
     return response
@@ -74,10 +151,29 @@ app.config['MAIL_USERNAME'] = os.environ.get('MAIL_USERNAME')
 app.config['MAIL_PASSWORD'] = os.environ.get('MAIL_PASSWORD')
 app.config['MAIL_DEFAULT_SENDER'] = os.environ.get('MAIL_DEFAULT_SENDER', app.config['MAIL_USERNAME'])
 
-# Configure Gemini AI
+# Gemini AI is imported and configured on first use: google.generativeai accounts for
+# most of the app's import time and only receipt analysis needs it
 GEMINI_API_KEY = os.environ.get('GEMINI_API_KEY')
-if GEMINI_API_KEY:
-    genai.configure(api_key=GEMINI_API_KEY)
+genai = None
+_genai_lock = threading.Lock()
+
+def get_genai():
+    """google.generativeai, imported and configured once per process"""
+    global genai
+    with _genai_lock:
+        if genai is None:
+            module = importlib.import_module('google.generativeai')
+            module.configure(api_key=GEMINI_API_KEY)
+            genai = module
+    return genai
+
+# Heavy libraries the request paths import lazily; a preloading server imports them up
+# front instead so all workers share one copy (see gunicorn.conf.py)
+LAZY_IMPORTS = ('google.generativeai', 'qrcode', 'qrcode.image.svg', 'PIL.Image', 'PIL.ImageOps')
+
+def warm_lazy_imports():
+    for name in LAZY_IMPORTS:
+        importlib.import_module(name)
 
 # Initialize Flask-Mail
 mail = Mail(app)
@@ -94,6 +190,66 @@ class MultiCheckboxField(SelectMultipleField):
     widget = ListWidget(prefix_label=False)
     option_widget = CheckboxInput()
 
+class TTLCache:
+    """Thread-safe LRU cache whose entries also expire after ttl seconds"""
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                self._entries.pop(key, None)
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._entries),
+                'maxsize': self.maxsize,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+            }
+
+# Rows behind load_user(), which otherwise runs a query on every authenticated request
+user_cache = TTLCache(app.config['USER_CACHE_SIZE'], app.config['USER_CACHE_TTL'])
+
+# Lookups nearly every route runs; HOT_PATH_QUERIES checks the plans of these exact strings
+USER_BY_ID_SQL = 'SELECT * FROM users WHERE id = ?'
+USER_BY_USERNAME_SQL = 'SELECT * FROM users WHERE username = ?'
+USER_BY_EMAIL_SQL = 'SELECT * FROM users WHERE email = ?'
+GROUP_BY_ID_SQL = 'SELECT * FROM groups WHERE id = ?'
+GROUP_BY_INVITE_CODE_SQL = 'SELECT * FROM groups WHERE invite_code = ?'
+MEMBERSHIP_SQL = 'SELECT 1 FROM group_members WHERE group_id = ? AND user_id = ?'
+USER_GROUP_IDS_SQL = 'SELECT group_id FROM group_members WHERE user_id = ?'
+
 # User model
 class User(UserMixin):
     def __init__(self, id, username, email, password_hash, created_at):
@@ -106,16 +262,28 @@ class User(UserMixin):
     @staticmethod
     def get(user_id):
         conn = get_db_connection()
-        user = conn.execute('SELECT * FROM users WHERE id = ?', (user_id,)).fetchone()
+        user = conn.execute(USER_BY_ID_SQL, (user_id,)).fetchone()
         conn.close()
         if user:
             return User(user['id'], user['username'], user['email'], user['password_hash'], user['created_at'])
         return None
 
+    @staticmethod
+    def get_cached(user_id):
+        """User.get() behind the per-worker user cache"""
+        fields = user_cache.get(user_id)
+        if fields is None:
+            user = User.get(user_id)
+            if user is None:
+                return None
+            fields = (user.id, user.username, user.email, user.password_hash, user.created_at)
+            user_cache.set(user_id, fields)
+        return User(*fields)
+
     @staticmethod
     def get_by_username(username):
         conn = get_db_connection()
-        user = conn.execute('SELECT * FROM users WHERE username = ?', (username,)).fetchone()
+        user = conn.execute(USER_BY_USERNAME_SQL, (username,)).fetchone()
         conn.close()
         if user:
             return User(user['id'], user['username'], user['email'], user['password_hash'], user['created_at'])
@@ -124,7 +292,7 @@ class User(UserMixin):
     @staticmethod
     def get_by_email(email):
         conn = get_db_connection()
-        user = conn.execute('SELECT * FROM users WHERE email = ?', (email,)).fetchone()
+        user = conn.execute(USER_BY_EMAIL_SQL, (email,)).fetchone()
         conn.close()
         if user:
             return User(user['id'], user['username'], user['email'], user['password_hash'], user['created_at'])
@@ -151,7 +319,7 @@ class User(UserMixin):
 
 @login_manager.user_loader
 def load_user(user_id):
-    return User.get(int(user_id))
+    return User.get_cached(int(user_id))
 
 # Forms
 class LoginForm(FlaskForm):
@@ -194,14 +362,532 @@ class SettlementForm(FlaskForm):
     submit = SubmitField('Settle Up')
 
 # Database functions
+class PooledConnection:
+    """Handle for a pooled sqlite3 connection; close() returns it to the pool"""
+
+    def __init__(self, pool, raw, acquired_at=None, acquired_in=None):
+        self._pool = pool
+        self._raw = raw
+        self.acquired_at = acquired_at
+        self.acquired_in = acquired_in
+        self.closed = False
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self._pool.release(self._raw)
+
+    def __getattr__(self, name):
+        if self.closed:
+            raise sqlite3.ProgrammingError('Cannot operate on a closed database.')
+        return getattr(self._raw, name)
+
+    def __enter__(self):
+        self._raw.__enter__()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        return self._raw.__exit__(exc_type, exc_value, tb)
+
+class QueryProfile:
+    """SQL statements, time and connection checkouts recorded for one request"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.seconds = 0.0
+        self.connections = 0
+        self.shapes = Counter()
+
+    def record(self, sql, seconds):
+        self.queries += 1
+        self.seconds += seconds
+        self.shapes[statement_shape(sql)] += 1
+
+    def add_time(self, seconds):
+        self.seconds += seconds
+
+    def repeated(self, threshold):
+        """Statement shapes run at least threshold times: likely a query inside a loop"""
+        return [(shape, count) for shape, count in self.shapes.most_common() if count >= threshold]
+
+def statement_shape(sql):
+    """Normalize a statement so calls that differ only in literals or IN-list length compare equal"""
+    shape = ' '.join(sql.split())
+    shape = re.sub(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b", '?', shape)
+    return re.sub(r'\(\s*\?(?:\s*,\s*\?)+\s*\)', '(?, ...)', shape)
+
+class ProfiledCursor:
+    """Cursor wrapper that adds row fetching time to the request profile"""
+
+    def __init__(self, cursor, profile):
+        self._cursor = cursor
+        self._profile = profile
+
+    def _timed(self, fetch, *args):
+        start = time.perf_counter()
+        try:
+            return fetch(*args)
+        finally:
+            self._profile.add_time(time.perf_counter() - start)
+
+    def fetchone(self):
+        return self._timed(self._cursor.fetchone)
+
+    def fetchmany(self, *args):
+        return self._timed(self._cursor.fetchmany, *args)
+
+    def fetchall(self):
+        return self._timed(self._cursor.fetchall)
+
+    def __iter__(self):
+        while True:
+            row = self.fetchone()
+            if row is None:
+                return
+            yield row
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+class ProfiledConnection(PooledConnection):
+    """Pooled connection that records every statement it runs into a QueryProfile"""
+
+    def __init__(self, pool, raw, profile, acquired_at=None, acquired_in=None):
+        super().__init__(pool, raw, acquired_at, acquired_in)
+        self.profile = profile
+        profile.connections += 1
+
+    def _run(self, method, sql, *args):
+        start = time.perf_counter()
+        try:
+            cursor = getattr(self._raw, method)(sql, *args)
+        finally:
+            self.profile.record(sql, time.perf_counter() - start)
+        return ProfiledCursor(cursor, self.profile)
+
+    def execute(self, sql, parameters=()):
+        return self._run('execute', sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self._run('executemany', sql, seq_of_parameters)
+
+    def executescript(self, sql_script):
+        return self._run('executescript', sql_script)
+
+class SQLitePool:
+    """Per-worker pool of long-lived SQLite connections opened in WAL mode"""
+
+    def __init__(self, database, size, busy_timeout_ms, cache_size, mmap_size):
+        self.database = database
+        self.size = size
+        self.busy_timeout_ms = busy_timeout_ms
+        self.cache_size = cache_size
+        self.mmap_size = mmap_size
+        self.opened = 0
+        self._idle = []
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+
+    def _connect(self):
+        # A connection is used by one thread at a time (whoever checked it out), but idle
+        # ones move between request and receipt threads, hence check_same_thread=False
+        conn = sqlite3.connect(self.database, timeout=self.busy_timeout_ms / 1000, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute(f'PRAGMA busy_timeout={int(self.busy_timeout_ms)}')
+        conn.execute(f'PRAGMA cache_size={int(self.cache_size)}')
+        conn.execute(f'PRAGMA mmap_size={int(self.mmap_size)}')
+        with self._lock:
+            self.opened += 1
+        return conn
+
+    def acquire(self):
+        raw = None
+        with self._lock:
+            # A forked gunicorn worker must never share the parent's file handles
+            if self._pid != os.getpid():
+                self._idle = []
+                self._pid = os.getpid()
+            if self._idle:
+                raw = self._idle.pop()
+        return raw or self._connect()
+
+    def release(self, raw):
+        try:
+            if raw.in_transaction:
+                raw.rollback()
+        except sqlite3.Error:
+            raw.close()
+            return
+        with self._lock:
+            if self._pid == os.getpid() and len(self._idle) < self.size:
+                self._idle.append(raw)
+                return
+        raw.close()
+
+    def close_all(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for raw in idle:
+            raw.close()
+
+_pools_lock = threading.Lock()
+
+def get_db_pool():
+    """Get the connection pool for the configured database, creating it on first use"""
+    database = app.config['DATABASE']
+    pools = app.extensions.setdefault('sqlite_pools', {})
+    with _pools_lock:
+        pool = pools.get(database)
+        if pool is None:
+            pool = pools[database] = SQLitePool(
+                database,
+                size=app.config['SQLITE_POOL_SIZE'],
+                busy_timeout_ms=app.config['SQLITE_BUSY_TIMEOUT_MS'],
+                cache_size=app.config['SQLITE_CACHE_SIZE'],
+                mmap_size=app.config['SQLITE_MMAP_SIZE'],
+            )
+    return pool
+
 def get_db_connection():
-    conn = sqlite3.connect(app.config['DATABASE'])
-    conn.row_factory = sqlite3.Row
+    acquired_at = traceback.format_stack(limit=8)[:-1] if app.config['SQLITE_DEBUG_LEAKS'] else None
+    acquired_in = f'{request.method} {request.path}' if has_request_context() else None
+    pool = get_db_pool()
+    # The profile starts with the request's first checkout, which is the session lookup
+    if (app.config['SQL_PROFILE'] or app.config['METRICS_ENABLED']) and has_request_context():
+        if '_sql_profile' not in g:
+            g._sql_profile = QueryProfile()
+        conn = ProfiledConnection(pool, pool.acquire(), g._sql_profile, acquired_at, acquired_in)
+    else:
+        conn = PooledConnection(pool, pool.acquire(), acquired_at, acquired_in)
+    
+    # Track checkouts so teardown can reclaim connections that were never closed
+    if has_app_context():
+        g.setdefault('_db_checkouts', []).append(conn)
     return conn
 
-def init_db():
+@app.after_request
+def report_sql_profile(response):
+    """Expose the request's SQL cost as Server-Timing and log it, flagging probable N+1 loops"""
+    profile = g.get('_sql_profile')
+    if profile is None or not app.config['SQL_PROFILE']:
+        return response
+    
+    total_ms = (time.perf_counter() - profile.started) * 1000
+    db_ms = profile.seconds * 1000
+    response.headers.add('Server-Timing', f'db;dur={db_ms:.1f};desc="{profile.queries} queries, {profile.connections} connections"')
+    response.headers.add('Server-Timing', f'app;dur={total_ms:.1f}')
+    
+    app.logger.debug('SQL %s %s %s: %d queries, %d connections, %.1fms db / %.1fms total', request.method,
+                     request.path, response.status_code, profile.queries, profile.connections, db_ms, total_ms)
+    for shape, count in profile.repeated(app.config['SQL_PROFILE_REPEAT_THRESHOLD']):
+        app.logger.warning('SQL possible N+1 in %s %s: %dx %s', request.method, request.path, count, shape[:200])
+    return response
+
+@app.teardown_appcontext
+def release_db_connections(exception=None):
+    """Return connections left open by the request to the pool"""
+    for conn in g.pop('_db_checkouts', []):
+        if conn.closed:
+            continue
+        if app.config['SQLITE_DEBUG_LEAKS']:
+            app.logger.warning('SQLite connection left open at teardown of %s, acquired at:\n%s',
+                               conn.acquired_in or '<no request>', ''.join(conn.acquired_at or []))
+        conn.close()
+
+# Metric families served by /metrics: name -> (type, help, histogram buckets in seconds)
+HTTP_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+METRICS = {
+    'http_requests_total': ('counter', 'HTTP requests by endpoint and status', None),
+    'http_request_duration_seconds': ('histogram', 'Time to produce the response', HTTP_BUCKETS),
+    'http_request_db_seconds': ('histogram', 'SQLite time spent per request', HTTP_BUCKETS),
+    'http_request_db_queries_total': ('counter', 'SQL statements run by requests', None),
+    'gemini_request_duration_seconds': ('histogram', 'Receipt analysis calls to Gemini by outcome',
+                                        (0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)),
+    'smtp_send_duration_seconds': ('histogram', 'Mail delivery to the SMTP server by outcome',
+                                   (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)),
+    'cache_hits_total': ('counter', 'Cache hits by cache', None),
+    'cache_misses_total': ('counter', 'Cache misses by cache', None),
+}
+
+def format_metric_labels(labels):
+    escape = lambda value: str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return ','.join(f'{key}="{escape(value)}"' for key, value in sorted(labels.items()))
+
+class MetricsRegistry:
+    """Counters and histograms buffered per worker and summed across workers in SQLite.
+
+    Every series is a plain number that only grows (histogram buckets are stored
+    cumulatively), so a flush just adds the buffered deltas to the metrics table
+    and concurrent workers never overwrite each other.
+    """
+
+    def __init__(self):
+        self._pending = defaultdict(float)
+        self._lock = threading.Lock()
+        self._last_flush = time.monotonic()
+        self._caches = {}
+        self._reported = defaultdict(int)
+
+    def track_cache(self, name, cache):
+        """Export a TTLCache's hit and miss counters as cache_hits_total/cache_misses_total"""
+        self._caches[name] = cache
+
+    def _collect_caches(self):
+        # The caches count cumulatively, so buffer only what grew since the last flush
+        for name, cache in self._caches.items():
+            stats = cache.stats()
+            with self._lock:
+                for kind in ('hits', 'misses'):
+                    delta = stats[kind] - self._reported[(name, kind)]
+                    if delta:
+                        self._reported[(name, kind)] = stats[kind]
+                        self._pending[(f'cache_{kind}_total', format_metric_labels({'cache': name}))] += delta
+
+    def inc(self, name, labels=None, value=1):
+        if not app.config['METRICS_ENABLED']:
+            return
+        with self._lock:
+            self._pending[(name, format_metric_labels(labels or {}))] += value
+
+    def observe(self, name, seconds, labels=None):
+        if not app.config['METRICS_ENABLED']:
+            return
+        labels = labels or {}
+        base = format_metric_labels(labels)
+        with self._lock:
+            for bound in METRICS[name][2]:
+                if seconds <= bound:
+                    self._pending[(f'{name}_bucket', format_metric_labels(dict(labels, le=bound)))] += 1
+            self._pending[(f'{name}_bucket', format_metric_labels(dict(labels, le='+Inf')))] += 1
+            self._pending[(f'{name}_sum', base)] += seconds
+            self._pending[(f'{name}_count', base)] += 1
+
+    @contextmanager
+    def timer(self, name, labels=None):
+        """Observe the duration of a block, labelled with outcome=success or outcome=error"""
+        started = time.perf_counter()
+        outcome = 'error'
+        try:
+            yield
+            outcome = 'success'
+        finally:
+            self.observe(name, time.perf_counter() - started, dict(labels or {}, outcome=outcome))
+
+    def maybe_flush(self):
+        with self._lock:
+            if time.monotonic() - self._last_flush < app.config['METRICS_FLUSH_INTERVAL']:
+                return
+            self._last_flush = time.monotonic()
+        self.flush()
+
+    def flush(self):
+        self._collect_caches()
+        with self._lock:
+            pending, self._pending = self._pending, defaultdict(float)
+        if not pending:
+            return
+        conn = get_db_connection()
+        try:
+            conn.executemany('''
+                INSERT INTO metrics (name, labels, value) VALUES (?, ?, ?)
+                ON CONFLICT (name, labels) DO UPDATE SET value = value + excluded.value
+            ''', [(name, labels, value) for (name, labels), value in pending.items()])
+            conn.commit()
+        except sqlite3.Error as e:
+            # Keep the deltas for the next flush rather than losing them
+            print(f"Error flushing metrics: {e}")
+            with self._lock:
+                for key, value in pending.items():
+                    self._pending[key] += value
+        finally:
+            conn.close()
+
+    def render(self):
+        """All workers' series in the Prometheus text exposition format"""
+        conn = get_db_connection()
+        try:
+            rows = conn.execute('SELECT name, labels, value FROM metrics ORDER BY name, labels').fetchall()
+        finally:
+            conn.close()
+        
+        series = defaultdict(list)
+        for row in rows:
+            family = row['name']
+            for suffix in ('_bucket', '_sum', '_count'):
+                if family.endswith(suffix) and family[:-len(suffix)] in METRICS:
+                    family = family[:-len(suffix)]
+            series[family].append(row)
+        
+        lines = []
+        for family in sorted(series):
+            metric_type, help_text, _ = METRICS.get(family, ('untyped', '', None))
+            lines.append(f'# HELP {family} {help_text}')
+            lines.append(f'# TYPE {family} {metric_type}')
+            for row in series[family]:
+                labels = f"{{{row['labels']}}}" if row['labels'] else ''
+                value = int(row['value']) if row['value'].is_integer() else row['value']
+                lines.append(f"{row['name']}{labels} {value}")
+        return '\n'.join(lines) + '\n'
+
+metrics = MetricsRegistry()
+metrics.track_cache('user', user_cache)
+
+@app.before_request
+def start_request_timer():
+    g._request_started = time.perf_counter()
+
+@app.after_request
+def record_request_metrics(response):
+    started = g.get('_request_started')
+    if not app.config['METRICS_ENABLED'] or started is None:
+        return response
+    
+    # Label by route endpoint, not path, so ids in URLs don't explode the series count
+    endpoint = request.endpoint or 'unmatched'
+    metrics.inc('http_requests_total', {'method': request.method, 'endpoint': endpoint, 'status': response.status_code})
+    metrics.observe('http_request_duration_seconds', time.perf_counter() - started,
+                    {'method': request.method, 'endpoint': endpoint})
+    profile = g.get('_sql_profile')
+    if profile is not None:
+        metrics.observe('http_request_db_seconds', profile.seconds, {'endpoint': endpoint})
+        metrics.inc('http_request_db_queries_total', {'endpoint': endpoint}, profile.queries)
+    metrics.maybe_flush()
+    return response
+
+class SQLiteSession(CallbackDict, SessionMixin):
+    """Session data loaded from the sessions table; any change marks it modified"""
+
+    def __init__(self, initial=None, sid=None, expires_at=None, new=False):
+        def on_update(self):
+            self.modified = True
+        super().__init__(initial, on_update)
+        self.sid = sid
+        self.expires_at = expires_at
+        self.new = new
+        self.modified = False
+
+SESSION_LOOKUP_SQL = 'SELECT data, expires_at FROM sessions WHERE id = ? AND expires_at > ?'
+EXPIRED_SESSIONS_SQL = 'DELETE FROM sessions WHERE expires_at <= ?'
+
+class SQLiteSessionInterface(SessionInterface):
+    """Keep session data in SQLite so the cookie is just an unguessable id.
+
+    Rows are only written when the session changed, or when less than half of
+    its TTL is left; expired rows are purged at most once per cleanup interval.
+    """
+    serializer = session_json_serializer
+
+    def __init__(self):
+        self._last_cleanup = 0.0
+        self._cleanup_lock = threading.Lock()
+
+    def open_session(self, app, request):
+        # Static files never touch the session, so don't pay a lookup for every asset.
+        # The session is opened before URL matching, so go by path rather than endpoint.
+        if request.path.startswith(app.static_url_path + '/'):
+            return self.make_null_session(app)
+        
+        sid = request.cookies.get(self.get_cookie_name(app))
+        if sid:
+            conn = get_db_connection()
+            try:
+                row = conn.execute(SESSION_LOOKUP_SQL, (sid, datetime.now().isoformat())).fetchone()
+            finally:
+                conn.close()
+            if row:
+                return SQLiteSession(self.serializer.loads(row['data']), sid,
+                                     datetime.fromisoformat(row['expires_at']))
+        # Unknown or expired ids are never reused, so a planted cookie can't fix the session id
+        return SQLiteSession(sid=secrets.token_urlsafe(32), new=True)
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        
+        if session.accessed:
+            response.vary.add('Cookie')
+        
+        if not session:
+            if not session.new and session.modified:
+                self._delete(session.sid)
+                response.delete_cookie(name, domain=domain, path=path,
+                                       secure=self.get_cookie_secure(app),
+                                       samesite=self.get_cookie_samesite(app))
+            return
+        
+        now = datetime.now()
+        ttl = timedelta(seconds=app.config['SESSION_TTL'])
+        refresh = session.expires_at is None or session.expires_at - now < ttl / 2
+        if not (session.modified or refresh):
+            return
+        
+        expires_at = now + ttl
+        conn = get_db_connection()
+        try:
+            if session.modified or session.new:
+                conn.execute('''
+                    INSERT OR REPLACE INTO sessions (id, data, expires_at) VALUES (?, ?, ?)
+                ''', (session.sid, self.serializer.dumps(dict(session)), expires_at.isoformat()))
+            else:
+                conn.execute('UPDATE sessions SET expires_at = ? WHERE id = ?', (expires_at.isoformat(), session.sid))
+            conn.commit()
+        finally:
+            conn.close()
+        self._maybe_cleanup(app)
+        
+        response.set_cookie(name, session.sid,
+                            expires=self.get_expiration_time(app, session),
+                            httponly=self.get_cookie_httponly(app),
+                            domain=domain, path=path,
+                            secure=self.get_cookie_secure(app),
+                            samesite=self.get_cookie_samesite(app))
+
+    def regenerate(self, session):
+        """Move the session to a fresh id, dropping the row under the old one"""
+        if not session.new:
+            self._delete(session.sid)
+        session.sid = secrets.token_urlsafe(32)
+        session.new = True
+        session.modified = True
+
+    def _delete(self, sid):
+        conn = get_db_connection()
+        try:
+            conn.execute('DELETE FROM sessions WHERE id = ?', (sid,))
+            conn.commit()
+        finally:
+            conn.close()
+
+    def _maybe_cleanup(self, app):
+        with self._cleanup_lock:
+            if time.monotonic() - self._last_cleanup < app.config['SESSION_CLEANUP_INTERVAL']:
+                return
+            self._last_cleanup = time.monotonic()
+        cleanup_expired_sessions()
+
+def cleanup_expired_sessions():
+    """Delete sessions past their expiry; returns how many were removed"""
     conn = get_db_connection()
-    
+    try:
+        removed = conn.execute(EXPIRED_SESSIONS_SQL, (datetime.now().isoformat(),)).rowcount
+        conn.commit()
+    finally:
+        conn.close()
+    return removed
+
+app.session_interface = SQLiteSessionInterface()
+
+@user_logged_in.connect_via(app)
+def rotate_session_id(sender, user, **extra):
+    """Issue a new session id on login so an id planted before login is worthless"""
+    app.session_interface.regenerate(session)
+
+def create_base_schema(conn):
+    """Migration 1: create the original tables and backfill columns older databases lack"""
     # Users table
     conn.execute('''
         CREATE TABLE IF NOT EXISTS users (
@@ -300,101 +986,643 @@ def init_db():
         )
     ''')
     
-    conn.commit()
-    conn.close()
+    # Databases created before these columns existed still need them
+    migrate_existing_groups(conn)
+    migrate_users_table(conn)
+    migrate_settlements_table(conn)
+
+def create_hot_path_indexes(conn):
+    """Migration 2: secondary indexes for the membership, ledger and token lookups"""
+    # Recent expenses per group (group_detail) and expense lookups in calculate_balances
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_expenses_group_created ON expenses (group_id, created_at)')
+    # Covers the settlement fold in calculate_balances without touching the table
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_settlements_group ON settlements (group_id, payer_id, payee_id, amount)')
+    # get_user_groups and every "groups of this user" lookup
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_group_members_user ON group_members (user_id, group_id)')
+    # cleanup_expired_tokens and the per-user token reset
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_password_reset_tokens_expires ON password_reset_tokens (expires_at)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_password_reset_tokens_user ON password_reset_tokens (user_id)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_password_reset_tokens_used ON password_reset_tokens (used) WHERE used = TRUE')
+    # Older databases got invite_code through ALTER TABLE, without the UNIQUE index
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_groups_invite_code ON groups (invite_code)')
+
+def rotated_order(keys, seed):
+    """Sorted keys starting at position seed % len(keys), so ties don't always favour the same key"""
+    keys = sorted(keys)
+    start = seed % len(keys) if keys else 0
+    return keys[start:] + keys[:start]
+
+def allocate_cents(exact_amounts, total_cents, seed):
+    """Round exact amounts (in cents) so they sum to total_cents, largest remainders first.
+
+    Equal remainders are broken in rotated_order(seed); pass the expense id as the seed.
+    """
+    floors = {key: int(amount // 1) for key, amount in exact_amounts.items()}
+    leftover = total_cents - sum(floors.values())
+    position = {key: i for i, key in enumerate(rotated_order(exact_amounts, seed))}
+    by_remainder = sorted(exact_amounts, key=lambda key: (-(exact_amounts[key] - floors[key]), position[key]))
+    for i, key in enumerate(by_remainder):
+        if i < leftover:
+            floors[key] += 1
+    return floors
+
+def convert_amounts_to_cents(conn):
+    """Migration 3: store every ledger amount as integer cents instead of REAL euros"""
+    conn.execute('''
+        CREATE TABLE expenses_new (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            group_id INTEGER NOT NULL,
+            description TEXT NOT NULL,
+            amount_cents INTEGER NOT NULL,
+            paid_by INTEGER NOT NULL,
+            created_by INTEGER NOT NULL,
+            created_at TIMESTAMP NOT NULL,
+            FOREIGN KEY (group_id) REFERENCES groups (id) ON DELETE CASCADE,
+            FOREIGN KEY (paid_by) REFERENCES users (id),
+            FOREIGN KEY (created_by) REFERENCES users (id)
+        )
+    ''')
+    conn.execute('''
+        INSERT INTO expenses_new (id, group_id, description, amount_cents, paid_by, created_by, created_at)
+        SELECT id, group_id, description, CAST(ROUND(amount * 100) AS INTEGER), paid_by, created_by, created_at
+        FROM expenses
+    ''')
+    
+    conn.execute('''
+        CREATE TABLE expense_shares_new (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            expense_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            amount_cents INTEGER NOT NULL,
+            FOREIGN KEY (expense_id) REFERENCES expenses (id) ON DELETE CASCADE,
+            FOREIGN KEY (user_id) REFERENCES users (id),
+            UNIQUE(expense_id, user_id)
+        )
+    ''')
+    # Float shares like 10/3 don't round to whole cents individually, so spread
+    # each expense's rounded share total over its shares by largest remainder
+    shares_by_expense = defaultdict(dict)
+    share_ids = {}
+    for share in conn.execute('SELECT id, expense_id, user_id, amount FROM expense_shares').fetchall():
+        shares_by_expense[share['expense_id']][share['user_id']] = share['amount'] * 100
+        share_ids[(share['expense_id'], share['user_id'])] = share['id']
+    rows = []
+    for expense_id, exact_amounts in shares_by_expense.items():
+        total_cents = round(sum(exact_amounts.values()))
+        for user_id, cents in allocate_cents(exact_amounts, total_cents, expense_id).items():
+            rows.append((share_ids[(expense_id, user_id)], expense_id, user_id, cents))
+    conn.executemany('''
+        INSERT INTO expense_shares_new (id, expense_id, user_id, amount_cents) VALUES (?, ?, ?, ?)
+    ''', rows)
     
-    # Migrate existing groups to have invite codes
-    migrate_existing_groups()
+    conn.execute('''
+        CREATE TABLE settlements_new (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            group_id INTEGER NOT NULL,
+            payer_id INTEGER NOT NULL,
+            payee_id INTEGER NOT NULL,
+            amount_cents INTEGER NOT NULL,
+            created_at TIMESTAMP NOT NULL,
+            description TEXT,
+            FOREIGN KEY (group_id) REFERENCES groups (id) ON DELETE CASCADE,
+            FOREIGN KEY (payer_id) REFERENCES users (id),
+            FOREIGN KEY (payee_id) REFERENCES users (id)
+        )
+    ''')
+    conn.execute('''
+        INSERT INTO settlements_new (id, group_id, payer_id, payee_id, amount_cents, created_at, description)
+        SELECT id, group_id, payer_id, payee_id, CAST(ROUND(amount * 100) AS INTEGER), created_at, description
+        FROM settlements
+    ''')
     
-    # Migrate users table to add bank details columns
-    migrate_users_table()
+    for table in ('expenses', 'expense_shares', 'settlements'):
+        conn.execute(f'DROP TABLE {table}')
+        conn.execute(f'ALTER TABLE {table}_new RENAME TO {table}')
     
-    # Migrate settlements table to add description column
-    migrate_settlements_table()
+    # Dropping the old tables dropped their indexes too
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_expenses_group_created ON expenses (group_id, created_at)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_settlements_group ON settlements (group_id, payer_id, payee_id, amount_cents)')
+
+def create_group_balances(conn):
+    """Migration 4: per-group balance projection, filled from the existing ledger"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS group_balances (
+            group_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            balance_cents INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (group_id, user_id),
+            FOREIGN KEY (group_id) REFERENCES groups (id) ON DELETE CASCADE,
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        ) WITHOUT ROWID
+    ''')
+    rebuild_group_balances(conn)
+
+def create_receipt_analysis_cache(conn):
+    """Migration 5: cache of Gemini receipt analyses keyed by image content"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS receipt_analysis_cache (
+            cache_key TEXT PRIMARY KEY,
+            result TEXT NOT NULL,
+            size_bytes INTEGER NOT NULL,
+            hits INTEGER NOT NULL DEFAULT 0,
+            created_at TIMESTAMP NOT NULL,
+            last_used_at TIMESTAMP NOT NULL
+        )
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_receipt_analysis_cache_created ON receipt_analysis_cache (created_at)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_receipt_analysis_cache_last_used ON receipt_analysis_cache (last_used_at)')
+
+def create_receipt_jobs(conn):
+    """Migration 6: queue of receipt analyses run outside the request"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS receipt_jobs (
+            id TEXT PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            group_id INTEGER NOT NULL,
+            filename TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'queued',
+            result TEXT,
+            error TEXT,
+            created_at TIMESTAMP NOT NULL,
+            updated_at TIMESTAMP NOT NULL,
+            FOREIGN KEY (user_id) REFERENCES users (id),
+            FOREIGN KEY (group_id) REFERENCES groups (id)
+        )
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_receipt_jobs_updated ON receipt_jobs (updated_at)')
+
+def add_receipt_job_image_stats(conn):
+    """Migration 7: record what image preprocessing saved on each receipt job"""
+    conn.execute('ALTER TABLE receipt_jobs ADD COLUMN original_bytes INTEGER')
+    conn.execute('ALTER TABLE receipt_jobs ADD COLUMN stored_bytes INTEGER')
+    conn.execute('ALTER TABLE receipt_jobs ADD COLUMN preprocess_ms REAL')
+
+def create_upload_store(conn):
+    """Migration 8: stored upload blobs and what still references them"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS upload_blobs (
+            hash TEXT PRIMARY KEY,
+            ext TEXT NOT NULL,
+            size_bytes INTEGER NOT NULL,
+            created_at TIMESTAMP NOT NULL,
+            last_referenced_at TIMESTAMP NOT NULL
+        ) WITHOUT ROWID
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS upload_refs (
+            blob_hash TEXT NOT NULL,
+            ref_type TEXT NOT NULL,
+            ref_id TEXT NOT NULL,
+            created_at TIMESTAMP NOT NULL,
+            expires_at TIMESTAMP,
+            PRIMARY KEY (blob_hash, ref_type, ref_id),
+            FOREIGN KEY (blob_hash) REFERENCES upload_blobs (hash)
+        ) WITHOUT ROWID
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_upload_refs_expires ON upload_refs (expires_at)')
+
+def create_settlement_history_index(conn):
+    """Migration 9: read a group's settlements newest first for the history API"""
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_settlements_group_created ON settlements (group_id, created_at)')
+
+def create_sessions_table(conn):
+    """Migration 10: server-side session store"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS sessions (
+            id TEXT PRIMARY KEY,
+            data TEXT NOT NULL,
+            expires_at TIMESTAMP NOT NULL
+        ) WITHOUT ROWID
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_sessions_expires ON sessions (expires_at)')
+
+def create_receipt_cache_stats(conn):
+    """Migration 12: receipt analysis cache hit and miss totals that survive eviction"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS receipt_analysis_cache_stats (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            hits INTEGER NOT NULL DEFAULT 0,
+            misses INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    conn.execute('INSERT OR IGNORE INTO receipt_analysis_cache_stats (id) VALUES (1)')
+
+def create_metrics_table(conn):
+    """Migration 11: metric series summed across workers"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS metrics (
+            name TEXT NOT NULL,
+            labels TEXT NOT NULL,
+            value REAL NOT NULL,
+            PRIMARY KEY (name, labels)
+        ) WITHOUT ROWID
+    ''')
+
+# Numbered schema migrations, applied in order and recorded in PRAGMA user_version.
+# Never edit a released migration; append a new one instead.
+MIGRATIONS = [
+    (1, 'Initial schema', create_base_schema),
+    (2, 'Hot-path indexes', create_hot_path_indexes),
+    (3, 'Integer cents amounts', convert_amounts_to_cents),
+    (4, 'Group balance projection', create_group_balances),
+    (5, 'Receipt analysis cache', create_receipt_analysis_cache),
+    (6, 'Receipt analysis jobs', create_receipt_jobs),
+    (7, 'Receipt image preprocessing stats', add_receipt_job_image_stats),
+    (8, 'Content-addressed upload store', create_upload_store),
+    (9, 'Settlement history index', create_settlement_history_index),
+    (10, 'Server-side sessions', create_sessions_table),
+    (11, 'Metrics store', create_metrics_table),
+    (12, 'Receipt cache hit and miss totals', create_receipt_cache_stats),
+]
+
+def get_schema_version(conn):
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+def run_migrations(conn):
+    """Apply every migration newer than the database's user_version exactly once"""
+    # An up-to-date database needs one PRAGMA read and no write lock
+    if get_schema_version(conn) >= MIGRATIONS[-1][0]:
+        return []
+    
+    applied = []
+    for version, description, migrate in MIGRATIONS:
+        # BEGIN IMMEDIATE serializes concurrent boots; re-check the version once we hold the lock
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            if get_schema_version(conn) >= version:
+                conn.rollback()
+                continue
+            migrate(conn)
+            conn.execute(f'PRAGMA user_version = {int(version)}')
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        print(f"Applied migration {version}: {description}")
+        applied.append(version)
+    return applied
+
+def init_db():
+    """Bring the schema up to date; on an up-to-date database this does no work proportional to the data"""
+    started = time.perf_counter()
+    conn = get_db_connection()
+    try:
+        applied = run_migrations(conn)
+        version = get_schema_version(conn)
+    finally:
+        conn.close()
     
-    # Clean up any existing invalid user data
-    cleanup_invalid_expense_shares()
-    cleanup_invalid_settlements()
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    print(f"Database ready at schema version {version} ({len(applied)} migrations applied) in {elapsed_ms:.1f}ms")
+    return applied
 
 # Helper functions
+USER_GROUPS_SQL = '''
+    SELECT g.*, u.username as creator_name
+    FROM groups g
+    JOIN group_members gm ON g.id = gm.group_id
+    JOIN users u ON g.created_by = u.id
+    WHERE gm.user_id = ?
+    ORDER BY g.created_at DESC
+'''
+
+GROUP_MEMBERS_SQL = '''
+    SELECT u.id, u.username, u.email, gm.joined_at
+    FROM users u
+    JOIN group_members gm ON u.id = gm.user_id
+    WHERE gm.group_id = ?
+    ORDER BY gm.joined_at
+'''
+
 def get_user_groups(user_id):
     conn = get_db_connection()
-    groups = conn.execute('''
-        SELECT g.*, u.username as creator_name
-        FROM groups g
-        JOIN group_members gm ON g.id = gm.group_id
-        JOIN users u ON g.created_by = u.id
-        WHERE gm.user_id = ?
-        ORDER BY g.created_at DESC
-    ''', (user_id,)).fetchall()
+    groups = conn.execute(USER_GROUPS_SQL, (user_id,)).fetchall()
     conn.close()
     return groups
 
 def get_group_members(group_id):
     conn = get_db_connection()
-    members = conn.execute('''
-        SELECT u.id, u.username, u.email, gm.joined_at
-        FROM users u
-        JOIN group_members gm ON u.id = gm.user_id
-        WHERE gm.group_id = ?
-        ORDER BY gm.joined_at
-    ''', (group_id,)).fetchall()
+    members = conn.execute(GROUP_MEMBERS_SQL, (group_id,)).fetchall()
     conn.close()
     return members
 
-def calculate_balances(group_id):
-    conn = get_db_connection()
-    
-    # Get valid group member IDs
-    valid_member_ids = set(member['id'] for member in get_group_members(group_id))
-    
-    # Get all expenses and their shares, but only for valid group members
-    expenses = conn.execute('''
-        SELECT e.id, e.amount, e.paid_by, es.user_id, es.amount as share_amount
-        FROM expenses e
-        JOIN expense_shares es ON e.id = es.expense_id
-        WHERE e.group_id = ? AND es.user_id IN ({})
-    '''.format(','.join('?' * len(valid_member_ids))), (group_id,) + tuple(valid_member_ids)).fetchall()
-    
-    # Get all settlements, but only for valid group members
-    settlements = conn.execute('''
-        SELECT payer_id, payee_id, amount
-        FROM settlements
-        WHERE group_id = ? AND payer_id IN ({}) AND payee_id IN ({})
-    '''.format(','.join('?' * len(valid_member_ids)), ','.join('?' * len(valid_member_ids))), 
-        (group_id,) + tuple(valid_member_ids) + tuple(valid_member_ids)).fetchall()
+# Money helpers: the ledger stores integer cents, euros only appear in forms, templates and JSON
+def to_cents(amount):
+    """Convert a euro amount (float, str or Decimal) to integer cents, rounding half up"""
+    return int((Decimal(str(amount)) * 100).quantize(Decimal('1'), rounding=ROUND_HALF_UP))
+
+def from_cents(cents):
+    """Convert integer cents to euros for display"""
+    return cents / 100
+
+def split_cents(total_cents, user_ids, seed):
+    """Split an amount equally; leftover cents go one each to the user ids in rotated_order(seed).
+
+    Pass the expense id as the seed so the extra cents move around the group from one expense to the next.
+    """
+    user_ids = rotated_order(user_ids, seed)
+    base, remainder = divmod(total_cents, len(user_ids))
+    return {user_id: base + (1 if i < remainder else 0) for i, user_id in enumerate(user_ids)}
+
+# Net balance per user in cents. Only shares and settlements between current group
+# members count; the payer is credited for any expense with at least one valid share.
+GROUP_BALANCES_SQL = '''
+    SELECT user_id, SUM(delta) AS balance FROM (
+        SELECT e.paid_by AS user_id, e.amount_cents AS delta
+        FROM expenses e
+        WHERE e.group_id = ? AND EXISTS (
+            SELECT 1 FROM expense_shares es
+            JOIN group_members gm ON gm.group_id = e.group_id AND gm.user_id = es.user_id
+            WHERE es.expense_id = e.id
+        )
+        UNION ALL
+        SELECT es.user_id, -es.amount_cents
+        FROM expenses e
+        JOIN expense_shares es ON es.expense_id = e.id
+        JOIN group_members gm ON gm.group_id = e.group_id AND gm.user_id = es.user_id
+        WHERE e.group_id = ?
+        UNION ALL
+        SELECT s.payer_id, s.amount_cents
+        FROM settlements s
+        WHERE s.group_id = ?
+          AND s.payer_id IN (SELECT user_id FROM group_members WHERE group_id = s.group_id)
+          AND s.payee_id IN (SELECT user_id FROM group_members WHERE group_id = s.group_id)
+        UNION ALL
+        SELECT s.payee_id, -s.amount_cents
+        FROM settlements s
+        WHERE s.group_id = ?
+          AND s.payer_id IN (SELECT user_id FROM group_members WHERE group_id = s.group_id)
+          AND s.payee_id IN (SELECT user_id FROM group_members WHERE group_id = s.group_id)
+    )
+    GROUP BY user_id
+'''
+
+# The same ledger as GROUP_BALANCES_SQL, counted and summed per member and kind of line
+GROUP_BALANCE_BREAKDOWN_SQL = '''
+    SELECT user_id, kind, COUNT(*) AS lines, SUM(amount_cents) AS total_cents FROM (
+        SELECT e.paid_by AS user_id, 'paid' AS kind, e.amount_cents
+        FROM expenses e
+        WHERE e.group_id = ? AND EXISTS (
+            SELECT 1 FROM expense_shares es
+            JOIN group_members gm ON gm.group_id = e.group_id AND gm.user_id = es.user_id
+            WHERE es.expense_id = e.id
+        )
+        UNION ALL
+        SELECT es.user_id, 'shares', es.amount_cents
+        FROM expenses e
+        JOIN expense_shares es ON es.expense_id = e.id
+        JOIN group_members gm ON gm.group_id = e.group_id AND gm.user_id = es.user_id
+        WHERE e.group_id = ?
+        UNION ALL
+        SELECT s.payer_id, 'made', s.amount_cents
+        FROM settlements s
+        WHERE s.group_id = ?
+          AND s.payer_id IN (SELECT user_id FROM group_members WHERE group_id = s.group_id)
+          AND s.payee_id IN (SELECT user_id FROM group_members WHERE group_id = s.group_id)
+        UNION ALL
+        SELECT s.payee_id, 'received', s.amount_cents
+        FROM settlements s
+        WHERE s.group_id = ?
+          AND s.payer_id IN (SELECT user_id FROM group_members WHERE group_id = s.group_id)
+          AND s.payee_id IN (SELECT user_id FROM group_members WHERE group_id = s.group_id)
+    )
+    GROUP BY user_id, kind
+'''
+
+def compute_group_balances(conn, group_id):
+    """Recompute a group's balances in cents from its full expense and settlement history"""
+    rows = conn.execute(GROUP_BALANCES_SQL, (group_id, group_id, group_id, group_id)).fetchall()
+    return {row['user_id']: row['balance'] for row in rows}
+
+def rebuild_group_balances(conn, group_ids=None):
+    """Recompute the group_balances projection from scratch (caller commits)"""
+    if group_ids is None:
+        group_ids = [row['id'] for row in conn.execute('SELECT id FROM groups').fetchall()]
+        conn.execute('DELETE FROM group_balances')
+    else:
+        conn.executemany('DELETE FROM group_balances WHERE group_id = ?', [(group_id,) for group_id in group_ids])
     
+    for group_id in group_ids:
+        conn.executemany('''
+            INSERT INTO group_balances (group_id, user_id, balance_cents) VALUES (?, ?, ?)
+        ''', [(group_id, user_id, cents) for user_id, cents in compute_group_balances(conn, group_id).items()])
+    return len(group_ids)
+
+def apply_balance_deltas(conn, group_id, deltas):
+    """Add per-user cent deltas to the group_balances projection (caller commits)"""
+    conn.executemany('''
+        INSERT INTO group_balances (group_id, user_id, balance_cents) VALUES (?, ?, ?)
+        ON CONFLICT (group_id, user_id) DO UPDATE SET balance_cents = balance_cents + excluded.balance_cents
+    ''', [(group_id, user_id, delta) for user_id, delta in deltas.items()])
+
+def record_expense(conn, group_id, description, amount_cents, paid_by, created_by, shares):
+    """Insert an expense with its {user_id: cents} shares and update balances (caller commits)"""
+    cursor = conn.execute('''
+        INSERT INTO expenses (group_id, description, amount_cents, paid_by, created_by, created_at)
+        VALUES (?, ?, ?, ?, ?, ?)
+    ''', (group_id, description, amount_cents, paid_by, created_by, datetime.now().isoformat()))
+    expense_id = cursor.lastrowid
+    
+    conn.executemany('''
+        INSERT INTO expense_shares (expense_id, user_id, amount_cents)
+        VALUES (?, ?, ?)
+    ''', [(expense_id, user_id, share_cents) for user_id, share_cents in shares.items()])
+    
+    # Shares are always split among current members, so the payer is credited in full
+    deltas = defaultdict(int)
+    deltas[paid_by] += amount_cents
+    for user_id, share_cents in shares.items():
+        deltas[user_id] -= share_cents
+    apply_balance_deltas(conn, group_id, deltas)
+    return expense_id
+
+def record_settlement(conn, group_id, payer_id, payee_id, amount_cents, description=None):
+    """Insert a settlement and update balances (caller commits)"""
+    cursor = conn.execute('''
+        INSERT INTO settlements (group_id, payer_id, payee_id, amount_cents, created_at, description)
+        VALUES (?, ?, ?, ?, ?, ?)
+    ''', (group_id, payer_id, payee_id, amount_cents, datetime.now().isoformat(), description))
+    
+    # Settlements involving a non-member don't count towards balances
+    members = conn.execute('''
+        SELECT COUNT(*) FROM group_members WHERE group_id = ? AND user_id IN (?, ?)
+    ''', (group_id, payer_id, payee_id)).fetchone()[0]
+    if members == 2:
+        apply_balance_deltas(conn, group_id, {payer_id: amount_cents, payee_id: -amount_cents})
+    return cursor.lastrowid
+
+def next_row_id(conn, table):
+    """First free id of an AUTOINCREMENT table; only stable while the caller holds the write lock"""
+    row = conn.execute('SELECT seq FROM sqlite_sequence WHERE name = ?', (table,)).fetchone()
+    max_id = conn.execute(f'SELECT COALESCE(MAX(id), 0) FROM {table}').fetchone()[0]
+    return max(row['seq'] if row else 0, max_id) + 1
+
+def record_expenses(conn, group_id, expenses):
+    """Batch variant of record_expense for many rows (caller holds the write lock and commits).
+
+    expenses: (description, amount_cents, paid_by, created_by, created_at, shares) tuples.
+    Ids are assigned up front so expenses and shares each go in with one executemany,
+    and the balance projection gets one upsert per member for the whole batch.
+    """
+    expense_id = next_row_id(conn, 'expenses')
+    expense_rows, share_rows = [], []
+    deltas = defaultdict(int)
+    for description, amount_cents, paid_by, created_by, created_at, shares in expenses:
+        expense_rows.append((expense_id, group_id, description, amount_cents, paid_by, created_by, created_at))
+        share_rows.extend((expense_id, user_id, share_cents) for user_id, share_cents in shares.items())
+        deltas[paid_by] += amount_cents
+        for user_id, share_cents in shares.items():
+            deltas[user_id] -= share_cents
+        expense_id += 1
+    
+    conn.executemany('''
+        INSERT INTO expenses (id, group_id, description, amount_cents, paid_by, created_by, created_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    ''', expense_rows)
+    conn.executemany('''
+        INSERT INTO expense_shares (expense_id, user_id, amount_cents) VALUES (?, ?, ?)
+    ''', share_rows)
+    apply_balance_deltas(conn, group_id, deltas)
+    return len(expense_rows)
+
+def record_settlements(conn, group_id, settlements):
+    """Batch variant of record_settlement for payments between current members (caller commits).
+
+    settlements: (payer_id, payee_id, amount_cents, created_at, description) tuples.
+    """
+    rows = [(group_id, payer_id, payee_id, amount_cents, created_at, description)
+            for payer_id, payee_id, amount_cents, created_at, description in settlements]
+    conn.executemany('''
+        INSERT INTO settlements (group_id, payer_id, payee_id, amount_cents, created_at, description)
+        VALUES (?, ?, ?, ?, ?, ?)
+    ''', rows)
+    
+    deltas = defaultdict(int)
+    for _, payer_id, payee_id, amount_cents, _, _ in rows:
+        deltas[payer_id] += amount_cents
+        deltas[payee_id] -= amount_cents
+    apply_balance_deltas(conn, group_id, deltas)
+    return len(rows)
+
+# Reads of the group_balances projection
+STORED_BALANCES_SQL = 'SELECT user_id, balance_cents FROM group_balances WHERE group_id = ?'
+
+STORED_BALANCES_FOR_GROUPS_SQL = '''
+    SELECT group_id, user_id, balance_cents FROM group_balances WHERE group_id IN ({placeholders})
+'''
+
+USER_BALANCES_SQL = '''
+    SELECT gm.group_id, COALESCE(gb.balance_cents, 0) AS balance_cents
+    FROM group_members gm
+    LEFT JOIN group_balances gb ON gb.group_id = gm.group_id AND gb.user_id = gm.user_id
+    WHERE gm.user_id = ?
+'''
+
+def calculate_balances_cents(group_id):
+    """Net balance per user in cents: paid minus owed, plus settlements made minus received"""
+    conn = get_db_connection()
+    rows = conn.execute(STORED_BALANCES_SQL, (group_id,)).fetchall()
     conn.close()
+    return {row['user_id']: row['balance_cents'] for row in rows}
+
+def calculate_balances_for_groups(group_ids):
+    """Balances in cents for several groups at once: {group_id: {user_id: cents}}"""
+    balances = {group_id: {} for group_id in group_ids}
+    if not balances:
+        return balances
     
-    # Calculate net balances
-    balances = defaultdict(float)
-    processed_expenses = set()
-    
-    # Process expenses
-    for expense in expenses:
-        # Credit the payer with the full amount (only once per expense)
-        if expense['id'] not in processed_expenses:
-            balances[expense['paid_by']] += expense['amount']
-            processed_expenses.add(expense['id'])
-        
-        # Debit each person for their share (including the payer)
-        balances[expense['user_id']] -= expense['share_amount']
-    
-    # Process settlements
-    for settlement in settlements:
-        # When you settle up, your debt decreases (balance becomes more positive)
-        balances[settlement['payer_id']] += settlement['amount']
-        # When you receive payment, people owe you less (balance becomes less positive)  
-        balances[settlement['payee_id']] -= settlement['amount']
+    conn = get_db_connection()
+    placeholders = ','.join('?' * len(balances))
+    rows = conn.execute(STORED_BALANCES_FOR_GROUPS_SQL.format(placeholders=placeholders), tuple(balances)).fetchall()
+    conn.close()
     
-    return dict(balances)
+    for row in rows:
+        balances[row['group_id']][row['user_id']] = row['balance_cents']
+    return balances
 
-def simplify_debts(balances):
-    """Simplify debts to minimize number of transactions"""
-    creditors = [(user_id, amount) for user_id, amount in balances.items() if amount > 0]
-    debtors = [(user_id, -amount) for user_id, amount in balances.items() if amount < 0]
+def get_user_balances_cents(user_id):
+    """The user's balance in cents in every group they belong to, in one query"""
+    conn = get_db_connection()
+    rows = conn.execute(USER_BALANCES_SQL, (user_id,)).fetchall()
+    conn.close()
+    return {row['group_id']: row['balance_cents'] for row in rows}
+
+BALANCE_LINE_KINDS = ('paid', 'shares', 'made', 'received')
+
+def get_balance_breakdown(conn, group_id):
+    """Line counts and totals per member: {user_id: {kind: {'count': n, 'total_cents': cents}}}"""
+    breakdown = defaultdict(lambda: {kind: {'count': 0, 'total_cents': 0} for kind in BALANCE_LINE_KINDS})
+    for row in conn.execute(GROUP_BALANCE_BREAKDOWN_SQL, (group_id,) * 4).fetchall():
+        breakdown[row['user_id']][row['kind']] = {'count': row['lines'], 'total_cents': row['total_cents']}
+    return breakdown
+
+# Itemized lines behind each breakdown total: (cursor kind, table alias, query)
+BALANCE_LINE_QUERIES = {
+    'paid': ('expense', 'e', '''
+        SELECT e.id, e.created_at, e.description, e.amount_cents, NULL as other_name
+        FROM expenses e
+        WHERE e.group_id = ? AND e.paid_by = ? {cursor} AND EXISTS (
+            SELECT 1 FROM expense_shares es
+            JOIN group_members gm ON gm.group_id = e.group_id AND gm.user_id = es.user_id
+            WHERE es.expense_id = e.id
+        )
+        ORDER BY e.created_at DESC, e.id DESC
+        LIMIT ?
+    '''),
+    'shares': ('expense', 'e', '''
+        SELECT e.id, e.created_at, e.description, es.amount_cents, NULL as other_name
+        FROM expenses e
+        JOIN expense_shares es ON es.expense_id = e.id
+        WHERE e.group_id = ? AND es.user_id = ? {cursor}
+        ORDER BY e.created_at DESC, e.id DESC
+        LIMIT ?
+    '''),
+    'made': ('settlement', 's', '''
+        SELECT s.id, s.created_at, s.description, s.amount_cents, u.username as other_name
+        FROM settlements s
+        JOIN users u ON s.payee_id = u.id
+        WHERE s.group_id = ? AND s.payer_id = ? {cursor}
+          AND s.payee_id IN (SELECT user_id FROM group_members WHERE group_id = s.group_id)
+        ORDER BY s.created_at DESC, s.id DESC
+        LIMIT ?
+    '''),
+    'received': ('settlement', 's', '''
+        SELECT s.id, s.created_at, s.description, s.amount_cents, u.username as other_name
+        FROM settlements s
+        JOIN users u ON s.payer_id = u.id
+        WHERE s.group_id = ? AND s.payee_id = ? {cursor}
+          AND s.payer_id IN (SELECT user_id FROM group_members WHERE group_id = s.group_id)
+        ORDER BY s.created_at DESC, s.id DESC
+        LIMIT ?
+    '''),
+}
+
+def get_balance_lines(conn, group_id, user_id, kind, limit, cursor=None):
+    """One keyset page of a member's lines of one kind; returns (lines, next_cursor or None)"""
+    cursor_kind, alias, sql = BALANCE_LINE_QUERIES[kind]
+    params = [group_id, user_id]
+    cursor_clause = ''
+    if cursor:
+        cursor_clause = f'AND ({alias}.created_at, {alias}.id) < (?, ?)'
+        params.extend((cursor[0], cursor[2]))
+    rows = conn.execute(sql.format(cursor=cursor_clause), params + [limit + 1]).fetchall()
+    
+    lines = [dict(row, amount=from_cents(row['amount_cents'])) for row in rows[:limit]]
+    next_cursor = None
+    if len(rows) > limit:
+        next_cursor = encode_history_cursor(lines[-1]['created_at'], cursor_kind, lines[-1]['id'])
+    return lines, next_cursor
+
+def calculate_balances(group_id):
+    """Net balance per user in euros"""
+    return {user_id: from_cents(cents) for user_id, cents in calculate_balances_cents(group_id).items()}
+
+def greedy_settlements(balances_cents):
+    """Match the largest creditor with the largest debtor until everyone is settled"""
+    creditors = [(user_id, amount) for user_id, amount in balances_cents.items() if amount > 0]
+    debtors = [(user_id, -amount) for user_id, amount in balances_cents.items() if amount < 0]
     
-    transactions = []
+    transfers = []
     
     creditors.sort(key=lambda x: x[1], reverse=True)
     debtors.sort(key=lambda x: x[1], reverse=True)
@@ -405,28 +1633,248 @@ def simplify_debts(balances):
         debtor_id, debt_amount = debtors[j]
         
         settle_amount = min(credit_amount, debt_amount)
-        
-        if settle_amount > 0.01:  # Avoid tiny amounts
-            transactions.append({
-                'from': debtor_id,
-                'to': creditor_id,
-                'amount': round(settle_amount, 2)
-            })
+        transfers.append((debtor_id, creditor_id, settle_amount))
         
         creditors[i] = (creditor_id, credit_amount - settle_amount)
         debtors[j] = (debtor_id, debt_amount - settle_amount)
         
-        if creditors[i][1] <= 0.01:
+        if creditors[i][1] == 0:
             i += 1
-        if debtors[j][1] <= 0.01:
+        if debtors[j][1] == 0:
             j += 1
     
-    return transactions
+    return transfers
+
+def zero_sum_subsets(amounts, deadline=None):
+    """Bitmasks of every non-empty subset of amounts that sums to zero.
+    
+    Meet in the middle: the subset sums of each half are enumerated separately
+    and joined on equal and opposite sums, so n amounts cost about 2 * 2^(n/2)
+    sums instead of 2^n. Returns None when the deadline passes.
+    """
+    half = len(amounts) // 2
+    
+    def sums(values, shift):
+        totals = {0: 0}
+        for i, amount in enumerate(values):
+            bit = 1 << (i + shift)
+            for mask, total in list(totals.items()):
+                totals[mask | bit] = total + amount
+        return totals
+    
+    right_by_sum = defaultdict(list)
+    for mask, total in sums(amounts[half:], half).items():
+        right_by_sum[total].append(mask)
+    
+    subsets = []
+    for count, (left, total) in enumerate(sums(amounts[:half], 0).items()):
+        if deadline is not None and not count & 0xFF and time.perf_counter() > deadline:
+            return None
+        subsets.extend(left | right for right in right_by_sum.get(-total, ()) if left | right)
+    return subsets
+
+def zero_sum_partition(amounts, deadline=None):
+    """Split amounts (which sum to zero) into the largest number of zero-sum subsets (lists of indexes).
+    
+    Every part of an optimal split is an atom: a zero-sum subset with no smaller
+    zero-sum subset inside it, otherwise splitting it would add a part. The atoms
+    are found with zero_sum_subsets(), then a memoized search covers the lowest
+    uncovered member with each atom that fits. Returns None when the deadline
+    (a time.perf_counter() value) passes.
+    """
+    n = len(amounts)
+    subsets = zero_sum_subsets(amounts, deadline)
+    if subsets is None:
+        return None
+    
+    atoms = []
+    for mask in sorted(subsets, key=int.bit_count):
+        if not any(atom & mask == atom for atom in atoms):
+            atoms.append(mask)
+        if deadline is not None and time.perf_counter() > deadline:
+            return None
+    by_member = [[atom for atom in atoms if atom >> i & 1] for i in range(n)]
+    
+    # best[covered] = most atoms the uncovered members split into, and the first of them
+    full = (1 << n) - 1
+    best = {full: (0, 0)}
+    
+    def search(covered):
+        if covered not in best:
+            if deadline is not None and time.perf_counter() > deadline:
+                raise TimeoutError
+            low = (~covered & full) & -(~covered & full)
+            most, first = -1, 0
+            for atom in by_member[low.bit_length() - 1]:
+                if not atom & covered:
+                    parts = search(covered | atom)[0] + 1
+                    if parts > most:
+                        most, first = parts, atom
+            best[covered] = (most, first)
+        return best[covered]
+    
+    try:
+        search(0)
+    except TimeoutError:
+        return None
+    
+    groups = []
+    covered = 0
+    while covered != full:
+        atom = best[covered][1]
+        groups.append([i for i in range(n) if atom >> i & 1])
+        covered |= atom
+    return groups
+
+def optimal_settlements(balances_cents, max_balances=None, time_budget_ms=None):
+    """Fewest possible transfers: settle each zero-sum subset of members on its own.
+    
+    Falls back to the greedy matcher when there are too many non-zero balances
+    for the exhaustive search or it runs out of time.
+    """
+    max_balances = max_balances or app.config['SETTLEMENT_OPTIMAL_MAX_BALANCES']
+    time_budget_ms = time_budget_ms or app.config['SETTLEMENT_TIME_BUDGET_MS']
+    
+    nonzero = {user_id: amount for user_id, amount in balances_cents.items() if amount}
+    if sum(nonzero.values()) != 0:
+        return greedy_settlements(balances_cents)
+    
+    # A debtor who owes exactly what a creditor is owed can always settle with one transfer
+    transfers = []
+    by_amount = defaultdict(list)
+    for user_id in sorted(nonzero):
+        amount = nonzero[user_id]
+        if by_amount[-amount]:
+            other = by_amount[-amount].pop(0)
+            debtor, creditor = (user_id, other) if amount < 0 else (other, user_id)
+            transfers.append((debtor, creditor, abs(amount)))
+        else:
+            by_amount[amount].append(user_id)
+    remaining = sorted(user_id for users in by_amount.values() for user_id in users)
+    
+    if len(remaining) > max_balances:
+        return transfers + greedy_settlements({user_id: nonzero[user_id] for user_id in remaining})
+    
+    deadline = time.perf_counter() + time_budget_ms / 1000
+    groups = zero_sum_partition([nonzero[user_id] for user_id in remaining], deadline)
+    if groups is None:
+        return transfers + greedy_settlements({user_id: nonzero[user_id] for user_id in remaining})
+    
+    # Within a zero-sum subset with no smaller zero-sum part, greedy needs exactly size - 1 transfers
+    for group in groups:
+        transfers += greedy_settlements({remaining[i]: nonzero[remaining[i]] for i in group})
+    return transfers
+
+SETTLEMENT_SOLVERS = {
+    'greedy': greedy_settlements,
+    'optimal': optimal_settlements,
+}
+
+def simplify_debts(balances, solver=None):
+    """Simplify debts to minimize number of transactions"""
+    # Balances come from whole cents, so matching in cents is exact and needs no tolerance
+    balances_cents = {user_id: to_cents(amount) for user_id, amount in balances.items()}
+    settle = SETTLEMENT_SOLVERS[solver or app.config['SETTLEMENT_SOLVER']]
+    
+    return [
+        {'from': debtor_id, 'to': creditor_id, 'amount': from_cents(amount)}
+        for debtor_id, creditor_id, amount in settle(balances_cents)
+    ]
+
+# Group history: expenses and settlements merged newest first, paged by keyset on
+# (created_at, kind rank, id). Expenses rank above settlements with the same timestamp.
+HISTORY_KIND_RANKS = {'expense': 1, 'settlement': 0}
+MAX_ROWID = 2 ** 63 - 1
+
+# {where} is the AND-joined filter list built by get_group_history()
+HISTORY_EXPENSES_SQL = '''
+    SELECT e.id, e.created_at, e.description, e.amount_cents, e.paid_by, u.username as paid_by_name
+    FROM expenses e
+    JOIN users u ON e.paid_by = u.id
+    WHERE {where}
+    ORDER BY e.created_at DESC, e.id DESC
+    LIMIT ?
+'''
+
+HISTORY_SETTLEMENTS_SQL = '''
+    SELECT s.id, s.created_at, s.description, s.amount_cents, s.payer_id, s.payee_id,
+           up.username as payer_name, ue.username as payee_name
+    FROM settlements s
+    JOIN users up ON s.payer_id = up.id
+    JOIN users ue ON s.payee_id = ue.id
+    WHERE {where}
+    ORDER BY s.created_at DESC, s.id DESC
+    LIMIT ?
+'''
+
+def encode_history_cursor(created_at, kind, item_id):
+    raw = json.dumps([created_at, HISTORY_KIND_RANKS[kind], item_id]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+def decode_history_cursor(cursor):
+    """Inverse of encode_history_cursor; raises ValueError for anything malformed"""
+    try:
+        created_at, kind_rank, item_id = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    except (TypeError, ValueError, binascii.Error):
+        raise ValueError('Invalid cursor')
+    if not isinstance(created_at, str) or kind_rank not in (0, 1) or not isinstance(item_id, int):
+        raise ValueError('Invalid cursor')
+    return created_at, kind_rank, item_id
+
+def get_group_history(conn, group_id, limit, cursor=None, payer_id=None, member_id=None,
+                      kinds=tuple(HISTORY_KIND_RANKS)):
+    """One page of a group's history; returns (items, next_cursor or None).
+
+    Each table is read through its (group_id, created_at) index starting at the
+    cursor, limit + 1 rows at most, so deep pages cost the same as the first one.
+    """
+    if cursor:
+        created_at, kind_rank, last_id = cursor
+        # Rows of the other kind with the cursor's timestamp are either all before or all after it
+        expense_bound = (created_at, last_id if kind_rank == 1 else 0)
+        settlement_bound = (created_at, last_id if kind_rank == 0 else MAX_ROWID)
+    
+    pages = []
+    if 'expense' in kinds:
+        where, params = ['e.group_id = ?'], [group_id]
+        if cursor:
+            where.append('(e.created_at, e.id) < (?, ?)')
+            params.extend(expense_bound)
+        if payer_id:
+            where.append('e.paid_by = ?')
+            params.append(payer_id)
+        if member_id:
+            where.append('(e.paid_by = ? OR EXISTS (SELECT 1 FROM expense_shares es WHERE es.expense_id = e.id AND es.user_id = ?))')
+            params.extend((member_id, member_id))
+        rows = conn.execute(HISTORY_EXPENSES_SQL.format(where=' AND '.join(where)), params + [limit + 1]).fetchall()
+        pages.extend(dict(row, kind='expense', amount=from_cents(row['amount_cents'])) for row in rows)
+    
+    if 'settlement' in kinds:
+        where, params = ['s.group_id = ?'], [group_id]
+        if cursor:
+            where.append('(s.created_at, s.id) < (?, ?)')
+            params.extend(settlement_bound)
+        if payer_id:
+            where.append('s.payer_id = ?')
+            params.append(payer_id)
+        if member_id:
+            where.append('? IN (s.payer_id, s.payee_id)')
+            params.append(member_id)
+        rows = conn.execute(HISTORY_SETTLEMENTS_SQL.format(where=' AND '.join(where)), params + [limit + 1]).fetchall()
+        pages.extend(dict(row, kind='settlement', amount=from_cents(row['amount_cents'])) for row in rows)
+    
+    pages.sort(key=lambda item: (item['created_at'], HISTORY_KIND_RANKS[item['kind']], item['id']), reverse=True)
+    items = pages[:limit]
+    next_cursor = None
+    if len(pages) > limit:
+        last = items[-1]
+        next_cursor = encode_history_cursor(last['created_at'], last['kind'], last['id'])
+    return items, next_cursor
 
 def get_group_by_invite_code(invite_code):
     """Get group by invite code"""
     conn = get_db_connection()
-    group = conn.execute('SELECT * FROM groups WHERE invite_code = ?', (invite_code,)).fetchone()
+    group = conn.execute(GROUP_BY_INVITE_CODE_SQL, (invite_code,)).fetchone()
     conn.close()
     return group
 
@@ -437,9 +1885,7 @@ def generate_invite_code():
 def is_user_in_group(user_id, group_id):
     """Check if user is already a member of the group"""
     conn = get_db_connection()
-    membership = conn.execute('''
-        SELECT 1 FROM group_members WHERE group_id = ? AND user_id = ?
-    ''', (group_id, user_id)).fetchone()
+    membership = conn.execute(MEMBERSHIP_SQL, (group_id, user_id)).fetchone()
     conn.close()
     return membership is not None
 
@@ -451,6 +1897,8 @@ def add_user_to_group(user_id, group_id):
             INSERT INTO group_members (group_id, user_id, joined_at)
             VALUES (?, ?, ?)
         ''', (group_id, user_id, datetime.now().isoformat()))
+        # Membership decides which shares and settlements count, so refresh the projection
+        rebuild_group_balances(conn, [group_id])
         conn.commit()
         conn.close()
         return True
@@ -458,160 +1906,95 @@ def add_user_to_group(user_id, group_id):
         conn.close()
         return False
 
-def migrate_existing_groups():
+def migrate_existing_groups(conn):
     """Add invite codes to existing groups that don't have them"""
-    conn = get_db_connection()
+    # Check if invite_code column exists
+    cursor = conn.execute("PRAGMA table_info(groups)")
+    columns = [row[1] for row in cursor.fetchall()]
     
-    try:
-        # Check if invite_code column exists
-        cursor = conn.execute("PRAGMA table_info(groups)")
-        columns = [row[1] for row in cursor.fetchall()]
-        
-        if 'invite_code' not in columns:
-            # Add the invite_code column if it doesn't exist (without UNIQUE constraint)
-            conn.execute('ALTER TABLE groups ADD COLUMN invite_code TEXT')
-            conn.commit()
-        
-        # Find groups without invite codes
-        groups_without_codes = conn.execute('''
-            SELECT id FROM groups WHERE invite_code IS NULL OR invite_code = ''
-        ''').fetchall()
-        
-        for group in groups_without_codes:
-            # Generate unique invite code
-            while True:
-                invite_code = generate_invite_code()
-                # Check if code already exists
-                existing = conn.execute('''
-                    SELECT id FROM groups WHERE invite_code = ?
-                ''', (invite_code,)).fetchone()
-                
-                if not existing:
-                    break
+    if 'invite_code' not in columns:
+        # Add the invite_code column if it doesn't exist (without UNIQUE constraint)
+        conn.execute('ALTER TABLE groups ADD COLUMN invite_code TEXT')
+    
+    # Find groups without invite codes
+    groups_without_codes = conn.execute('''
+        SELECT id FROM groups WHERE invite_code IS NULL OR invite_code = ''
+    ''').fetchall()
+    
+    for group in groups_without_codes:
+        # Generate unique invite code
+        while True:
+            invite_code = generate_invite_code()
+            # Check if code already exists
+            existing = conn.execute('''
+                SELECT id FROM groups WHERE invite_code = ?
+            ''', (invite_code,)).fetchone()
             
-            # Update group with invite code
-            conn.execute('''
-                UPDATE groups SET invite_code = ? WHERE id = ?
-            ''', (invite_code, group['id']))
-        
-        conn.commit()
+            if not existing:
+                break
         
-    except Exception as e:
-        print(f"Migration error: {e}")
-        conn.rollback()
-    finally:
-        conn.close()
+        # Update group with invite code
+        conn.execute('''
+            UPDATE groups SET invite_code = ? WHERE id = ?
+        ''', (invite_code, group['id']))
 
-def migrate_users_table():
+def migrate_users_table(conn):
     """Add bank details columns to existing users table"""
-    conn = get_db_connection()
+    # Check if bank details columns exist
+    cursor = conn.execute("PRAGMA table_info(users)")
+    columns = [row[1] for row in cursor.fetchall()]
     
-    try:
-        # Check if bank details columns exist
-        cursor = conn.execute("PRAGMA table_info(users)")
-        columns = [row[1] for row in cursor.fetchall()]
+    if 'full_name' not in columns:
+        conn.execute('ALTER TABLE users ADD COLUMN full_name TEXT')
         
-        if 'full_name' not in columns:
-            conn.execute('ALTER TABLE users ADD COLUMN full_name TEXT')
-            
-        if 'iban' not in columns:
-            conn.execute('ALTER TABLE users ADD COLUMN iban TEXT')
-            
-        if 'bic' not in columns:
-            conn.execute('ALTER TABLE users ADD COLUMN bic TEXT')
-            
-        conn.commit()
+    if 'iban' not in columns:
+        conn.execute('ALTER TABLE users ADD COLUMN iban TEXT')
         
-    except Exception as e:
-        print(f"User table migration error: {e}")
-        conn.rollback()
-    finally:
-        conn.close()
+    if 'bic' not in columns:
+        conn.execute('ALTER TABLE users ADD COLUMN bic TEXT')
 
-def migrate_settlements_table():
+def migrate_settlements_table(conn):
     """Add description column to settlements table if it doesn't exist"""
-    conn = get_db_connection()
+    # Check if description column exists
+    cursor = conn.execute("PRAGMA table_info(settlements)")
+    columns = [row[1] for row in cursor.fetchall()]
     
-    try:
-        # Check if description column exists
-        cursor = conn.execute("PRAGMA table_info(settlements)")
-        columns = [row[1] for row in cursor.fetchall()]
-        
-        if 'description' not in columns:
-            conn.execute('ALTER TABLE settlements ADD COLUMN description TEXT')
-            conn.commit()
-            print("Added description column to settlements table")
-            
-    except Exception as e:
-        print(f"Settlements table migration error: {e}")
-        conn.rollback()
-    finally:
-        conn.close()
+    if 'description' not in columns:
+        conn.execute('ALTER TABLE settlements ADD COLUMN description TEXT')
+        print("Added description column to settlements table")
 
-def cleanup_invalid_expense_shares():
-    """Remove expense shares for users that are not valid group members"""
-    conn = get_db_connection()
-    try:
-        # Get all groups
-        groups = conn.execute('SELECT id FROM groups').fetchall()
-        
-        for group in groups:
-            group_id = group['id']
-            # Get valid member IDs for this group
-            valid_member_ids = [member['id'] for member in get_group_members(group_id)]
-            
-            if valid_member_ids:
-                # Delete expense shares for invalid user IDs
-                placeholders = ','.join('?' * len(valid_member_ids))
-                deleted = conn.execute('''
-                    DELETE FROM expense_shares 
-                    WHERE expense_id IN (
-                        SELECT id FROM expenses WHERE group_id = ?
-                    ) AND user_id NOT IN ({})
-                '''.format(placeholders), (group_id,) + tuple(valid_member_ids))
-                
-                if deleted.rowcount > 0:
-                    print(f"Cleaned up {deleted.rowcount} invalid expense shares for group {group_id}")
-        
-        conn.commit()
-        print("Completed cleanup of invalid expense shares")
-    except Exception as e:
-        print(f"Error during cleanup: {e}")
-        conn.rollback()
-    finally:
-        conn.close()
+# Ledger rows that reference users who are not (or no longer) members of the group.
+# Groups without any members are left alone.
+INVALID_EXPENSE_SHARES_SQL = '''
+    FROM expense_shares es
+    JOIN expenses e ON e.id = es.expense_id
+    WHERE NOT EXISTS (SELECT 1 FROM group_members gm WHERE gm.group_id = e.group_id AND gm.user_id = es.user_id)
+      AND EXISTS (SELECT 1 FROM group_members gm WHERE gm.group_id = e.group_id)
+'''
+INVALID_SETTLEMENTS_SQL = '''
+    FROM settlements s
+    WHERE (NOT EXISTS (SELECT 1 FROM group_members gm WHERE gm.group_id = s.group_id AND gm.user_id = s.payer_id)
+           OR NOT EXISTS (SELECT 1 FROM group_members gm WHERE gm.group_id = s.group_id AND gm.user_id = s.payee_id))
+      AND EXISTS (SELECT 1 FROM group_members gm WHERE gm.group_id = s.group_id)
+'''
 
-def cleanup_invalid_settlements():
-    """Remove settlements for users that are not valid group members"""
-    conn = get_db_connection()
-    try:
-        # Get all groups
-        groups = conn.execute('SELECT id FROM groups').fetchall()
-        
-        for group in groups:
-            group_id = group['id']
-            # Get valid member IDs for this group
-            valid_member_ids = [member['id'] for member in get_group_members(group_id)]
-            
-            if valid_member_ids:
-                # Delete settlements for invalid user IDs
-                placeholders = ','.join('?' * len(valid_member_ids))
-                deleted = conn.execute('''
-                    DELETE FROM settlements 
-                    WHERE group_id = ? AND (payer_id NOT IN ({}) OR payee_id NOT IN ({}))
-                '''.format(placeholders, placeholders), 
-                    (group_id,) + tuple(valid_member_ids) + tuple(valid_member_ids))
-                
-                if deleted.rowcount > 0:
-                    print(f"Cleaned up {deleted.rowcount} invalid settlements for group {group_id}")
-        
-        conn.commit()
-        print("Completed cleanup of invalid settlements")
-    except Exception as e:
-        print(f"Error during cleanup: {e}")
-        conn.rollback()
-    finally:
-        conn.close()
+def cleanup_invalid_expense_shares(conn, dry_run=False):
+    """Remove expense shares of users who are not members of the expense's group (caller commits)"""
+    group_ids = [row[0] for row in conn.execute('SELECT DISTINCT e.group_id ' + INVALID_EXPENSE_SHARES_SQL)]
+    count = conn.execute('SELECT COUNT(*) ' + INVALID_EXPENSE_SHARES_SQL).fetchone()[0]
+    if count and not dry_run:
+        conn.execute('DELETE FROM expense_shares WHERE id IN (SELECT es.id ' + INVALID_EXPENSE_SHARES_SQL + ')')
+        rebuild_group_balances(conn, group_ids)
+    return count, group_ids
+
+def cleanup_invalid_settlements(conn, dry_run=False):
+    """Remove settlements whose payer or payee is not a member of the group (caller commits)"""
+    group_ids = [row[0] for row in conn.execute('SELECT DISTINCT s.group_id ' + INVALID_SETTLEMENTS_SQL)]
+    count = conn.execute('SELECT COUNT(*) ' + INVALID_SETTLEMENTS_SQL).fetchone()[0]
+    if count and not dry_run:
+        conn.execute('DELETE FROM settlements WHERE id IN (SELECT s.id ' + INVALID_SETTLEMENTS_SQL + ')')
+        rebuild_group_balances(conn, group_ids)
+    return count, group_ids
 
 def allowed_file(filename):
     """Check if file extension is allowed"""
@@ -622,65 +2005,213 @@ def ensure_upload_folder():
     """Ensure upload folder exists"""
     os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 
-def generate_epc_qr_code(amount, recipient_name, recipient_iban, recipient_bic=None, reference=None):
-    """Generate EPC QR code for SEPA payments"""
-    try:
-        # EPC QR code format according to European Payments Council guidelines
-        epc_data = [
-            "BCD",  # Service Tag
-            "002",  # Version
-            "1",    # Character set (UTF-8)
-            "SCT",  # Identification (SEPA Credit Transfer)
-            recipient_bic or "",  # BIC of the Beneficiary Bank
-            recipient_name,  # Name of the Beneficiary
-            recipient_iban,  # Account number (IBAN)
-            f"EUR{amount:.2f}",  # Amount in EUR
-            "",     # Purpose (empty)
-            reference or "",  # Structured Reference
-            ""      # Unstructured Remittance Information
-        ]
-        
-        # Join with newlines as per EPC specification
-        epc_string = '\n'.join(epc_data)
-        
-        # Generate QR code
-        qr = qrcode.QRCode(
-            version=1,
-            error_correction=qrcode.constants.ERROR_CORRECT_M,
-            box_size=6,
-            border=4,
-        )
-        qr.add_data(epc_string)
-        qr.make(fit=True)
-        
-        # Create image
-        img = qr.make_image(fill_color="black", back_color="white")
-        
-        # Convert to base64 for embedding in HTML
-        buffer = BytesIO()
-        img.save(buffer, format='PNG')
-        img_str = base64.b64encode(buffer.getvalue()).decode()
-        
-        return f"data:image/png;base64,{img_str}"
-        
-    except Exception as e:
-        print(f"Error generating EPC QR code: {e}")
-        return None
+# Content-addressed upload store: UPLOAD_FOLDER/receipts/ab/cd/<sha256>.<ext>, one file per distinct image.
+# upload_refs records who still needs a blob (a receipt job until it expires, an expense for good).
+UPLOAD_GC_GRACE = timedelta(hours=1)  # never collect blobs referenced this recently
 
-def analyze_receipt_with_gemini(file_path):
-    """Analyze receipt using Gemini AI and extract individual items"""
-    if not GEMINI_API_KEY:
-        return None
+def upload_blob_path(blob_hash, ext):
+    return os.path.join(app.config['UPLOAD_FOLDER'], 'receipts', blob_hash[:2], blob_hash[2:4], f'{blob_hash}.{ext}')
+
+def store_upload_blob(conn, data, ext):
+    """Store data unless an identical blob already exists; returns (hash, path). Caller commits"""
+    blob_hash = hashlib.sha256(data).hexdigest()
+    existing = conn.execute('SELECT ext FROM upload_blobs WHERE hash = ?', (blob_hash,)).fetchone()
+    if existing:
+        ext = existing['ext']
+    
+    path = upload_blob_path(blob_hash, ext)
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write then rename so a concurrent upload of the same image never sees a partial file
+        tmp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    
+    now = datetime.now().isoformat()
+    conn.execute('''
+        INSERT INTO upload_blobs (hash, ext, size_bytes, created_at, last_referenced_at) VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT (hash) DO UPDATE SET last_referenced_at = excluded.last_referenced_at
+    ''', (blob_hash, ext, len(data), now, now))
+    return blob_hash, path
+
+def add_upload_ref(conn, blob_hash, ref_type, ref_id, expires_at=None):
+    """Keep a stored blob alive for ref_type/ref_id (until expires_at, if given). Caller commits"""
+    now = datetime.now().isoformat()
+    conn.execute('''
+        INSERT OR REPLACE INTO upload_refs (blob_hash, ref_type, ref_id, created_at, expires_at)
+        SELECT hash, ?, ?, ?, ? FROM upload_blobs WHERE hash = ?
+    ''', (ref_type, str(ref_id), now, expires_at.isoformat() if expires_at else None, blob_hash))
+    conn.execute('UPDATE upload_blobs SET last_referenced_at = ? WHERE hash = ?', (now, blob_hash))
+
+def collect_upload_garbage(conn, dry_run=False, now=None):
+    """Delete expired references, then the blobs nothing references any more.
+
+    Also sweeps files left behind by the old flat layout (receipt_*) once they are
+    past RECEIPT_UPLOAD_RETENTION, and store files without a blob row. With
+    dry_run nothing is changed and the report says what would be reclaimed.
+    """
+    now = now or datetime.now()
+    grace_cutoff = (now - UPLOAD_GC_GRACE).timestamp()
+    dead_refs = '''
+        (expires_at IS NOT NULL AND expires_at < :now) OR (ref_type = 'expense' AND NOT EXISTS (
+            SELECT 1 FROM expenses e WHERE e.id = CAST(upload_refs.ref_id AS INTEGER)))
+    '''
+    params = {'now': now.isoformat(), 'grace': (now - UPLOAD_GC_GRACE).isoformat()}
+    
+    report = {'refs': conn.execute(f'SELECT COUNT(*) FROM upload_refs WHERE {dead_refs}', params).fetchone()[0]}
+    if not dry_run:
+        conn.execute(f'DELETE FROM upload_refs WHERE {dead_refs}', params)
+    
+    # Blobs whose remaining references are all dead (in a dry run they have not been deleted yet)
+    blobs = conn.execute(f'''
+        SELECT hash, ext, size_bytes FROM upload_blobs b
+        WHERE last_referenced_at < :grace
+        AND NOT EXISTS (SELECT 1 FROM upload_refs WHERE blob_hash = b.hash AND NOT ({dead_refs}))
+    ''', params).fetchall()
+    report['blobs'] = len(blobs)
+    report['blob_bytes'] = sum(blob['size_bytes'] for blob in blobs)
+    known = set(row['hash'] for row in conn.execute('SELECT hash FROM upload_blobs').fetchall())
+    
+    doomed = [upload_blob_path(blob['hash'], blob['ext']) for blob in blobs]
+    if not dry_run:
+        conn.executemany('DELETE FROM upload_blobs WHERE hash = ?', [(blob['hash'],) for blob in blobs])
+        conn.commit()
     
+    # Stray files: legacy flat uploads past retention, and store files whose row never got committed
+    legacy_cutoff = (now - timedelta(seconds=app.config['RECEIPT_UPLOAD_RETENTION'])).timestamp()
+    stray = []
+    upload_folder = app.config['UPLOAD_FOLDER']
+    if os.path.isdir(upload_folder):
+        with os.scandir(upload_folder) as entries:
+            for entry in entries:
+                if entry.is_file() and entry.name.startswith('receipt_') and entry.stat().st_mtime < legacy_cutoff:
+                    stray.append(entry.path)
+    for root, _, files in os.walk(os.path.join(upload_folder, 'receipts')):
+        for name in files:
+            path = os.path.join(root, name)
+            if name.split('.', 1)[0] not in known and os.path.getmtime(path) < grace_cutoff:
+                stray.append(path)
+    report['stray_files'] = len(stray)
+    report['stray_bytes'] = sum(os.path.getsize(path) for path in stray)
+    
+    if not dry_run:
+        for path in doomed + stray:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+    return report
+
+RECEIPT_IMAGE_FORMATS = {'webp': ('WEBP', 'webp'), 'jpeg': ('JPEG', 'jpg')}
+
+def preprocess_receipt_image(image_bytes, original_ext):
+    """Orient, downscale and re-encode an uploaded receipt.
+
+    Returns (bytes, extension, stats). The original bytes are kept when Pillow
+    cannot read the image, or when it needed no rotation, resize or mode change
+    and re-encoding would not make it smaller.
+    """
+    from PIL import Image, ImageOps
+    
+    start = time.perf_counter()
+    pil_format, ext = RECEIPT_IMAGE_FORMATS[app.config['RECEIPT_IMAGE_FORMAT']]
+    output = image_bytes
     try:
-        # Upload file to Gemini
-        file = genai.upload_file(file_path)
-        
-        # Create the model
-        model = genai.GenerativeModel('gemini-1.5-flash')
-        
-        # Analyze the receipt
-        prompt = """
+        with Image.open(BytesIO(image_bytes)) as image:
+            max_edge = app.config['RECEIPT_MAX_EDGE']
+            original = (image.size, image.mode)
+            # 0x0112 is the EXIF Orientation tag; anything but 1 means exif_transpose rotates or flips
+            rotated = image.getexif().get(0x0112, 1) != 1
+            # JPEGs can be decoded at a reduced scale, which is far cheaper than resizing afterwards
+            image.draft('RGB', (max_edge, max_edge))
+            image = ImageOps.exif_transpose(image)
+            image.thumbnail((max_edge, max_edge), Image.LANCZOS)
+            
+            if app.config['RECEIPT_GRAYSCALE']:
+                image = image.convert('L')
+            elif image.mode != 'RGB':
+                # Flatten transparency onto white paper rather than black
+                rgba = image.convert('RGBA')
+                image = Image.new('RGB', rgba.size, 'white')
+                image.paste(rgba, mask=rgba.getchannel('A'))
+            
+            buffer = BytesIO()
+            image.save(buffer, pil_format, quality=app.config['RECEIPT_IMAGE_QUALITY'], optimize=True)
+            # A rotated, resized or converted image must reach Gemini even if it came out larger
+            if rotated or (image.size, image.mode) != original or buffer.tell() < len(image_bytes):
+                output = buffer.getvalue()
+    except (OSError, ValueError, Image.DecompressionBombError) as e:
+        app.logger.warning('Could not preprocess receipt image, storing it unchanged: %s', e)
+    
+    stats = {
+        'original_bytes': len(image_bytes),
+        'stored_bytes': len(output),
+        'preprocess_ms': (time.perf_counter() - start) * 1000,
+    }
+    app.logger.debug('Receipt image %d -> %d bytes (%d saved) in %.1fms', stats['original_bytes'],
+                     stats['stored_bytes'], stats['original_bytes'] - stats['stored_bytes'], stats['preprocess_ms'])
+    return output, ext if output is not image_bytes else original_ext, stats
+
+qr_cache = TTLCache(app.config['QR_CACHE_SIZE'], app.config['QR_CACHE_TTL'])
+metrics.track_cache('qr', qr_cache)
+
+QR_IMAGE_TYPES = {'png': 'image/png', 'svg': 'image/svg+xml'}
+
+def build_epc_payload(amount, recipient_name, recipient_iban, recipient_bic=None, reference=None):
+    """EPC QR payload for a SEPA credit transfer"""
+    # EPC QR code format according to European Payments Council guidelines
+    epc_data = [
+        "BCD",  # Service Tag
+        "002",  # Version
+        "1",    # Character set (UTF-8)
+        "SCT",  # Identification (SEPA Credit Transfer)
+        recipient_bic or "",  # BIC of the Beneficiary Bank
+        recipient_name,  # Name of the Beneficiary
+        recipient_iban,  # Account number (IBAN)
+        f"EUR{amount:.2f}",  # Amount in EUR
+        "",     # Purpose (empty)
+        reference or "",  # Structured Reference
+        ""      # Unstructured Remittance Information
+    ]
+    
+    # Join with newlines as per EPC specification
+    return '\n'.join(epc_data)
+
+def render_qr_code(payload, image_format='png'):
+    """Render payload as PNG or SVG bytes; identical payloads are served from qr_cache"""
+    cache_key = (payload, image_format)
+    image_bytes = qr_cache.get(cache_key)
+    if image_bytes is not None:
+        return image_bytes
+    
+    import qrcode
+    import qrcode.image.svg
+    
+    qr = qrcode.QRCode(
+        version=1,
+        error_correction=qrcode.constants.ERROR_CORRECT_M,
+        box_size=6,
+        border=4,
+    )
+    qr.add_data(payload)
+    qr.make(fit=True)
+    
+    buffer = BytesIO()
+    if image_format == 'svg':
+        qr.make_image(image_factory=qrcode.image.svg.SvgPathImage).save(buffer)
+    else:
+        qr.make_image(fill_color="black", back_color="white").save(buffer, format='PNG')
+    image_bytes = buffer.getvalue()
+    qr_cache.set(cache_key, image_bytes)
+    return image_bytes
+
+def qr_code_etag(payload, image_format):
+    return hashlib.sha256(f"{image_format}\n{payload}".encode()).hexdigest()[:32]
+
+GEMINI_MODEL = 'gemini-1.5-flash'
+
+RECEIPT_PROMPT = """
         Analyze this receipt image and extract ALL individual items as separate entries.
         If an item has quantity > 1, create separate entries for each individual item.
         
@@ -709,18 +2240,40 @@ def analyze_receipt_with_gemini(file_path):
         - Include ALL items from the receipt as separate entries
         - Return valid JSON only, no other text
         """
-        
-        response = model.generate_content([file, prompt])
-        
-        # Parse JSON response
-        response_text = response.text.strip()
-        # Remove markdown code blocks if present
-        if response_text.startswith('```json'):
-            response_text = response_text[7:-3]
-        elif response_text.startswith('```'):
-            response_text = response_text[3:-3]
-        
-        parsed_result = json.loads(response_text)
+
+# Cached analyses are only valid for the prompt and model that produced them
+RECEIPT_ANALYSIS_VERSION = hashlib.sha256(f"{GEMINI_MODEL}\n{RECEIPT_PROMPT}".encode()).hexdigest()[:16]
+
+def analyze_receipt_with_gemini(file_path):
+    """Analyze receipt using Gemini AI and extract individual items"""
+    if not GEMINI_API_KEY:
+        return None
+    
+    try:
+        # A reply that isn't valid JSON counts as a failed call too
+        with metrics.timer('gemini_request_duration_seconds'):
+            gemini = get_genai()
+            
+            # Upload file to Gemini
+            file = gemini.upload_file(file_path)
+            
+            # Create the model
+            model = gemini.GenerativeModel(GEMINI_MODEL)
+            
+            # Analyze the receipt
+            prompt = RECEIPT_PROMPT
+            
+            response = model.generate_content([file, prompt])
+            
+            # Parse JSON response
+            response_text = response.text.strip()
+            # Remove markdown code blocks if present
+            if response_text.startswith('```json'):
+                response_text = response_text[7:-3]
+            elif response_text.startswith('```'):
+                response_text = response_text[3:-3]
+            
+            parsed_result = json.loads(response_text)
         
         # Validate and fix the parsed result
         if 'items' in parsed_result:
@@ -741,13 +2294,532 @@ def analyze_receipt_with_gemini(file_path):
                 if item['price'] < 0:
                     item['price'] = 0.0
         
-        return parsed_result
+        return parsed_result
+        
+    except Exception as e:
+        print(f"Error analyzing receipt: {e}")
+        return None
+
+# Ledger export: each dataset is one query walking the group's (group_id, created_at) index
+# oldest first, so rows can be streamed straight off the cursor without sorting
+EXPORT_DATASETS = {
+    'expenses': '''
+        SELECT e.id, e.created_at, e.description, e.amount_cents, u.username AS paid_by, uc.username AS created_by
+        FROM expenses e
+        JOIN users u ON e.paid_by = u.id
+        JOIN users uc ON e.created_by = uc.id
+        WHERE e.group_id = ?
+        ORDER BY e.created_at, e.id
+    ''',
+    'shares': '''
+        SELECT e.id AS expense_id, e.created_at, e.description, u.username, es.amount_cents
+        FROM expenses e
+        JOIN expense_shares es ON es.expense_id = e.id
+        JOIN users u ON es.user_id = u.id
+        WHERE e.group_id = ?
+        ORDER BY e.created_at, e.id
+    ''',
+    'settlements': '''
+        SELECT s.id, s.created_at, up.username AS payer, ue.username AS payee, s.amount_cents, s.description
+        FROM settlements s
+        JOIN users up ON s.payer_id = up.id
+        JOIN users ue ON s.payee_id = ue.id
+        WHERE s.group_id = ?
+        ORDER BY s.created_at, s.id
+    ''',
+}
+EXPORT_FORMATS = {'csv': 'text/csv', 'ndjson': 'application/x-ndjson'}
+
+def export_chunks(cursor, chunk_size):
+    """Yield lists of rows from an open cursor, chunk_size rows at a time"""
+    while True:
+        rows = cursor.fetchmany(chunk_size)
+        if not rows:
+            return
+        yield rows
+
+def generate_export(group_id, dataset, export_format, chunk_size):
+    """Serialize an export dataset chunk by chunk; holds its own connection until exhausted"""
+    conn = get_db_connection()
+    try:
+        cursor = conn.execute(EXPORT_DATASETS[dataset], (group_id,))
+        columns = [column[0] for column in cursor.description]
+        amount_index = columns.index('amount_cents')
+        
+        if export_format == 'csv':
+            # Amounts go out as euro strings so spreadsheets read them without rounding noise
+            buffer = StringIO()
+            writer = csv.writer(buffer)
+            
+            def drain():
+                chunk = buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+                return chunk
+            
+            writer.writerow(['amount' if column == 'amount_cents' else column for column in columns])
+            yield drain()
+            for rows in export_chunks(cursor, chunk_size):
+                for row in rows:
+                    row = list(row)
+                    row[amount_index] = f'{Decimal(row[amount_index]) / 100:.2f}'
+                    writer.writerow(row)
+                yield drain()
+        else:
+            for rows in export_chunks(cursor, chunk_size):
+                yield ''.join(json.dumps(dict(zip(columns, row)), separators=(',', ':')) + '\n' for row in rows)
+    finally:
+        conn.close()
+
+# CSV ledger import (Splitwise export format):
+#   Date,Description,Category,Cost,Currency,<member>,<member>,...
+# Each member column is that member's net for the row: what they paid minus their share.
+# Rows in the "Payment" category are settlements; the closing "Total balance" row is skipped.
+IMPORT_FIXED_COLUMNS = ['date', 'description', 'category', 'cost', 'currency']
+IMPORT_BATCH_SIZE = 1000
+IMPORT_MAX_ERRORS = 20
+
+def map_import_columns(header, members, name_map=None):
+    """Resolve the member columns of a CSV header to user ids, or raise ValueError"""
+    if [column.strip().lower() for column in header[:5]] != IMPORT_FIXED_COLUMNS:
+        raise ValueError('Expected columns: Date, Description, Category, Cost, Currency, then one per member')
+    
+    lookup = {}
+    for member in members:
+        lookup[member['username'].lower()] = member['id']
+        if member['full_name']:
+            lookup.setdefault(member['full_name'].lower(), member['id'])
+    name_map = {name.lower(): username.lower() for name, username in (name_map or {}).items()}
+    
+    column_users, unknown = [], []
+    for name in header[5:]:
+        key = name.strip().lower()
+        user_id = lookup.get(name_map.get(key, key))
+        if user_id is None:
+            unknown.append(name.strip())
+        column_users.append(user_id)
+    if unknown:
+        raise ValueError(f"Not group members: {', '.join(unknown)}. Map them to usernames or add them to the group first.")
+    if len(set(column_users)) != len(column_users):
+        raise ValueError('Two columns map to the same member')
+    return column_users
+
+def parse_import_row(row, column_users, created_by):
+    """Turn one CSV row into ('expense' | 'settlement', record) or None for rows to skip; raises ValueError"""
+    if not row or not any(field.strip() for field in row):
+        return None
+    date, description, category, cost, currency = (field.strip() for field in row[:5])
+    if description.lower() == 'total balance' or not date:
+        return None
+    if len(row) != 5 + len(column_users):
+        raise ValueError(f'expected {5 + len(column_users)} fields, got {len(row)}')
+    if currency and currency.upper() != 'EUR':
+        raise ValueError(f'currency {currency} is not supported, only EUR')
+    
+    try:
+        created_at = datetime.fromisoformat(date).isoformat()
+        amount_cents = to_cents(cost)
+        nets = {user_id: to_cents(field.strip() or '0') for user_id, field in zip(column_users, row[5:])}
+    except (ValueError, ArithmeticError):
+        raise ValueError('invalid date or amount')
+    
+    if amount_cents <= 0:
+        raise ValueError('cost must be positive')
+    if sum(nets.values()) != 0:
+        raise ValueError('member columns do not add up to zero')
+    
+    payers = [user_id for user_id, net in nets.items() if net > 0]
+    if category.lower() == 'payment':
+        payees = [user_id for user_id, net in nets.items() if net < 0]
+        if len(payers) != 1 or len(payees) != 1 or nets[payers[0]] != amount_cents:
+            raise ValueError('a payment must move its cost from one member to one other')
+        return 'settlement', (payers[0], payees[0], amount_cents, created_at, description or None)
+    
+    if not payers:
+        return None  # Someone paid only for themselves; nothing to split
+    if len(payers) > 1:
+        raise ValueError('expenses with several payers are not supported')
+    paid_by = payers[0]
+    shares = {user_id: -net for user_id, net in nets.items() if net < 0}
+    payer_share = amount_cents - sum(shares.values())
+    if payer_share < 0:
+        raise ValueError('shares add up to more than the cost')
+    if payer_share:
+        shares[paid_by] = payer_share
+    return 'expense', (description or 'Imported expense', amount_cents, paid_by, created_by, created_at, shares)
+
+def import_ledger_csv(conn, group_id, lines, created_by, name_map=None, skip_invalid=False, batch_size=IMPORT_BATCH_SIZE):
+    """Stream a CSV into the group's ledger inside one transaction.
+
+    lines is any iterable of text lines (an open file, an upload stream), read
+    row by row and written in executemany batches, so memory stays flat however
+    long the file is. Invalid rows abort the import unless skip_invalid is set.
+    Returns a report dict; raises ValueError with the first errors when aborting.
+    """
+    start = time.perf_counter()
+    reader = csv.reader(lines)
+    header = next(reader, None)
+    if header is None:
+        raise ValueError('The file is empty')
+    
+    members = conn.execute('''
+        SELECT u.id, u.username, u.full_name FROM users u
+        JOIN group_members gm ON u.id = gm.user_id
+        WHERE gm.group_id = ?
+    ''', (group_id,)).fetchall()
+    column_users = map_import_columns(header, members, name_map)
+    
+    report = {'rows': 0, 'expenses': 0, 'settlements': 0, 'skipped': 0, 'errors': []}
+    expenses, settlements = [], []
+    
+    def flush():
+        report['expenses'] += record_expenses(conn, group_id, expenses)
+        report['settlements'] += record_settlements(conn, group_id, settlements)
+        del expenses[:], settlements[:]
+    
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        for row in reader:
+            report['rows'] += 1
+            try:
+                parsed = parse_import_row(row, column_users, created_by)
+            except ValueError as e:
+                report['skipped'] += 1
+                if len(report['errors']) < IMPORT_MAX_ERRORS:
+                    report['errors'].append(f"Line {reader.line_num}: {e}")
+                if not skip_invalid:
+                    raise ValueError('; '.join(report['errors']))
+                continue
+            
+            if parsed is None:
+                report['skipped'] += 1
+            elif parsed[0] == 'expense':
+                expenses.append(parsed[1])
+            else:
+                settlements.append(parsed[1])
+            if len(expenses) + len(settlements) >= batch_size:
+                flush()
+        flush()
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    
+    report['seconds'] = time.perf_counter() - start
+    report['rows_per_second'] = report['rows'] / report['seconds'] if report['seconds'] else 0.0
+    return report
+
+def format_import_report(report):
+    return (f"Imported {report['expenses']} expenses and {report['settlements']} settlements from {report['rows']} rows "
+            f"({report['skipped']} skipped) in {report['seconds']:.2f}s, {report['rows_per_second']:.0f} rows/s")
+
+@app.cli.command('receipt-cache-stats')
+@click.option('--evict', is_flag=True, help='Drop expired entries and trim to RECEIPT_CACHE_MAX_BYTES first.')
+def receipt_cache_stats_command(evict):
+    """Show size and hit counts of the receipt analysis cache."""
+    conn = get_db_connection()
+    try:
+        if evict:
+            click.echo(f"Evicted {evict_receipt_analysis_cache(conn)} entries.")
+            conn.commit()
+        row = conn.execute('''
+            SELECT COUNT(*) AS entries, COALESCE(SUM(size_bytes), 0) AS size_bytes
+            FROM receipt_analysis_cache
+        ''').fetchone()
+        stats = conn.execute('SELECT hits, misses FROM receipt_analysis_cache_stats WHERE id = 1').fetchone()
+    finally:
+        conn.close()
+    
+    lookups = stats['hits'] + stats['misses']
+    hit_rate = stats['hits'] / lookups if lookups else 0.0
+    click.echo(f"{row['entries']} entries, {row['size_bytes']} bytes, "
+               f"{stats['hits']} hits, {stats['misses']} misses, hit rate {hit_rate:.0%}")
+
+@app.cli.command('receipt-image-stats')
+def receipt_image_stats_command():
+    """Show how much receipt preprocessing saved over the retained jobs."""
+    conn = get_db_connection()
+    try:
+        row = conn.execute('''
+            SELECT COUNT(*) AS images, COALESCE(SUM(original_bytes), 0) AS original_bytes,
+                   COALESCE(SUM(stored_bytes), 0) AS stored_bytes, AVG(preprocess_ms) AS avg_ms,
+                   MAX(preprocess_ms) AS max_ms
+            FROM receipt_jobs WHERE original_bytes IS NOT NULL
+        ''').fetchone()
+    finally:
+        conn.close()
+    
+    if not row['images']:
+        click.echo('No preprocessed receipts recorded.')
+        return
+    saved = row['original_bytes'] - row['stored_bytes']
+    click.echo(f"{row['images']} images, {row['original_bytes']} -> {row['stored_bytes']} bytes "
+               f"({saved} saved, {saved / row['original_bytes']:.0%}), "
+               f"preprocessing avg {row['avg_ms']:.1f}ms, max {row['max_ms']:.1f}ms")
+
+@app.cli.command('gc-uploads')
+@click.option('--dry-run', is_flag=True, help='Only report what would be removed.')
+def gc_uploads_command(dry_run):
+    """Remove stored receipt images that nothing references any more."""
+    conn = get_db_connection()
+    try:
+        report = collect_upload_garbage(conn, dry_run=dry_run)
+    finally:
+        conn.close()
+    
+    verb = 'Would remove' if dry_run else 'Removed'
+    click.echo(f"{verb} {report['refs']} expired references, {report['blobs']} blobs ({report['blob_bytes']} bytes) "
+               f"and {report['stray_files']} stray files ({report['stray_bytes']} bytes).")
+    click.echo(f"Reclaimable: {report['blob_bytes'] + report['stray_bytes']} bytes.")
+
+@app.cli.command('cleanup-sessions')
+def cleanup_sessions_command():
+    """Delete expired server-side sessions."""
+    click.echo(f"Removed {cleanup_expired_sessions()} expired sessions.")
+
+@app.cli.command('import-csv')
+@click.argument('csv_file', type=click.Path(exists=True, dir_okay=False))
+@click.option('--group-id', type=int, required=True, help='Group to import into.')
+@click.option('--created-by', help='Username recorded as creator of the expenses (default: the group creator).')
+@click.option('--map', 'mappings', multiple=True, metavar='NAME=USERNAME', help='Map a CSV column name to a member (repeatable).')
+@click.option('--skip-invalid', is_flag=True, help='Skip rows that fail validation instead of aborting.')
+def import_csv_command(csv_file, group_id, created_by, mappings, skip_invalid):
+    """Import a Splitwise-style CSV export into a group's ledger."""
+    try:
+        name_map = dict(mapping.split('=', 1) for mapping in mappings)
+    except ValueError:
+        raise click.BadParameter('use NAME=USERNAME', param_hint='--map')
+    
+    conn = get_db_connection()
+    try:
+        group = conn.execute('SELECT created_by FROM groups WHERE id = ?', (group_id,)).fetchone()
+        if not group:
+            raise click.ClickException(f'Group {group_id} not found')
+        creator_id = group['created_by']
+        if created_by:
+            user = conn.execute('SELECT id FROM users WHERE username = ?', (created_by,)).fetchone()
+            if not user:
+                raise click.ClickException(f'User {created_by} not found')
+            creator_id = user['id']
+        
+        with open(csv_file, newline='', encoding='utf-8-sig') as f:
+            report = import_ledger_csv(conn, group_id, f, creator_id, name_map, skip_invalid)
+    except ValueError as e:
+        raise click.ClickException(f'Import aborted, nothing was written: {e}')
+    finally:
+        conn.close()
+    
+    for error in report['errors']:
+        click.echo(f"Skipped {error}")
+    click.echo(format_import_report(report))
+
+@app.cli.command('cleanup-ledger')
+@click.option('--dry-run', is_flag=True, help='Only report what would be deleted.')
+def cleanup_ledger_command(dry_run):
+    """Delete expense shares and settlements of users who are not members of the group."""
+    conn = get_db_connection()
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        shares, share_groups = cleanup_invalid_expense_shares(conn, dry_run)
+        settlements, settlement_groups = cleanup_invalid_settlements(conn, dry_run)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+    
+    verb = 'Would delete' if dry_run else 'Deleted'
+    click.echo(f"{verb} {shares} expense shares in {len(share_groups)} groups "
+               f"and {settlements} settlements in {len(settlement_groups)} groups.")
+
+@app.cli.command('rebuild-balances')
+@click.option('--group-id', type=int, multiple=True, help='Only rebuild these groups (repeatable).')
+@click.option('--check', is_flag=True, help='Report groups whose stored balances drifted, without writing.')
+def rebuild_balances_command(group_id, check):
+    """Recompute the group_balances projection from the full ledger."""
+    conn = get_db_connection()
+    try:
+        if check:
+            group_ids = list(group_id) or [row['id'] for row in conn.execute('SELECT id FROM groups').fetchall()]
+            drifted = 0
+            for gid in group_ids:
+                stored = {row['user_id']: row['balance_cents'] for row in conn.execute(
+                    STORED_BALANCES_SQL, (gid,)).fetchall()}
+                if stored != compute_group_balances(conn, gid):
+                    drifted += 1
+                    click.echo(f"Group {gid}: stored balances differ from the ledger")
+            click.echo(f"Checked {len(group_ids)} groups, {drifted} drifted.")
+            if drifted:
+                raise SystemExit(1)
+            return
+        
+        rebuilt = rebuild_group_balances(conn, list(group_id) or None)
+        conn.commit()
+    finally:
+        conn.close()
+    click.echo(f"Rebuilt balances for {rebuilt} groups.")
+
+def receipt_cache_key(image_bytes):
+    """SHA-256 of the image bytes, scoped to the current prompt/model version"""
+    return f"{RECEIPT_ANALYSIS_VERSION}:{hashlib.sha256(image_bytes).hexdigest()}"
+
+def get_cached_receipt_analysis(cache_key):
+    """Return a cached analysis that is still within its TTL, or None, counting the hit or miss"""
+    now = datetime.now()
+    oldest = (now - timedelta(seconds=app.config['RECEIPT_CACHE_TTL'])).isoformat()
+    conn = get_db_connection()
+    try:
+        row = conn.execute('''
+            SELECT result FROM receipt_analysis_cache WHERE cache_key = ? AND created_at >= ?
+        ''', (cache_key, oldest)).fetchone()
+        if row:
+            conn.execute('''
+                UPDATE receipt_analysis_cache SET hits = hits + 1, last_used_at = ? WHERE cache_key = ?
+            ''', (now.isoformat(), cache_key))
+        # Totals live outside the cache rows so eviction and re-stores don't lose them
+        kind = 'hits' if row else 'misses'
+        conn.execute(f'UPDATE receipt_analysis_cache_stats SET {kind} = {kind} + 1 WHERE id = 1')
+        conn.commit()
+    finally:
+        conn.close()
+    
+    metrics.inc(f'cache_{kind}_total', {'cache': 'receipt'})
+    app.logger.debug('Receipt analysis cache %s for %s', 'hit' if row else 'miss', cache_key)
+    return json.loads(row['result']) if row else None
+
+def store_receipt_analysis(cache_key, result):
+    """Cache an analysis, then evict expired entries and the least recently used over the size cap"""
+    now = datetime.now()
+    payload = json.dumps(result)
+    conn = get_db_connection()
+    try:
+        conn.execute('''
+            INSERT OR REPLACE INTO receipt_analysis_cache (cache_key, result, size_bytes, hits, created_at, last_used_at)
+            VALUES (?, ?, ?, 0, ?, ?)
+        ''', (cache_key, payload, len(payload.encode()), now.isoformat(), now.isoformat()))
+        evict_receipt_analysis_cache(conn, now)
+        conn.commit()
+    finally:
+        conn.close()
+
+def evict_receipt_analysis_cache(conn, now=None):
+    """Delete expired entries and trim the cache to RECEIPT_CACHE_MAX_BYTES (caller commits)"""
+    now = now or datetime.now()
+    oldest = (now - timedelta(seconds=app.config['RECEIPT_CACHE_TTL'])).isoformat()
+    evicted = conn.execute('DELETE FROM receipt_analysis_cache WHERE created_at < ?', (oldest,)).rowcount
+    
+    total = 0
+    over_limit = []
+    for row in conn.execute('''
+        SELECT cache_key, size_bytes FROM receipt_analysis_cache ORDER BY last_used_at DESC
+    ''').fetchall():
+        total += row['size_bytes']
+        if total > app.config['RECEIPT_CACHE_MAX_BYTES']:
+            over_limit.append((row['cache_key'],))
+    conn.executemany('DELETE FROM receipt_analysis_cache WHERE cache_key = ?', over_limit)
+    return evicted + len(over_limit)
+
+def analyze_receipt(file_path):
+    """Analyze a receipt, reusing the cached result when the same image was analyzed before"""
+    with open(file_path, 'rb') as f:
+        cache_key = receipt_cache_key(f.read())
+    
+    cached = get_cached_receipt_analysis(cache_key)
+    if cached is not None:
+        return cached
+    
+    result = analyze_receipt_with_gemini(file_path)
+    if result:
+        store_receipt_analysis(cache_key, result)
+    return result
+
+_receipt_executor_lock = threading.Lock()
+
+def get_receipt_executor():
+    """Per-worker thread pool for receipt analysis, recreated in each forked worker"""
+    with _receipt_executor_lock:
+        pid, executor = app.extensions.get('receipt_executor', (None, None))
+        if pid != os.getpid():
+            executor = ThreadPoolExecutor(max_workers=app.config['RECEIPT_WORKERS'],
+                                          thread_name_prefix='receipt-analysis')
+            app.extensions['receipt_executor'] = (os.getpid(), executor)
+    return executor
+
+RECEIPT_JOB_SQL = 'SELECT * FROM receipt_jobs WHERE id = ? AND user_id = ?'
+PURGE_RECEIPT_JOBS_SQL = 'DELETE FROM receipt_jobs WHERE updated_at < ?'
+
+def update_receipt_job(job_id, status, result=None, error=None):
+    conn = get_db_connection()
+    try:
+        conn.execute('''
+            UPDATE receipt_jobs SET status = ?, result = ?, error = ?, updated_at = ? WHERE id = ?
+        ''', (status, json.dumps(result) if result is not None else None, error,
+              datetime.now().isoformat(), job_id))
+        conn.commit()
+    finally:
+        conn.close()
+
+def run_receipt_job(job_id, file_path):
+    """Worker-thread body: analyze the receipt and record the outcome on the job"""
+    with app.app_context():
+        update_receipt_job(job_id, 'running')
+        try:
+            result = analyze_receipt(file_path)
+        except Exception:
+            app.logger.exception('Receipt job %s failed', job_id)
+            result = None
         
-    except Exception as e:
-        print(f"Error analyzing receipt: {e}")
-        return None
+        if result:
+            update_receipt_job(job_id, 'done', result=result)
+        elif not GEMINI_API_KEY:
+            update_receipt_job(job_id, 'failed', error='Gemini AI not configured. Please set GEMINI_API_KEY environment variable.')
+        else:
+            update_receipt_job(job_id, 'failed', error='Could not analyze receipt. Please add items manually.')
+
+def enqueue_receipt_job(user_id, group_id, image_bytes, ext, image_stats=None):
+    """Store the image, record a queued job, hand it to the worker pool and return its id"""
+    job_id = uuid.uuid4().hex
+    now = datetime.now()
+    image_stats = image_stats or {}
+    conn = get_db_connection()
+    try:
+        blob_hash, file_path = store_upload_blob(conn, image_bytes, ext)
+        add_upload_ref(conn, blob_hash, 'receipt_job', job_id,
+                       expires_at=now + timedelta(seconds=app.config['RECEIPT_UPLOAD_RETENTION']))
+        filename = os.path.relpath(file_path, app.config['UPLOAD_FOLDER'])
+        conn.execute('''
+            INSERT INTO receipt_jobs (id, user_id, group_id, filename, status, created_at, updated_at,
+                                      original_bytes, stored_bytes, preprocess_ms)
+            VALUES (?, ?, ?, ?, 'queued', ?, ?, ?, ?, ?)
+        ''', (job_id, user_id, group_id, filename, now.isoformat(), now.isoformat(),
+              image_stats.get('original_bytes'), image_stats.get('stored_bytes'),
+              image_stats.get('preprocess_ms')))
+        oldest = now - timedelta(seconds=app.config['RECEIPT_JOB_RETENTION'])
+        conn.execute(PURGE_RECEIPT_JOBS_SQL, (oldest.isoformat(),))
+        conn.commit()
+    finally:
+        conn.close()
+    
+    get_receipt_executor().submit(run_receipt_job, job_id, file_path)
+    return job_id
+
+def get_receipt_job(conn, job_id, user_id):
+    """Fetch a user's job, failing it if it was left unfinished (e.g. its worker was restarted)"""
+    job = conn.execute(RECEIPT_JOB_SQL, (job_id, user_id)).fetchone()
+    if job and job['status'] in ('queued', 'running'):
+        stale_before = datetime.now() - timedelta(seconds=app.config['RECEIPT_JOB_TIMEOUT'])
+        if datetime.fromisoformat(job['updated_at']) < stale_before:
+            update_receipt_job(job_id, 'failed', error='Receipt analysis timed out. Please try again or add items manually.')
+            job = conn.execute('SELECT * FROM receipt_jobs WHERE id = ?', (job_id,)).fetchone()
+    return job
 
 # Password reset helper functions
+RESET_TOKEN_SQL = 'SELECT user_id, expires_at, used FROM password_reset_tokens WHERE token = ?'
+USE_RESET_TOKEN_SQL = 'UPDATE password_reset_tokens SET used = TRUE WHERE token = ?'
+UNUSED_RESET_TOKENS_SQL = 'DELETE FROM password_reset_tokens WHERE user_id = ? AND used = FALSE'
+EXPIRED_RESET_TOKENS_SQL = 'DELETE FROM password_reset_tokens WHERE expires_at < ? OR used = TRUE'
+
 def generate_reset_token():
     """Generate a secure random token for password reset"""
     return ''.join(secrets.choice(string.ascii_letters + string.digits) for _ in range(32))
@@ -760,10 +2832,7 @@ def create_password_reset_token(user_id):
     conn = get_db_connection()
     try:
         # Delete any existing unused tokens for this user
-        conn.execute('''
-            DELETE FROM password_reset_tokens 
-            WHERE user_id = ? AND used = FALSE
-        ''', (user_id,))
+        conn.execute(UNUSED_RESET_TOKENS_SQL, (user_id,))
         
         # Insert new token
         conn.execute('''
@@ -783,11 +2852,7 @@ def validate_reset_token(token):
     """Validate a password reset token and return user_id if valid"""
     conn = get_db_connection()
     try:
-        result = conn.execute('''
-            SELECT user_id, expires_at, used
-            FROM password_reset_tokens
-            WHERE token = ?
-        ''', (token,)).fetchone()
+        result = conn.execute(RESET_TOKEN_SQL, (token,)).fetchone()
         
         if not result:
             return None
@@ -809,11 +2874,7 @@ def mark_token_as_used(token):
     """Mark a reset token as used"""
     conn = get_db_connection()
     try:
-        conn.execute('''
-            UPDATE password_reset_tokens
-            SET used = TRUE
-            WHERE token = ?
-        ''', (token,))
+        conn.execute(USE_RESET_TOKEN_SQL, (token,))
         conn.commit()
     finally:
         conn.close()
@@ -840,7 +2901,8 @@ def send_password_reset_email(user_email, reset_token):
                                reset_token=reset_token,
                                app_name='Smart Split')
         )
-        mail.send(msg)
+        with metrics.timer('smtp_send_duration_seconds'):
+            mail.send(msg)
         print("Email sent successfully!")
         return True
     except Exception as e:
@@ -853,14 +2915,119 @@ def cleanup_expired_tokens():
     """Clean up expired password reset tokens"""
     conn = get_db_connection()
     try:
-        conn.execute('''
-            DELETE FROM password_reset_tokens
-            WHERE expires_at < ? OR used = TRUE
-        ''', (datetime.now().isoformat(),))
+        conn.execute(EXPIRED_RESET_TOKENS_SQL, (datetime.now().isoformat(),))
         conn.commit()
     finally:
         conn.close()
 
+# Route queries with more than one caller or worth a plan check (see HOT_PATH_QUERIES)
+EXPENSE_DETAIL_SQL = '''
+    SELECT e.*,
+           e.amount_cents / 100.0 as amount,
+           up.username as paid_by_name,
+           uc.username as created_by_name,
+           g.name as group_name
+    FROM expenses e
+    JOIN users up ON e.paid_by = up.id
+    JOIN users uc ON e.created_by = uc.id
+    JOIN groups g ON e.group_id = g.id
+    WHERE e.id = ? AND e.group_id = ?
+'''
+
+EXPENSE_SHARES_SQL = '''
+    SELECT es.*, es.amount_cents / 100.0 as amount, u.username, u.id as user_id
+    FROM expense_shares es
+    JOIN users u ON es.user_id = u.id
+    WHERE es.expense_id = ? AND es.user_id IN ({placeholders})
+    ORDER BY u.username
+'''
+
+RECENT_SETTLEMENTS_SQL = '''
+    SELECT s.*,
+           s.amount_cents / 100.0 as amount,
+           up.username as payer_name,
+           ue.username as payee_name
+    FROM settlements s
+    JOIN users up ON s.payer_id = up.id
+    JOIN users ue ON s.payee_id = ue.id
+    WHERE s.group_id = ?
+    ORDER BY s.created_at DESC
+    LIMIT 20
+'''
+
+GROUP_EXPENSE_COUNT_SQL = 'SELECT COUNT(*) FROM expenses WHERE group_id = ?'
+
+# Query plan checks
+# The statements the routes run, built from the same constants with representative
+# parameters; check_query_plans() asserts none of them full-scans a table.
+HOT_PATH_QUERIES = [
+    ('membership check', MEMBERSHIP_SQL, (1, 1)),
+    ('user group ids', USER_GROUP_IDS_SQL, (1,)),
+    ('user by id', USER_BY_ID_SQL, (1,)),
+    ('user by username', USER_BY_USERNAME_SQL, ('alice',)),
+    ('user by email', USER_BY_EMAIL_SQL, ('alice@example.com',)),
+    ('group by id', GROUP_BY_ID_SQL, (1,)),
+    ('group by invite code', GROUP_BY_INVITE_CODE_SQL, ('ABCD1234',)),
+    ('get_user_groups', USER_GROUPS_SQL, (1,)),
+    ('get_group_members', GROUP_MEMBERS_SQL, (1,)),
+    ('compute_group_balances', GROUP_BALANCES_SQL, (1, 1, 1, 1)),
+    ('calculate_balances_cents', STORED_BALANCES_SQL, (1,)),
+    ('calculate_balances_for_groups', STORED_BALANCES_FOR_GROUPS_SQL.format(placeholders='?,?'), (1, 2)),
+    ('get_user_balances_cents', USER_BALANCES_SQL, (1,)),
+    ('expense_detail expense', EXPENSE_DETAIL_SQL, (1, 1)),
+    ('expense_detail shares', EXPENSE_SHARES_SQL.format(placeholders='?,?'), (1, 1, 2)),
+    ('group_admin recent settlements', RECENT_SETTLEMENTS_SQL, (1,)),
+    ('balance_details expense count', GROUP_EXPENSE_COUNT_SQL, (1,)),
+    ('balance_details breakdown', GROUP_BALANCE_BREAKDOWN_SQL, (1, 1, 1, 1)),
+    ('balance lines shares', BALANCE_LINE_QUERIES['shares'][2].format(cursor=''), (1, 1, 21)),
+    ('balance lines made', BALANCE_LINE_QUERIES['made'][2].format(cursor=''), (1, 1, 21)),
+    ('history expenses page', HISTORY_EXPENSES_SQL.format(where='e.group_id = ? AND (e.created_at, e.id) < (?, ?)'),
+     (1, '2100-01-01', 1, 21)),
+    ('history settlements page', HISTORY_SETTLEMENTS_SQL.format(where='s.group_id = ? AND (s.created_at, s.id) < (?, ?)'),
+     (1, '2100-01-01', 1, 21)),
+    ('reset token lookup', RESET_TOKEN_SQL, ('x',)),
+    ('use reset token', USE_RESET_TOKEN_SQL, ('x',)),
+    ('reset tokens of user', UNUSED_RESET_TOKENS_SQL, (1,)),
+    ('expired reset tokens', EXPIRED_RESET_TOKENS_SQL, ('2000-01-01',)),
+    ('session lookup', SESSION_LOOKUP_SQL, ('x', '2000-01-01')),
+    ('expired sessions', EXPIRED_SESSIONS_SQL, ('2000-01-01',)),
+    ('export expenses', EXPORT_DATASETS['expenses'], (1,)),
+    ('export shares', EXPORT_DATASETS['shares'], (1,)),
+    ('export settlements', EXPORT_DATASETS['settlements'], (1,)),
+    ('receipt job status', RECEIPT_JOB_SQL, ('x', 1)),
+    ('purge old receipt jobs', PURGE_RECEIPT_JOBS_SQL, ('2000-01-01',)),
+]
+
+def explain_query_plan(conn, sql, params=()):
+    """Return the EXPLAIN QUERY PLAN detail lines for a statement"""
+    return [row['detail'] for row in conn.execute('EXPLAIN QUERY PLAN ' + sql, params).fetchall()]
+
+def check_query_plans(conn, queries=None):
+    """Return (name, detail) for every plan step that scans a table without an index"""
+    problems = []
+    for name, sql, params in queries or HOT_PATH_QUERIES:
+        for detail in explain_query_plan(conn, sql, params):
+            # Scanning a materialized subquery is fine, scanning a base table is not
+            if detail.startswith('SCAN ') and ' USING ' not in detail and not detail.startswith(('SCAN (', 'SCAN CONSTANT')):
+                problems.append((name, detail))
+    return problems
+
+@app.cli.command('check-query-plans')
+def check_query_plans_command():
+    """Fail if any hot-path route query full-scans a table."""
+    conn = get_db_connection()
+    try:
+        run_migrations(conn)
+        problems = check_query_plans(conn)
+    finally:
+        conn.close()
+    
+    for name, detail in problems:
+        click.echo(f"FULL SCAN  {name}: {detail}")
+    if problems:
+        raise SystemExit(1)
+    click.echo(f"All {len(HOT_PATH_QUERIES)} hot-path queries use an index.")
+
 # Routes
 @app.route('/')
 def index():
@@ -973,6 +3140,7 @@ def reset_password(token):
                     WHERE id = ?
                 ''', (new_password_hash, user_id))
                 conn.commit()
+                user_cache.invalidate(user_id)
                 
                 # Mark token as used
                 mark_token_as_used(token)
@@ -995,21 +3163,14 @@ def dashboard():
     groups = get_user_groups(current_user.id)
     
     # Calculate total balances across all groups
-    total_you_owe = 0
-    total_owed_to_you = 0
-    
-    for group in groups:
-        balances = calculate_balances(group['id'])
-        user_balance = balances.get(current_user.id, 0)
-        if user_balance < 0:
-            total_you_owe += abs(user_balance)
-        else:
-            total_owed_to_you += user_balance
+    user_balances = get_user_balances_cents(current_user.id)
+    total_you_owe = sum(-cents for cents in user_balances.values() if cents < 0)
+    total_owed_to_you = sum(cents for cents in user_balances.values() if cents > 0)
     
     return render_template('dashboard.html', 
                          groups=groups, 
-                         total_you_owe=total_you_owe,
-                         total_owed_to_you=total_owed_to_you)
+                         total_you_owe=from_cents(total_you_owe),
+                         total_owed_to_you=from_cents(total_owed_to_you))
 
 @app.route('/groups')
 @login_required
@@ -1023,21 +3184,18 @@ def create_group():
     form = GroupForm()
     if form.validate_on_submit():
         conn = get_db_connection()
-        cursor = conn.cursor()
         
         # Generate unique invite code
         invite_code = generate_invite_code()
         
         # Create group
-        cursor.execute('''
+        group_id = conn.execute('''
             INSERT INTO groups (name, description, created_by, invite_code, created_at)
             VALUES (?, ?, ?, ?, ?)
-        ''', (form.name.data, form.description.data, current_user.id, invite_code, datetime.now().isoformat()))
-        
-        group_id = cursor.lastrowid
+        ''', (form.name.data, form.description.data, current_user.id, invite_code, datetime.now().isoformat())).lastrowid
         
         # Add creator as member
-        cursor.execute('''
+        conn.execute('''
             INSERT INTO group_members (group_id, user_id, joined_at)
             VALUES (?, ?, ?)
         ''', (group_id, current_user.id, datetime.now().isoformat()))
@@ -1056,30 +3214,21 @@ def group_detail(group_id):
     conn = get_db_connection()
     
     # Check if user is member of group
-    membership = conn.execute('''
-        SELECT 1 FROM group_members WHERE group_id = ? AND user_id = ?
-    ''', (group_id, current_user.id)).fetchone()
+    membership = conn.execute(MEMBERSHIP_SQL, (group_id, current_user.id)).fetchone()
     
     if not membership:
         flash('You are not a member of this group.', 'error')
+        conn.close()
         return redirect(url_for('groups'))
     
     # Get group info
-    group = conn.execute('SELECT * FROM groups WHERE id = ?', (group_id,)).fetchone()
+    group = conn.execute(GROUP_BY_ID_SQL, (group_id,)).fetchone()
     
     # Get members
     members = get_group_members(group_id)
     
-    # Get recent expenses
-    expenses = conn.execute('''
-        SELECT e.*, u.username as paid_by_name, uc.username as created_by_name
-        FROM expenses e
-        JOIN users u ON e.paid_by = u.id
-        JOIN users uc ON e.created_by = uc.id
-        WHERE e.group_id = ?
-        ORDER BY e.created_at DESC
-        LIMIT 10
-    ''', (group_id,)).fetchall()
+    # Get recent expenses; older pages are loaded from the history API as the user scrolls
+    expenses, expenses_cursor = get_group_history(conn, group_id, 10, kinds=('expense',))
     
     conn.close()
     
@@ -1098,7 +3247,8 @@ def group_detail(group_id):
                          expenses=expenses,
                          balances=balances,
                          simplified_debts=simplified_debts,
-                         member_names=member_names)
+                         member_names=member_names,
+                         expenses_cursor=expenses_cursor)
 
 @app.route('/groups/<int:group_id>/add_expense', methods=['GET', 'POST'])
 @login_required
@@ -1106,16 +3256,21 @@ def add_expense(group_id):
     conn = get_db_connection()
     
     # Check if user is member of group
-    membership = conn.execute('''
-        SELECT 1 FROM group_members WHERE group_id = ? AND user_id = ?
-    ''', (group_id, current_user.id)).fetchone()
+    membership = conn.execute(MEMBERSHIP_SQL, (group_id, current_user.id)).fetchone()
     
     if not membership:
         flash('You are not a member of this group.', 'error')
+        conn.close()
         return redirect(url_for('groups'))
     
+    # Arriving from a failed receipt scan: say why the items have to be entered by hand
+    if request.method == 'GET' and request.args.get('receipt_job'):
+        job = get_receipt_job(conn, request.args['receipt_job'], current_user.id)
+        if job and job['status'] == 'failed' and job['group_id'] == group_id:
+            flash(job['error'], 'warning')
+    
     # Get group and members
-    group = conn.execute('SELECT * FROM groups WHERE id = ?', (group_id,)).fetchone()
+    group = conn.execute(GROUP_BY_ID_SQL, (group_id,)).fetchone()
     members = get_group_members(group_id)
     
     form = ExpenseForm()
@@ -1123,17 +3278,17 @@ def add_expense(group_id):
     form.split_among.choices = [(m['id'], m['username']) for m in members]
     
     if form.validate_on_submit():
-        cursor = conn.cursor()
+        amount_cents = to_cents(form.amount.data)
         
         # Validate custom amounts if custom split is selected
         if form.split_type.data == 'custom':
             try:
                 custom_amounts = json.loads(form.custom_amounts.data) if form.custom_amounts.data else {}
-                total_custom = sum(float(amount) for amount in custom_amounts.values())
+                total_custom = sum(to_cents(amount) for amount in custom_amounts.values())
                 
-                # Check if custom amounts add up to total expense amount (within 0.01 tolerance)
-                if abs(total_custom - form.amount.data) > 0.01:
-                    flash(f'Custom amounts (€{total_custom:.2f}) must equal the total expense amount (€{form.amount.data:.2f})', 'error')
+                # Check if custom amounts add up to total expense amount, to the cent
+                if total_custom != amount_cents:
+                    flash(f'Custom amounts (€{from_cents(total_custom):.2f}) must equal the total expense amount (€{from_cents(amount_cents):.2f})', 'error')
                     conn.close()
                     return render_template('groups/add_expense.html', form=form, group=group, members=members)
                     
@@ -1144,40 +3299,27 @@ def add_expense(group_id):
                         conn.close()
                         return render_template('groups/add_expense.html', form=form, group=group, members=members)
                         
-            except (json.JSONDecodeError, ValueError, TypeError):
+            except (json.JSONDecodeError, ValueError, TypeError, ArithmeticError):
                 flash('Invalid custom amounts data', 'error')
                 conn.close()
                 return render_template('groups/add_expense.html', form=form, group=group, members=members)
         
-        # Create expense
-        cursor.execute('''
-            INSERT INTO expenses (group_id, description, amount, paid_by, created_by, created_at)
-            VALUES (?, ?, ?, ?, ?, ?)
-        ''', (group_id, form.description.data, form.amount.data, 
-              form.paid_by.data, current_user.id, datetime.now().isoformat()))
-        
-        expense_id = cursor.lastrowid
+        # Hold the write lock so the id the leftover cents are rotated by is the one the expense gets
+        conn.execute('BEGIN IMMEDIATE')
+        expense_id = next_row_id(conn, 'expenses')
         
         # Create expense shares based on split type
         if form.split_type.data == 'equal':
-            # Calculate equal split among selected members
-            split_members = form.split_among.data
-            share_amount = form.amount.data / len(split_members)
-            
-            for member_id in split_members:
-                cursor.execute('''
-                    INSERT INTO expense_shares (expense_id, user_id, amount)
-                    VALUES (?, ?, ?)
-                ''', (expense_id, member_id, share_amount))
+            # Split equally among selected members; leftover cents rotate with the expense id
+            share_amounts = split_cents(amount_cents, form.split_among.data, expense_id)
         else:
             # Use custom amounts
             custom_amounts = json.loads(form.custom_amounts.data)
-            for member_id in form.split_among.data:
-                amount = float(custom_amounts[str(member_id)])
-                cursor.execute('''
-                    INSERT INTO expense_shares (expense_id, user_id, amount)
-                    VALUES (?, ?, ?)
-                ''', (expense_id, member_id, amount))
+            share_amounts = {member_id: to_cents(custom_amounts[str(member_id)]) for member_id in form.split_among.data}
+        
+        # Create expense, its shares and the balance updates in one transaction
+        record_expense(conn, group_id, form.description.data, amount_cents,
+                       form.paid_by.data, current_user.id, share_amounts)
         
         conn.commit()
         conn.close()
@@ -1194,60 +3336,54 @@ def scan_receipt(group_id):
     conn = get_db_connection()
     
     # Check if user is member of group
-    membership = conn.execute('''
-        SELECT 1 FROM group_members WHERE group_id = ? AND user_id = ?
-    ''', (group_id, current_user.id)).fetchone()
+    membership = conn.execute(MEMBERSHIP_SQL, (group_id, current_user.id)).fetchone()
     
     if not membership:
         flash('You are not a member of this group.', 'error')
+        conn.close()
         return redirect(url_for('groups'))
     
     # Get group info
-    group = conn.execute('SELECT * FROM groups WHERE id = ?', (group_id,)).fetchone()
+    group = conn.execute(GROUP_BY_ID_SQL, (group_id,)).fetchone()
     conn.close()
     
     if request.method == 'POST':
         ensure_upload_folder()
+        # The scanner page uploads with fetch() and polls the job; plain form posts get redirected
+        wants_json = request.accept_mimetypes.best == 'application/json'
         
-        # Check if file was uploaded
-        if 'receipt_file' not in request.files:
-            flash('No file selected', 'error')
-            return render_template('groups/scan_receipt.html', group=group)
-        
-        file = request.files['receipt_file']
+        file = request.files.get('receipt_file')
+        if not file or file.filename == '':
+            error = 'No file selected'
+        elif not allowed_file(file.filename):
+            error = 'Invalid file type. Please upload an image file (PNG, JPG, JPEG, GIF, BMP, WebP)'
+        else:
+            error = None
         
-        # Check if file was actually selected
-        if file.filename == '':
-            flash('No file selected', 'error')
+        if error:
+            if wants_json:
+                return jsonify({'error': error}), 400
+            flash(error, 'error')
             return render_template('groups/scan_receipt.html', group=group)
         
-        # Validate file type and save
-        if file and allowed_file(file.filename):
-            # Create secure filename with timestamp and user ID
-            timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-            original_filename = secure_filename(file.filename)
-            filename = f"receipt_{current_user.id}_{group_id}_{timestamp}_{original_filename}"
-            
-            file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-            file.save(file_path)
-            
-            # Analyze receipt with Gemini AI
-            receipt_analysis = analyze_receipt_with_gemini(file_path)
-            
-            if receipt_analysis:
-                # Store analysis in session for item selection
-                session['receipt_analysis'] = receipt_analysis
-                session['receipt_filename'] = filename
-                return redirect(url_for('select_receipt_items', group_id=group_id))
-            else:
-                if not GEMINI_API_KEY:
-                    flash('Gemini AI not configured. Please set GEMINI_API_KEY environment variable.', 'warning')
-                else:
-                    flash('Could not analyze receipt. Please add items manually.', 'warning')
-                return redirect(url_for('add_expense', group_id=group_id))
-        else:
-            flash('Invalid file type. Please upload an image file (PNG, JPG, JPEG, GIF, BMP, WebP)', 'error')
-    
+        # Normalize the image first: smaller files upload to Gemini faster and take less disk
+        original_ext = os.path.splitext(secure_filename(file.filename))[1]
+        image_bytes, ext, image_stats = preprocess_receipt_image(file.read(), original_ext.lstrip('.'))
+        
+        # Store (deduplicated by content) and analyze in the background so the worker is free while Gemini runs
+        job_id = enqueue_receipt_job(current_user.id, group_id, image_bytes, ext, image_stats)
+        if wants_json:
+            return jsonify({
+                'job_id': job_id,
+                'status': 'queued',
+                'status_url': url_for('api_receipt_job_status', job_id=job_id)
+            }), 202
+        return redirect(url_for('scan_receipt', group_id=group_id, job=job_id))
+    
+    job_id = request.args.get('job')
+    if job_id:
+        return render_template('groups/scan_receipt.html', group=group, job_id=job_id,
+                               status_url=url_for('api_receipt_job_status', job_id=job_id))
     return render_template('groups/scan_receipt.html', group=group)
 
 @app.route('/groups/<int:group_id>/select_items', methods=['GET', 'POST'])
@@ -1256,16 +3392,15 @@ def select_receipt_items(group_id):
     conn = get_db_connection()
     
     # Check if user is member of group
-    membership = conn.execute('''
-        SELECT 1 FROM group_members WHERE group_id = ? AND user_id = ?
-    ''', (group_id, current_user.id)).fetchone()
+    membership = conn.execute(MEMBERSHIP_SQL, (group_id, current_user.id)).fetchone()
     
     if not membership:
         flash('You are not a member of this group.', 'error')
+        conn.close()
         return redirect(url_for('groups'))
     
     # Get group info and members
-    group = conn.execute('SELECT * FROM groups WHERE id = ?', (group_id,)).fetchone()
+    group = conn.execute(GROUP_BY_ID_SQL, (group_id,)).fetchone()
     members_rows = conn.execute('''
         SELECT u.* FROM users u 
         JOIN group_members gm ON u.id = gm.user_id 
@@ -1275,10 +3410,19 @@ def select_receipt_items(group_id):
     # Convert SQLite Row objects to dictionaries for JSON serialization
     members = [dict(member) for member in members_rows]
     
+    # Pick up the result of a finished background analysis
+    job_id = request.args.get('job')
+    if job_id:
+        job = get_receipt_job(conn, job_id, current_user.id)
+        if job and job['group_id'] == group_id and job['status'] == 'done':
+            session['receipt_analysis'] = json.loads(job['result'])
+            session['receipt_filename'] = job['filename']
+    
     # Check if we have receipt analysis in session
     receipt_analysis = session.get('receipt_analysis')
     if not receipt_analysis:
         flash('No receipt analysis found. Please upload a receipt again.', 'error')
+        conn.close()
         return redirect(url_for('scan_receipt', group_id=group_id))
     
     if request.method == 'POST':
@@ -1320,7 +3464,6 @@ def select_receipt_items(group_id):
         
         # Process item selections
         selected_items = []
-        total_amount = 0
         
         for i, item in enumerate(receipt_analysis['items']):
             # Check if this item is in split mode
@@ -1344,22 +3487,14 @@ def select_receipt_items(group_id):
                 group_members_only = [user_id for user_id in selected_by if user_id in valid_member_ids]
                 
                 if group_members_only:  # Only create expense if group members are involved
-                    # Calculate individual share for this single item
                     try:
-                        price = float(item.get('price', 0))
-                        
-                        # Calculate individual share based on group members only (ignore guests for debt tracking)
-                        individual_share = round(price / len(group_members_only), 2)
-                        
                         selected_items.append({
                             'name': item['name'],
-                            'price': price,
+                            'price_cents': to_cents(item.get('price', 0)),
                             'selected_by': group_members_only,  # Only group members for expense tracking
-                            'individual_share': individual_share,
                             'is_split': is_split_mode
                         })
-                        total_amount += price
-                    except (ValueError, TypeError, ZeroDivisionError) as e:
+                    except (ValueError, TypeError, ArithmeticError) as e:
                         flash(f'Error processing item {item.get("name", "Unknown")}: {str(e)}', 'error')
                         conn.close()
                         return render_template('groups/select_receipt_items.html', 
@@ -1401,16 +3536,13 @@ def select_receipt_items(group_id):
             remaining_users = [user_id for user_id in item['selected_by'] if user_id not in confirmed_user_ids]
             
             if remaining_users:
-                # Recalculate individual share for remaining users
-                individual_share = item['price'] / len(remaining_users)
                 filtered_selected_items.append({
                     'name': item['name'],
-                    'price': item['price'],
+                    'price_cents': item['price_cents'],
                     'selected_by': remaining_users,
-                    'individual_share': individual_share,
                     'is_split': item['is_split']
                 })
-                actual_total_amount += item['price']
+                actual_total_amount += item['price_cents']
         
         # Only create expense if there are remaining unpaid items
         if not filtered_selected_items:
@@ -1421,42 +3553,31 @@ def select_receipt_items(group_id):
             
             confirmed_count = len(confirmed_user_payments)
             flash(f'All {confirmed_count} payment(s) have been confirmed! No expense added to the group.', 'success')
+            conn.close()
             return redirect(url_for('group_detail', group_id=group_id))
 
         # Create single expense for the remaining unpaid amount
         try:
-            cursor = conn.cursor()
+            # Aggregate expense shares per user (to avoid duplicate user_id entries);
+            # each item is split to the cent, so the shares always add up to the expense.
+            # Leftover cents rotate with the expense id and the item, under the write lock
+            conn.execute('BEGIN IMMEDIATE')
+            expense_id = next_row_id(conn, 'expenses')
+            user_shares = defaultdict(int)
+            for i, item in enumerate(filtered_selected_items):
+                for user_id, share_cents in split_cents(item['price_cents'], item['selected_by'], expense_id + i).items():
+                    user_shares[user_id] += share_cents
             
-            # Create the main expense
+            # Create the main expense with its shares
             store_name = receipt_analysis.get('store_name', 'Receipt')
-            cursor.execute('''
-                INSERT INTO expenses (group_id, description, amount, paid_by, created_by, created_at)
-                VALUES (?, ?, ?, ?, ?, ?)
-            ''', (group_id, f"Receipt from {store_name}", actual_total_amount, bill_payer_id, current_user.id, datetime.now().isoformat()))
-            
-            expense_id = cursor.lastrowid
+            expense_id = record_expense(conn, group_id, f"Receipt from {store_name}", actual_total_amount,
+                                        bill_payer_id, current_user.id, user_shares)
             
-            # Aggregate expense shares per user (to avoid duplicate user_id entries)
-            user_shares = {}
-            for item in filtered_selected_items:
-                for user_id in item['selected_by']:
-                    if user_id not in user_shares:
-                        user_shares[user_id] = 0
-                    user_shares[user_id] += item['individual_share']
-            
-            # Create expense shares for each user
-            total_shares_amount = 0
-            for user_id, total_share in user_shares.items():
-                cursor.execute('''
-                    INSERT INTO expense_shares (expense_id, user_id, amount)
-                    VALUES (?, ?, ?)
-                ''', (expense_id, user_id, total_share))
-                total_shares_amount += total_share
-            
-            # Update the expense amount to match the sum of shares
-            cursor.execute('''
-                UPDATE expenses SET amount = ? WHERE id = ?
-            ''', (total_shares_amount, expense_id))
+            # The expense keeps its receipt image; the stored file is named after its content hash
+            receipt_filename = session.get('receipt_filename')
+            if receipt_filename:
+                blob_hash = os.path.basename(receipt_filename).split('.', 1)[0]
+                add_upload_ref(conn, blob_hash, 'expense', expense_id)
             
             conn.commit()
             conn.close()
@@ -1471,9 +3592,9 @@ def select_receipt_items(group_id):
             # Create success message based on confirmed payments
             if confirmed_user_payments:
                 confirmed_total = sum(confirmed_user_payments.values())
-                flash(f'Receipt processed! {len(confirmed_user_payments)} payment(s) confirmed (€{confirmed_total:.2f}). Expense added for remaining €{actual_total_amount:.2f} paid by {payer_name}.', 'success')
+                flash(f'Receipt processed! {len(confirmed_user_payments)} payment(s) confirmed (€{confirmed_total:.2f}). Expense added for remaining €{from_cents(actual_total_amount):.2f} paid by {payer_name}.', 'success')
             else:
-                flash(f'Successfully added receipt expenses! {payer_name} paid €{actual_total_amount:.2f} total.', 'success')
+                flash(f'Successfully added receipt expenses! {payer_name} paid €{from_cents(actual_total_amount):.2f} total.', 'success')
             
             return redirect(url_for('group_detail', group_id=group_id))
             
@@ -1503,9 +3624,7 @@ def expense_detail(group_id, expense_id):
     conn = get_db_connection()
     
     # Check if user is member of group
-    membership = conn.execute('''
-        SELECT 1 FROM group_members WHERE group_id = ? AND user_id = ?
-    ''', (group_id, current_user.id)).fetchone()
+    membership = conn.execute(MEMBERSHIP_SQL, (group_id, current_user.id)).fetchone()
     
     if not membership:
         flash('You are not a member of this group.', 'error')
@@ -1513,17 +3632,7 @@ def expense_detail(group_id, expense_id):
         return redirect(url_for('groups'))
     
     # Get expense details
-    expense = conn.execute('''
-        SELECT e.*, 
-               up.username as paid_by_name, 
-               uc.username as created_by_name,
-               g.name as group_name
-        FROM expenses e
-        JOIN users up ON e.paid_by = up.id
-        JOIN users uc ON e.created_by = uc.id
-        JOIN groups g ON e.group_id = g.id
-        WHERE e.id = ? AND e.group_id = ?
-    ''', (expense_id, group_id)).fetchone()
+    expense = conn.execute(EXPENSE_DETAIL_SQL, (expense_id, group_id)).fetchone()
     
     if not expense:
         flash('Expense not found.', 'error')
@@ -1535,16 +3644,12 @@ def expense_detail(group_id, expense_id):
     members = get_group_members(group_id)
     valid_member_ids = [member['id'] for member in members]
     
-    expense_shares = conn.execute('''
-        SELECT es.*, u.username, u.id as user_id
-        FROM expense_shares es
-        JOIN users u ON es.user_id = u.id
-        WHERE es.expense_id = ? AND es.user_id IN ({})
-        ORDER BY u.username
-    '''.format(','.join('?' * len(valid_member_ids))), (expense_id,) + tuple(valid_member_ids)).fetchall()
+    placeholders = ','.join('?' * len(valid_member_ids))
+    expense_shares = conn.execute(EXPENSE_SHARES_SQL.format(placeholders=placeholders),
+                                  (expense_id,) + tuple(valid_member_ids)).fetchall()
     
     # Get group info for navigation
-    group = conn.execute('SELECT * FROM groups WHERE id = ?', (group_id,)).fetchone()
+    group = conn.execute(GROUP_BY_ID_SQL, (group_id,)).fetchone()
     
     conn.close()
     
@@ -1565,9 +3670,7 @@ def balance_details(group_id):
     conn = get_db_connection()
     
     # Check if user is member of group
-    membership = conn.execute('''
-        SELECT 1 FROM group_members WHERE group_id = ? AND user_id = ?
-    ''', (group_id, current_user.id)).fetchone()
+    membership = conn.execute(MEMBERSHIP_SQL, (group_id, current_user.id)).fetchone()
     
     if not membership:
         flash('You are not a member of this group.', 'error')
@@ -1575,93 +3678,35 @@ def balance_details(group_id):
         return redirect(url_for('groups'))
     
     # Get group info
-    group = conn.execute('SELECT * FROM groups WHERE id = ?', (group_id,)).fetchone()
+    group = conn.execute(GROUP_BY_ID_SQL, (group_id,)).fetchone()
     
     # Get all group members
     members = get_group_members(group_id)
     
-    # Get all expenses with detailed information
-    expenses = conn.execute('''
-        SELECT e.*, 
-               up.username as paid_by_name, 
-               uc.username as created_by_name
-        FROM expenses e
-        JOIN users up ON e.paid_by = up.id
-        JOIN users uc ON e.created_by = uc.id
-        WHERE e.group_id = ?
-        ORDER BY e.created_at DESC
-    ''', (group_id,)).fetchall()
-    
-    # Get valid group member IDs
-    valid_member_ids = [member['id'] for member in members]
-    
-    # Get all expense shares, but only for valid group members
-    expense_shares = conn.execute('''
-        SELECT es.*, e.description as expense_description, e.created_at, u.username
-        FROM expense_shares es
-        JOIN expenses e ON es.expense_id = e.id
-        JOIN users u ON es.user_id = u.id
-        WHERE e.group_id = ? AND es.user_id IN ({})
-        ORDER BY e.created_at DESC, u.username
-    '''.format(','.join('?' * len(valid_member_ids))), (group_id,) + tuple(valid_member_ids)).fetchall()
-    
-    # Get all settlements, but only for valid group members
-    settlements = conn.execute('''
-        SELECT s.*, 
-               up.username as payer_name, 
-               ue.username as payee_name
-        FROM settlements s
-        JOIN users up ON s.payer_id = up.id
-        JOIN users ue ON s.payee_id = ue.id
-        WHERE s.group_id = ? AND s.payer_id IN ({}) AND s.payee_id IN ({})
-        ORDER BY s.created_at DESC
-    '''.format(','.join('?' * len(valid_member_ids)), ','.join('?' * len(valid_member_ids))), 
-        (group_id,) + tuple(valid_member_ids) + tuple(valid_member_ids)).fetchall()
+    # Per-member totals in one grouped pass; the itemized lines are fetched on demand
+    breakdown = get_balance_breakdown(conn, group_id)
+    total_expenses = conn.execute(GROUP_EXPENSE_COUNT_SQL, (group_id,)).fetchone()[0]
     
     conn.close()
     
-    # Calculate balances for display
-    balances = calculate_balances(group_id)
-    
     # Organize data by member for detailed view
     member_details = {}
+    balances = {}
     for member in members:
         member_id = member['id']
+        totals = breakdown[member_id]
+        balance_cents = (totals['paid']['total_cents'] - totals['shares']['total_cents']
+                         + totals['made']['total_cents'] - totals['received']['total_cents'])
+        balances[member_id] = from_cents(balance_cents)
         member_details[member_id] = {
             'member': dict(member),
-            'balance': balances.get(member_id, 0),
-            'expenses_paid': [],
-            'expense_shares': [],
-            'settlements_made': [],
-            'settlements_received': []
+            'balance': balances[member_id],
+            **{kind: {'count': totals[kind]['count'], 'total': from_cents(totals[kind]['total_cents'])}
+               for kind in BALANCE_LINE_KINDS}
         }
     
-    # Add expense details
-    for expense in expenses:
-        paid_by_id = expense['paid_by']
-        if paid_by_id in member_details:
-            member_details[paid_by_id]['expenses_paid'].append(dict(expense))
-    
-    # Add expense share details
-    for share in expense_shares:
-        user_id = share['user_id']
-        if user_id in member_details:
-            member_details[user_id]['expense_shares'].append(dict(share))
-    
-    # Add settlement details
-    for settlement in settlements:
-        payer_id = settlement['payer_id']
-        payee_id = settlement['payee_id']
-        
-        if payer_id in member_details:
-            member_details[payer_id]['settlements_made'].append(dict(settlement))
-        
-        if payee_id in member_details:
-            member_details[payee_id]['settlements_received'].append(dict(settlement))
-    
-    # Calculate summary statistics
-    total_expenses = len(expenses)
-    total_settlements = len(settlements)
+    # Every settlement between members is made by exactly one of them
+    total_settlements = sum(details['made']['count'] for details in member_details.values())
     
     return render_template('groups/balance_details.html', 
                          group=dict(group), 
@@ -1671,6 +3716,101 @@ def balance_details(group_id):
                          total_expenses=total_expenses,
                          total_settlements=total_settlements)
 
+@app.route('/api/groups/<int:group_id>/members/<int:user_id>/balance-lines')
+@login_required
+def api_balance_lines(group_id, user_id):
+    """Itemized lines behind one member's balance total, one keyset page at a time"""
+    kind = request.args.get('kind')
+    if kind not in BALANCE_LINE_QUERIES:
+        return jsonify({'error': 'kind must be one of ' + ', '.join(BALANCE_LINE_KINDS)}), 400
+    
+    conn = get_db_connection()
+    members = set(row['user_id'] for row in conn.execute('''
+        SELECT user_id FROM group_members WHERE group_id = ? AND user_id IN (?, ?)
+    ''', (group_id, current_user.id, user_id)).fetchall())
+    
+    if current_user.id not in members:
+        conn.close()
+        return jsonify({'error': 'Not authorized'}), 403
+    if user_id not in members:
+        conn.close()
+        return jsonify({'error': 'Member not found'}), 404
+    
+    limit = request.args.get('limit', app.config['HISTORY_PAGE_SIZE'], type=int)
+    limit = max(1, min(limit, app.config['HISTORY_MAX_PAGE_SIZE']))
+    try:
+        cursor = request.args.get('cursor')
+        cursor = decode_history_cursor(cursor) if cursor else None
+    except ValueError as e:
+        conn.close()
+        return jsonify({'error': str(e)}), 400
+    
+    lines, next_cursor = get_balance_lines(conn, group_id, user_id, kind, limit, cursor)
+    conn.close()
+    
+    for line in lines:
+        if kind in ('paid', 'shares'):
+            line['url'] = url_for('expense_detail', group_id=group_id, expense_id=line['id'])
+        else:
+            prefix = 'Payment to' if kind == 'made' else 'Payment from'
+            line['description'] = f"{prefix} {line['other_name']}" + (f" - {line['description']}" if line['description'] else '')
+    return jsonify({'lines': lines, 'next_cursor': next_cursor})
+
+@app.route('/groups/<int:group_id>/export/<dataset>.<export_format>')
+@login_required
+def export_ledger(group_id, dataset, export_format):
+    """Stream a group's expenses, shares or settlements as CSV or NDJSON"""
+    if dataset not in EXPORT_DATASETS or export_format not in EXPORT_FORMATS:
+        return jsonify({'error': f"Export one of {', '.join(EXPORT_DATASETS)} as {' or '.join(EXPORT_FORMATS)}"}), 404
+    if not is_user_in_group(current_user.id, group_id):
+        return jsonify({'error': 'Not authorized'}), 403
+    
+    # The generator owns its connection, so nothing is buffered before the first chunk goes out
+    rows = generate_export(group_id, dataset, export_format, app.config['EXPORT_CHUNK_SIZE'])
+    response = Response(stream_with_context(rows), mimetype=EXPORT_FORMATS[export_format])
+    response.headers['Content-Disposition'] = f'attachment; filename=group-{group_id}-{dataset}.{export_format}'
+    return response
+
+@app.route('/groups/<int:group_id>/import', methods=['GET', 'POST'])
+@login_required
+def import_ledger(group_id):
+    """Upload a CSV export to bring a group's existing history into Smart Split"""
+    conn = get_db_connection()
+    group = conn.execute(GROUP_BY_ID_SQL, (group_id,)).fetchone()
+    
+    if not group or not is_user_in_group(current_user.id, group_id):
+        flash('You are not a member of this group.', 'error')
+        conn.close()
+        return redirect(url_for('groups'))
+    
+    if group['created_by'] != current_user.id:
+        flash('Only the group creator can import expenses.', 'error')
+        conn.close()
+        return redirect(url_for('group_detail', group_id=group_id))
+    
+    if request.method == 'POST':
+        file = request.files.get('csv_file')
+        if not file or file.filename == '':
+            flash('No file selected', 'error')
+        else:
+            # Parse the upload as a stream of lines rather than reading it into memory
+            lines = TextIOWrapper(file.stream, encoding='utf-8-sig', newline='')
+            try:
+                report = import_ledger_csv(conn, group_id, lines, current_user.id,
+                                           skip_invalid=bool(request.form.get('skip_invalid')))
+            except (ValueError, UnicodeDecodeError, csv.Error) as e:
+                flash(f'Import aborted, nothing was written: {e}', 'error')
+            else:
+                conn.close()
+                for error in report['errors']:
+                    flash(f'Skipped {error}', 'warning')
+                flash(format_import_report(report), 'success')
+                return redirect(url_for('group_detail', group_id=group_id))
+    
+    members = get_group_members(group_id)
+    conn.close()
+    return render_template('groups/import.html', group=group, members=members)
+
 @app.route('/groups/<int:group_id>/admin', methods=['GET', 'POST'])
 @login_required
 def group_admin(group_id):
@@ -1678,23 +3818,24 @@ def group_admin(group_id):
     conn = get_db_connection()
     
     # Check if user is member of group
-    membership = conn.execute('''
-        SELECT 1 FROM group_members WHERE group_id = ? AND user_id = ?
-    ''', (group_id, current_user.id)).fetchone()
+    membership = conn.execute(MEMBERSHIP_SQL, (group_id, current_user.id)).fetchone()
     
     if not membership:
         flash('You are not a member of this group.', 'error')
+        conn.close()
         return redirect(url_for('groups'))
     
     # Get group info and check if user is creator
-    group = conn.execute('SELECT * FROM groups WHERE id = ?', (group_id,)).fetchone()
+    group = conn.execute(GROUP_BY_ID_SQL, (group_id,)).fetchone()
     
     if not group:
         flash('Group not found.', 'error')
+        conn.close()
         return redirect(url_for('groups'))
     
     if group['created_by'] != current_user.id:
         flash('Only the group creator can access the admin dashboard.', 'error')
+        conn.close()
         return redirect(url_for('group_detail', group_id=group_id))
     
     # Get members
@@ -1721,14 +3862,8 @@ def group_admin(group_id):
                     flash('Invalid payer or payee selection.', 'error')
                 else:
                     # Create settlement entry
-                    cursor = conn.cursor()
                     settlement_desc = description or 'Manual adjustment by admin'
-                    
-                    cursor.execute('''
-                        INSERT INTO settlements (group_id, payer_id, payee_id, amount, created_at, description)
-                        VALUES (?, ?, ?, ?, ?, ?)
-                    ''', (group_id, payer_id, payee_id, amount, datetime.now().isoformat(), settlement_desc))
-                    
+                    record_settlement(conn, group_id, payer_id, payee_id, to_cents(amount), settlement_desc)
                     conn.commit()
                     
                     payer_name = next((m['username'] for m in members if m['id'] == payer_id), 'Unknown')
@@ -1743,17 +3878,7 @@ def group_admin(group_id):
     balances = calculate_balances(group_id)
     
     # Get recent settlements for this group
-    recent_settlements = conn.execute('''
-        SELECT s.*, 
-               up.username as payer_name, 
-               ue.username as payee_name
-        FROM settlements s
-        JOIN users up ON s.payer_id = up.id
-        JOIN users ue ON s.payee_id = ue.id
-        WHERE s.group_id = ?
-        ORDER BY s.created_at DESC
-        LIMIT 20
-    ''', (group_id,)).fetchall()
+    recent_settlements = conn.execute(RECENT_SETTLEMENTS_SQL, (group_id,)).fetchall()
     
     conn.close()
     
@@ -1782,18 +3907,14 @@ def quick_settle():
         conn = get_db_connection()
         
         # Check if user is member of group
-        membership = conn.execute('''
-            SELECT 1 FROM group_members WHERE group_id = ? AND user_id = ?
-        ''', (group_id, current_user.id)).fetchone()
+        membership = conn.execute(MEMBERSHIP_SQL, (group_id, current_user.id)).fetchone()
         
         if not membership:
             conn.close()
             return jsonify({'error': 'Not authorized'}), 403
         
         # Check if payee is also a member
-        payee_membership = conn.execute('''
-            SELECT 1 FROM group_members WHERE group_id = ? AND user_id = ?
-        ''', (group_id, payee_id)).fetchone()
+        payee_membership = conn.execute(MEMBERSHIP_SQL, (group_id, payee_id)).fetchone()
         
         if not payee_membership:
             conn.close()
@@ -1809,12 +3930,7 @@ def quick_settle():
             return jsonify({'error': 'Payee not found'}), 404
         
         # Record the settlement
-        cursor = conn.cursor()
-        cursor.execute('''
-            INSERT INTO settlements (group_id, payer_id, payee_id, amount, created_at)
-            VALUES (?, ?, ?, ?, ?)
-        ''', (group_id, current_user.id, payee_id, amount, datetime.now().isoformat()))
-        
+        record_settlement(conn, group_id, current_user.id, payee_id, to_cents(amount))
         conn.commit()
         conn.close()
         
@@ -1828,70 +3944,94 @@ def quick_settle():
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+def get_payment_qr_request():
+    """Parse the payment QR query string; returns (payload, None) or (None, error response)"""
+    try:
+        amount = float(request.args.get('amount', 0))
+        payer_id = int(request.args.get('payer_id'))
+    except (TypeError, ValueError):
+        return None, (jsonify({'error': 'Invalid amount or payer'}), 400)
+    reference = request.args.get('reference', f'Payment from {current_user.username}')
+    
+    if amount <= 0:
+        return None, (jsonify({'error': 'Invalid amount'}), 400)
+    
+    # Get payer's bank details
+    conn = get_db_connection()
+    payer = conn.execute('''
+        SELECT full_name, iban, bic FROM users WHERE id = ?
+    ''', (payer_id,)).fetchone()
+    conn.close()
+    
+    if not payer:
+        return None, (jsonify({'error': 'Payer not found'}), 404)
+    
+    if not payer['iban']:
+        return None, (jsonify({'error': 'Payer has no bank details configured'}), 400)
+    
+    payload = build_epc_payload(amount, payer['full_name'] or 'Unknown', payer['iban'], payer['bic'], reference)
+    return {'payload': payload, 'amount': amount, 'payer_id': payer_id, 'reference': reference,
+            'recipient': payer['full_name'] or 'Unknown', 'iban': payer['iban'], 'bic': payer['bic']}, None
+
 @app.route('/api/generate_payment_qr')
 @login_required
 def generate_payment_qr():
     """Generate EPC QR code for payment"""
     try:
-        amount = float(request.args.get('amount', 0))
-        payer_id = int(request.args.get('payer_id'))
-        reference = request.args.get('reference', f'Payment from {current_user.username}')
-        
-        if amount <= 0:
-            return jsonify({'error': 'Invalid amount'}), 400
-        
-        # Get payer's bank details
-        conn = get_db_connection()
-        payer = conn.execute('''
-            SELECT full_name, iban, bic FROM users WHERE id = ?
-        ''', (payer_id,)).fetchone()
-        conn.close()
-        
-        if not payer:
-            return jsonify({'error': 'Payer not found'}), 404
-        
-        if not payer['iban']:
-            return jsonify({'error': 'Payer has no bank details configured'}), 400
+        qr_request, error = get_payment_qr_request()
+        if error:
+            return error
         
-        # Generate QR code
-        qr_data = generate_epc_qr_code(
-            amount=amount,
-            recipient_name=payer['full_name'] or 'Unknown',
-            recipient_iban=payer['iban'],
-            recipient_bic=payer['bic'],
-            reference=reference
-        )
-        
-        if not qr_data:
-            return jsonify({'error': 'Failed to generate QR code'}), 500
+        # Only the image URL is returned; it is versioned by payload, so browsers may cache
+        # the image indefinitely and nothing is rendered or base64-encoded here
+        qr_url = url_for('payment_qr_image', image_format='svg', amount=qr_request['amount'],
+                         payer_id=qr_request['payer_id'], reference=qr_request['reference'],
+                         v=qr_code_etag(qr_request['payload'], 'svg')[:12])
         
         return jsonify({
-            'qr_code': qr_data,
-            'amount': amount,
-            'recipient': payer['full_name'] or 'Unknown',
-            'iban': payer['iban']
+            'qr_url': qr_url,
+            'amount': qr_request['amount'],
+            'recipient': qr_request['recipient'],
+            'iban': qr_request['iban']
         })
         
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/payment_qr.<image_format>')
+@login_required
+def payment_qr_image(image_format):
+    """EPC QR code as raw PNG or SVG bytes, cacheable by the browser"""
+    if image_format not in QR_IMAGE_TYPES:
+        return jsonify({'error': 'Unsupported image format'}), 404
+    
+    qr_request, error = get_payment_qr_request()
+    if error:
+        return error
+    
+    response = app.response_class(render_qr_code(qr_request['payload'], image_format),
+                                  mimetype=QR_IMAGE_TYPES[image_format])
+    response.set_etag(qr_code_etag(qr_request['payload'], image_format))
+    # Bank details are personal: only the user's own browser may cache them
+    response.headers['Cache-Control'] = 'private, max-age=31536000, immutable'
+    return response.make_conditional(request)
+
 @app.route('/groups/<int:group_id>/settle/<int:payee_id>', methods=['GET', 'POST'])
 @login_required
 def settle_debt(group_id, payee_id):
     conn = get_db_connection()
     
     # Check if user is member of group
-    membership = conn.execute('''
-        SELECT 1 FROM group_members WHERE group_id = ? AND user_id = ?
-    ''', (group_id, current_user.id)).fetchone()
+    membership = conn.execute(MEMBERSHIP_SQL, (group_id, current_user.id)).fetchone()
     
     if not membership:
         flash('You are not a member of this group.', 'error')
+        conn.close()
         return redirect(url_for('groups'))
     
     # Get group and payee info
-    group = conn.execute('SELECT * FROM groups WHERE id = ?', (group_id,)).fetchone()
-    payee = conn.execute('SELECT * FROM users WHERE id = ?', (payee_id,)).fetchone()
+    group = conn.execute(GROUP_BY_ID_SQL, (group_id,)).fetchone()
+    payee = conn.execute(USER_BY_ID_SQL, (payee_id,)).fetchone()
     
     # Calculate current balance
     balances = calculate_balances(group_id)
@@ -1900,14 +4040,8 @@ def settle_debt(group_id, payee_id):
     form = SettlementForm()
     
     if form.validate_on_submit():
-        cursor = conn.cursor()
-        
         # Record settlement
-        cursor.execute('''
-            INSERT INTO settlements (group_id, payer_id, payee_id, amount, created_at)
-            VALUES (?, ?, ?, ?, ?)
-        ''', (group_id, current_user.id, payee_id, form.amount.data, datetime.now().isoformat()))
-        
+        record_settlement(conn, group_id, current_user.id, payee_id, to_cents(form.amount.data))
         conn.commit()
         conn.close()
         
@@ -1929,16 +4063,15 @@ def group_invite(group_id):
     conn = get_db_connection()
     
     # Check if user is member of group
-    membership = conn.execute('''
-        SELECT 1 FROM group_members WHERE group_id = ? AND user_id = ?
-    ''', (group_id, current_user.id)).fetchone()
+    membership = conn.execute(MEMBERSHIP_SQL, (group_id, current_user.id)).fetchone()
     
     if not membership:
         flash('You are not a member of this group.', 'error')
+        conn.close()
         return redirect(url_for('groups'))
     
     # Get group info
-    group = conn.execute('SELECT * FROM groups WHERE id = ?', (group_id,)).fetchone()
+    group = conn.execute(GROUP_BY_ID_SQL, (group_id,)).fetchone()
     conn.close()
     
     if not group:
@@ -1956,12 +4089,11 @@ def regenerate_invite_code(group_id):
     conn = get_db_connection()
     
     # Check if user is member of group
-    membership = conn.execute('''
-        SELECT 1 FROM group_members WHERE group_id = ? AND user_id = ?
-    ''', (group_id, current_user.id)).fetchone()
+    membership = conn.execute(MEMBERSHIP_SQL, (group_id, current_user.id)).fetchone()
     
     if not membership:
         flash('You are not a member of this group.', 'error')
+        conn.close()
         return redirect(url_for('groups'))
     
     # Generate new invite code
@@ -2042,6 +4174,7 @@ def settings():
                 WHERE id = ?
             ''', (full_name, iban, bic, current_user.id))
             conn.commit()
+            user_cache.invalidate(current_user.id)
             flash('Bank details updated successfully!', 'success')
         except Exception as e:
             flash('Error updating bank details. Please try again.', 'error')
@@ -2093,9 +4226,7 @@ def offline():
 @login_required
 def api_group_balances(group_id):
     conn = get_db_connection()
-    membership = conn.execute('''
-        SELECT 1 FROM group_members WHERE group_id = ? AND user_id = ?
-    ''', (group_id, current_user.id)).fetchone()
+    membership = conn.execute(MEMBERSHIP_SQL, (group_id, current_user.id)).fetchone()
     conn.close()
     
     if not membership:
@@ -2109,6 +4240,107 @@ def api_group_balances(group_id):
         'simplified_debts': simplified_debts
     })
 
+@app.route('/api/groups/<int:group_id>/history')
+@login_required
+def api_group_history(group_id):
+    """Expenses and settlements of a group, newest first, one keyset page at a time"""
+    conn = get_db_connection()
+    membership = conn.execute(MEMBERSHIP_SQL, (group_id, current_user.id)).fetchone()
+    
+    if not membership:
+        conn.close()
+        return jsonify({'error': 'Not authorized'}), 403
+    
+    # Page size is capped so one request is always a bounded index read
+    limit = request.args.get('limit', app.config['HISTORY_PAGE_SIZE'], type=int)
+    limit = max(1, min(limit, app.config['HISTORY_MAX_PAGE_SIZE']))
+    payer_id = request.args.get('payer', type=int)
+    member_id = request.args.get('member', type=int)
+    
+    try:
+        cursor = request.args.get('cursor')
+        cursor = decode_history_cursor(cursor) if cursor else None
+    except ValueError as e:
+        conn.close()
+        return jsonify({'error': str(e)}), 400
+    
+    kind = request.args.get('kind')
+    if kind and kind not in HISTORY_KIND_RANKS:
+        conn.close()
+        return jsonify({'error': 'kind must be expense or settlement'}), 400
+    kinds = (kind,) if kind else tuple(HISTORY_KIND_RANKS)
+    
+    items, next_cursor = get_group_history(conn, group_id, limit, cursor, payer_id, member_id, kinds)
+    conn.close()
+    
+    for item in items:
+        if item['kind'] == 'expense':
+            item['url'] = url_for('expense_detail', group_id=group_id, expense_id=item['id'])
+    return jsonify({'items': items, 'next_cursor': next_cursor})
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """Prometheus scrape target covering every worker"""
+    # Without a token the endpoint doesn't exist: endpoint names and traffic aren't public
+    token = app.config['METRICS_TOKEN']
+    if not app.config['METRICS_ENABLED'] or not token:
+        return jsonify({'error': 'Not found'}), 404
+    if not secrets.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}'):
+        return jsonify({'error': 'Not authorized'}), 401
+    
+    metrics.flush()
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/api/groups/balances')
+@login_required
+def api_batch_group_balances():
+    """Balances and simplified debts for several groups in one response"""
+    conn = get_db_connection()
+    user_group_ids = set(row['group_id'] for row in conn.execute(USER_GROUP_IDS_SQL, (current_user.id,)).fetchall())
+    conn.close()
+    
+    # ?ids=1,2,3 limits the response; by default every group of the user is returned
+    requested = request.args.get('ids', '').strip()
+    if requested:
+        try:
+            group_ids = set(int(group_id) for group_id in requested.split(',') if group_id.strip())
+        except ValueError:
+            return jsonify({'error': 'Invalid group ids'}), 400
+        if not group_ids <= user_group_ids:
+            return jsonify({'error': 'Not authorized'}), 403
+    else:
+        group_ids = user_group_ids
+    
+    groups_balances = {}
+    for group_id, cents in calculate_balances_for_groups(sorted(group_ids)).items():
+        balances = {user_id: from_cents(balance) for user_id, balance in cents.items()}
+        groups_balances[group_id] = {
+            'balances': balances,
+            'simplified_debts': simplify_debts(balances)
+        }
+    
+    return jsonify({'groups': groups_balances})
+
+@app.route('/api/receipt-jobs/<job_id>')
+@login_required
+def api_receipt_job_status(job_id):
+    """Status of a background receipt analysis, polled by the scanner page"""
+    conn = get_db_connection()
+    job = get_receipt_job(conn, job_id, current_user.id)
+    conn.close()
+
+    if not job:
+        return jsonify({'error': 'Job not found'}), 404
+
+    response = {'job_id': job['id'], 'status': job['status']}
+    if job['status'] == 'done':
+        response['redirect_url'] = url_for('select_receipt_items', group_id=job['group_id'], job=job['id'])
+    elif job['status'] == 'failed':
+        # The manual expense form the page moves on to shows the error; polling never flashes
+        response['error'] = job['error']
+        response['redirect_url'] = url_for('add_expense', group_id=job['group_id'], receipt_job=job['id'])
+    return jsonify(response)
+
 @app.route('/api/user/stats')
 @login_required
 def api_user_stats():
@@ -2124,31 +4356,31 @@ def api_user_stats():
 @login_required
 def api_dashboard_summary():
     groups = get_user_groups(current_user.id)
+    user_balances = get_user_balances_cents(current_user.id)
     
     total_you_owe = 0
     total_owed_to_you = 0
     group_balances = []
     
     for group in groups:
-        balances = calculate_balances(group['id'])
-        user_balance = balances.get(current_user.id, 0)
+        user_balance = user_balances.get(group['id'], 0)
         
         group_balances.append({
             'group_id': group['id'],
             'group_name': group['name'],
-            'balance': user_balance
+            'balance': from_cents(user_balance)
         })
         
         if user_balance < 0:
-            total_you_owe += abs(user_balance)
+            total_you_owe += -user_balance
         else:
             total_owed_to_you += user_balance
     
     return jsonify({
-        'total_you_owe': round(total_you_owe, 2),
-        'total_owed_to_you': round(total_owed_to_you, 2),
+        'total_you_owe': from_cents(total_you_owe),
+        'total_owed_to_you': from_cents(total_owed_to_you),
         'group_balances': group_balances,
-        'net_balance': round(total_owed_to_you - total_you_owe, 2)
+        'net_balance': from_cents(total_owed_to_you - total_you_owe)
     })
 
 @app.route('/privacy-policy')
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+"""
+Dashboard scaling benchmark.
+
+Puts one user in a growing number of groups and times /dashboard and
+/api/dashboard/summary. With the single grouped balance query the latency
+should stay flat as the group count grows; the per-request query count is
+reported alongside so a regression back to per-group queries is obvious.
+
+Usage: python benchmarks/dashboard_scaling.py [--groups 10 40 160] [--repeat 50]
+"""
+
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+TMP_DIR = tempfile.mkdtemp(prefix='smartsplit-bench-')
+os.environ['DATABASE'] = os.path.join(TMP_DIR, 'bench.db')
+os.environ.pop('GEMINI_API_KEY', None)
+
+import app as smart_split  # noqa: E402
+
+
+def seed(group_count, members_per_group=5, expenses_per_group=20):
+    """Create a fresh database where user 1 belongs to group_count groups"""
+    smart_split.app.config['DATABASE'] = os.path.join(TMP_DIR, f'bench_{group_count}.db')
+    smart_split.init_db()
+
+    conn = smart_split.get_db_connection()
+    now = datetime.now().isoformat()
+    password_hash = smart_split.generate_password_hash('benchmark')
+    conn.executemany(
+        'INSERT INTO users (username, email, password_hash, created_at) VALUES (?, ?, ?, ?)',
+        [(f'user{i}', f'user{i}@example.com', password_hash, now) for i in range(1, members_per_group + 1)]
+    )
+    member_ids = list(range(1, members_per_group + 1))
+    for g in range(group_count):
+        cursor = conn.execute(
+            'INSERT INTO groups (name, created_by, invite_code, created_at) VALUES (?, 1, ?, ?)',
+            (f'Group {g}', f'BENCH{g:04d}', now)
+        )
+        group_id = cursor.lastrowid
+        conn.executemany(
+            'INSERT INTO group_members (group_id, user_id, joined_at) VALUES (?, ?, ?)',
+            [(group_id, user_id, now) for user_id in member_ids]
+        )
+        for e in range(expenses_per_group):
+            amount_cents = 1000 + e * 37
+            smart_split.record_expense(conn, group_id, f'Expense {e}', amount_cents,
+                                       member_ids[e % len(member_ids)], 1,
+                                       smart_split.split_cents(amount_cents, member_ids, e))
+    conn.commit()
+    conn.close()
+
+
+def count_statements():
+    """Record every SQL statement run through get_db_connection()"""
+    statements = []
+    get_db_connection = smart_split.get_db_connection
+
+    def traced_connection():
+        conn = get_db_connection()
+        conn.set_trace_callback(statements.append)
+        return conn
+
+    smart_split.get_db_connection = traced_connection
+    return statements
+
+
+def time_route(client, path, repeat, statements):
+    samples = []
+    for _ in range(repeat):
+        del statements[:]
+        start = time.perf_counter()
+        response = client.get(path)
+        samples.append((time.perf_counter() - start) * 1000)
+        assert response.status_code == 200, (path, response.status_code)
+    return statistics.median(samples), len(statements)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--groups', type=int, nargs='+', default=[10, 40, 160])
+    parser.add_argument('--repeat', type=int, default=50)
+    args = parser.parse_args()
+
+    smart_split.app.config['WTF_CSRF_ENABLED'] = False
+    statements = count_statements()
+
+    print(f"{'groups':>8} {'/dashboard ms':>15} {'queries':>8} {'/api/dashboard/summary ms':>27} {'queries':>8}")
+    for group_count in args.groups:
+        seed(group_count)
+        client = smart_split.app.test_client()
+        client.post('/login', data={'username': 'user1', 'password': 'benchmark'})
+        dashboard_ms, dashboard_queries = time_route(client, '/dashboard', args.repeat, statements)
+        summary_ms, summary_queries = time_route(client, '/api/dashboard/summary', args.repeat, statements)
+        print(f"{group_count:>8} {dashboard_ms:>15.2f} {dashboard_queries:>8} {summary_ms:>27.2f} {summary_queries:>8}")
+
+
+if __name__ == '__main__':
+    main()
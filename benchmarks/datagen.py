@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+"""
+Seeded synthetic dataset generator.
+
+Builds a database with the schema from init_db() and fills it with users,
+groups, memberships, expenses (with equal or uneven shares) and settlements.
+The same seed and sizes always produce the same rows, so benchmark results
+from different commits are comparable. User 1 ("user1", password
+"benchmark") belongs to every group, which makes it the user whose pages
+grow with the dataset.
+
+Usage: python benchmarks/datagen.py OUTPUT.db [--tier medium] [--groups 20 --expenses 1000 ...] [--seed 42]
+"""
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+os.environ.setdefault('DATABASE', os.path.join(tempfile.mkdtemp(prefix='smartsplit-bench-'), 'bench.db'))
+os.environ.pop('GEMINI_API_KEY', None)
+
+import app as smart_split  # noqa: E402
+
+PASSWORD = 'benchmark'
+
+# users, groups, members per group, expenses per group, settlements per group
+TIERS = {
+    'small': dict(users=20, groups=5, members=5, expenses=100, settlements=10),
+    'medium': dict(users=200, groups=20, members=8, expenses=1000, settlements=100),
+    'large': dict(users=1000, groups=40, members=12, expenses=5000, settlements=500),
+}
+
+DESCRIPTIONS = ['Groceries', 'Dinner', 'Rent', 'Fuel', 'Cinema', 'Coffee', 'Train tickets', 'Pharmacy', 'Drinks', 'Hotel']
+
+
+def generate(path, users, groups, members, expenses, settlements, seed=42):
+    """Create a fresh database at path and fill it; returns row counts"""
+    if os.path.exists(path):
+        os.remove(path)
+    smart_split.app.config['DATABASE'] = path
+    smart_split.init_db()
+
+    rng = random.Random(seed)
+    members = min(members, users)
+    start = datetime(2024, 1, 1)
+    conn = smart_split.get_db_connection()
+    try:
+        # One hash for everyone: hashing thousands of passwords would dominate the run
+        password_hash = smart_split.generate_password_hash(PASSWORD)
+        conn.executemany(
+            'INSERT INTO users (id, username, email, password_hash, created_at, full_name) VALUES (?, ?, ?, ?, ?, ?)',
+            [(i, f'user{i}', f'user{i}@example.com', password_hash, start.isoformat(), f'User {i}')
+             for i in range(1, users + 1)]
+        )
+        conn.commit()
+
+        for group_id in range(1, groups + 1):
+            member_ids = sorted([1] + rng.sample(range(2, users + 1), members - 1))
+            conn.execute('BEGIN IMMEDIATE')
+            conn.execute(
+                'INSERT INTO groups (id, name, description, created_by, invite_code, created_at) VALUES (?, ?, ?, ?, ?, ?)',
+                (group_id, f'Group {group_id}', None, 1, f'BENCH{group_id:04d}', start.isoformat())
+            )
+            conn.executemany(
+                'INSERT INTO group_members (group_id, user_id, joined_at) VALUES (?, ?, ?)',
+                [(group_id, user_id, start.isoformat()) for user_id in member_ids]
+            )
+
+            # Expenses and settlements interleave over a year, oldest first
+            rows = []
+            for n in range(expenses):
+                amount_cents = rng.randint(100, 20000)
+                participants = rng.sample(member_ids, rng.randint(2, len(member_ids)))
+                if rng.random() < 0.8:
+                    shares = smart_split.split_cents(amount_cents, participants, n)
+                else:
+                    weights = [rng.randint(1, 5) for _ in participants]
+                    shares = {user_id: amount_cents * w // sum(weights) for user_id, w in zip(participants, weights)}
+                    shares[participants[0]] += amount_cents - sum(shares.values())
+                created_at = start + timedelta(minutes=rng.randint(0, 525600))
+                rows.append((created_at.isoformat(), (f'{rng.choice(DESCRIPTIONS)} #{n}', amount_cents,
+                                                      rng.choice(member_ids), 1, created_at.isoformat(), shares)))
+            rows.sort(key=lambda row: row[0])
+            smart_split.record_expenses(conn, group_id, [expense for _, expense in rows])
+
+            payments = []
+            for _ in range(settlements):
+                payer_id, payee_id = rng.sample(member_ids, 2)
+                created_at = start + timedelta(minutes=rng.randint(0, 525600))
+                payments.append((payer_id, payee_id, rng.randint(100, 10000), created_at.isoformat(), None))
+            payments.sort(key=lambda payment: payment[3])
+            smart_split.record_settlements(conn, group_id, payments)
+            conn.commit()
+
+        conn.execute('ANALYZE')
+        counts = {table: conn.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0]
+                  for table in ('users', 'groups', 'group_members', 'expenses', 'expense_shares', 'settlements')}
+    finally:
+        conn.close()
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('output')
+    parser.add_argument('--tier', choices=TIERS, default='small')
+    for name in TIERS['small']:
+        parser.add_argument(f'--{name}', type=int, help=f'Override the tier\'s {name}')
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    sizes = {name: getattr(args, name) or default for name, default in TIERS[args.tier].items()}
+    started = time.perf_counter()
+    counts = generate(os.path.abspath(args.output), seed=args.seed, **sizes)
+    print(', '.join(f'{count} {table}' for table, count in counts.items()))
+    print(f'Generated {args.output} in {time.perf_counter() - started:.1f}s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+"""
+Import-time and worker-memory report.
+
+Runs `python -X importtime -c "import app"` in a fresh interpreter and reports
+the app's total import time and its slowest imports. It fails (exit code 1)
+when the import takes longer than --max-import-ms, or when a library that
+should only load lazily (app.LAZY_IMPORTS) is imported up front, so it can
+guard worker cold-start time in CI.
+
+With --workers N it also boots gunicorn with gunicorn.conf.py three ways and
+reports the time until the first response plus RSS and PSS per worker:
+
+    lazy, idle   no preload; workers have not needed Gemini/qrcode/Pillow yet
+    lazy, used   no preload; every worker has loaded them (as after its first
+                 receipt or QR request)
+    preload      the master imports the app and those libraries before forking
+
+PSS splits shared pages between the processes sharing them, so it shows what
+copy-on-write sharing actually saves.
+
+Usage: python benchmarks/import_report.py [--max-import-ms 500] [--top 15] [--workers 4]
+"""
+
+import argparse
+import os
+import re
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+IMPORTTIME_RE = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)$')
+
+
+def measure_imports():
+    """(module, self_us, cumulative_us, depth) for every import triggered by `import app`"""
+    env = dict(os.environ, DATABASE=os.path.join(tempfile.mkdtemp(prefix='smartsplit-import-'), 'import.db'))
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import app'],
+                            cwd=ROOT, env=env, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise SystemExit(f'import app failed:\n{result.stderr}')
+    imports = []
+    for line in result.stderr.splitlines():
+        match = IMPORTTIME_RE.match(line)
+        if match:
+            self_us, cumulative_us, indent, module = match.groups()
+            imports.append((module, int(self_us), int(cumulative_us), len(indent) // 2))
+    return imports
+
+
+def lazy_imports():
+    """The modules app.py promises to import only on demand"""
+    sys.path.insert(0, ROOT)
+    os.environ.setdefault('DATABASE', os.path.join(tempfile.mkdtemp(prefix='smartsplit-import-'), 'import.db'))
+    import app
+    return app.LAZY_IMPORTS
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def children(pid):
+    try:
+        with open(f'/proc/{pid}/task/{pid}/children') as f:
+            return [int(child) for child in f.read().split()]
+    except OSError:
+        return []
+
+
+def memory_kib(pid):
+    """(RSS, PSS) of a process in KiB, from /proc"""
+    values = {}
+    for path in (f'/proc/{pid}/status', f'/proc/{pid}/smaps_rollup'):
+        try:
+            with open(path) as f:
+                for line in f:
+                    key, _, rest = line.partition(':')
+                    if key in ('VmRSS', 'Pss'):
+                        values[key] = int(rest.split()[0])
+        except OSError:
+            pass
+    return values.get('VmRSS', 0), values.get('Pss', 0)
+
+
+# Loaded on top of gunicorn.conf.py to make each worker import the lazy libraries on boot
+USED_WORKER_CONFIG = '''
+exec(open(os.path.join(ROOT, 'gunicorn.conf.py')).read())
+
+def post_worker_init(worker):
+    import app
+    app.warm_lazy_imports()
+'''
+
+
+def boot_gunicorn(workers, preload, warm_workers=False):
+    config = os.path.join(ROOT, 'gunicorn.conf.py')
+    if warm_workers:
+        config = os.path.join(tempfile.mkdtemp(prefix='smartsplit-import-'), 'gunicorn.conf.py')
+        with open(config, 'w') as f:
+            f.write(f'import os\nROOT = {ROOT!r}\n' + USED_WORKER_CONFIG)
+    port = free_port()
+    env = dict(os.environ,
+               DATABASE=os.path.join(tempfile.mkdtemp(prefix='smartsplit-import-'), 'boot.db'),
+               GUNICORN_BIND=f'127.0.0.1:{port}', GUNICORN_WORKERS=str(workers),
+               GUNICORN_PRELOAD=str(preload), GUNICORN_ACCESS_LOG='/dev/null')
+    subprocess.run([sys.executable, '-c', 'import app; app.init_db()'], cwd=ROOT, env=env,
+                   capture_output=True, check=True)
+
+    started = time.perf_counter()
+    server = subprocess.Popen([sys.executable, '-m', 'gunicorn', '-c', config, 'app:app'],
+                              cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        first_response = None
+        while time.perf_counter() - started < 60:
+            try:
+                with urllib.request.urlopen(f'http://127.0.0.1:{port}/login', timeout=2):
+                    first_response = time.perf_counter() - started
+                    break
+            except OSError:
+                time.sleep(0.05)
+        if first_response is None:
+            raise SystemExit('gunicorn did not answer within 60s')
+
+        # Let every worker boot and serve a few requests before sampling memory
+        deadline = time.perf_counter() + 30
+        while len(children(server.pid)) < workers and time.perf_counter() < deadline:
+            time.sleep(0.1)
+        for _ in range(workers * 10):
+            urllib.request.urlopen(f'http://127.0.0.1:{port}/login', timeout=5).read()
+        time.sleep(0.5)
+        return first_response, memory_kib(server.pid), [memory_kib(pid) for pid in children(server.pid)]
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--max-import-ms', type=float, default=500)
+    parser.add_argument('--top', type=int, default=15)
+    parser.add_argument('--workers', type=int, default=0, help='Also compare gunicorn boots with this many workers')
+    args = parser.parse_args()
+
+    imports = measure_imports()
+    total_ms = next(cumulative for module, _, cumulative, _ in imports if module == 'app') / 1000
+    print(f"import app: {total_ms:.1f}ms\n")
+    print(f"{'cumulative ms':>14} {'self ms':>9}  module")
+    direct = [entry for entry in imports if entry[3] == 1]
+    for module, self_us, cumulative_us, _ in sorted(direct, key=lambda entry: -entry[2])[:args.top]:
+        print(f"{cumulative_us / 1000:>14.1f} {self_us / 1000:>9.1f}  {module}")
+
+    failures = []
+    if total_ms > args.max_import_ms:
+        failures.append(f"import app took {total_ms:.1f}ms, over the {args.max_import_ms:.0f}ms budget")
+    imported = {module for module, _, _, _ in imports}
+    for module in lazy_imports():
+        if module in imported:
+            failures.append(f"{module} is imported at startup but should load lazily")
+
+    if args.workers:
+        print(f"\n{'mode':<12} {'first response s':>17} {'master RSS MiB':>15} {'worker RSS MiB':>15} "
+              f"{'worker PSS MiB':>15} {'total PSS MiB':>14}")
+        for mode, preload, warm_workers in (('lazy, idle', False, False), ('lazy, used', False, True),
+                                            ('preload', True, False)):
+            first_response, master, workers = boot_gunicorn(args.workers, preload, warm_workers)
+            worker_rss = sum(rss for rss, _ in workers) / len(workers) / 1024
+            worker_pss = sum(pss for _, pss in workers) / len(workers) / 1024
+            total_pss = (master[1] + sum(pss for _, pss in workers)) / 1024
+            print(f"{mode:<12} {first_response:>17.2f} {master[0] / 1024:>15.1f} "
+                  f"{worker_rss:>15.1f} {worker_pss:>15.1f} {total_pss:>14.1f}")
+
+    for failure in failures:
+        print(f"\nFAIL: {failure}")
+    if failures:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,431 @@
+#!/usr/bin/env python3
+"""
+Load test against app:app under gunicorn.
+
+Seeds a database with benchmarks/datagen.py, starts a local SMTP sink and
+gunicorn serving benchmarks/loadtest_app.py (the real app with a fake
+Gemini of configurable latency), then runs --concurrency virtual users for
+--duration seconds. Each virtual user logs in as a different seeded user and
+repeats a journey through one of their groups:
+
+    dashboard -> group detail -> add expense -> quick-settle
+    -> (every --receipt-every journeys) scan receipt -> wait for the analysis
+       -> select items page -> submit item selection
+    -> (every --reset-every journeys) request a password reset mail
+
+Form steps (login, add expense, password reset) include loading the form for
+its CSRF token. Reports throughput, p50/p95/p99 latency and error rate per
+step, and can write them as JSON. Everything runs on 127.0.0.1; nothing leaves the machine.
+
+Usage: python benchmarks/loadtest.py [--tier small] [--workers 4] [--concurrency 16] [--duration 60]
+                                     [--worker-class gthread --threads 4] [--smtp-latency-ms 300]
+                                     [--gemini-latency-ms 1500] [--output results.json]
+                                     [--gunicorn-arg=--keep-alive=5 ...]
+"""
+
+import argparse
+import http.cookiejar
+import io
+import json
+import os
+import random
+import re
+import socket
+import socketserver
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import uuid
+from collections import defaultdict
+
+from PIL import Image, ImageDraw
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+CSRF_RE = re.compile(r'name="csrf_token"[^>]*value="([^"]+)"')
+STEPS = ['login', 'dashboard', 'group_detail', 'add_expense', 'quick_settle', 'scan_receipt',
+         'receipt_analysis', 'select_items', 'submit_items', 'password_reset']
+
+
+class SMTPSinkHandler(socketserver.StreamRequestHandler):
+    """Just enough SMTP for Flask-Mail to deliver a message, which is then dropped"""
+
+    def reply(self, line):
+        self.wfile.write(line.encode() + b'\r\n')
+
+    def handle(self):
+        self.reply('220 loadtest SMTP sink')
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode(errors='replace').strip().upper()
+            if command.startswith(('EHLO', 'HELO')):
+                self.reply('250 loadtest')
+            elif command == 'DATA':
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+                while self.rfile.readline() not in (b'.\r\n', b'.\n', b''):
+                    pass
+                time.sleep(self.server.latency)
+                with self.server.lock:
+                    self.server.messages += 1
+                self.reply('250 OK')
+            elif command == 'QUIT':
+                self.reply('221 Bye')
+                return
+            else:
+                self.reply('250 OK')
+
+
+class SMTPSink(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, latency=0.0):
+        super().__init__(('127.0.0.1', 0), SMTPSinkHandler)
+        self.latency = latency
+        self.messages = 0
+        self.lock = threading.Lock()
+
+
+class NoRedirect(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+class Client:
+    """One browser: its own cookie jar, redirects reported instead of followed"""
+
+    def __init__(self, base_url):
+        self.base_url = base_url
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()), NoRedirect)
+
+    def request(self, method, path, data=None, headers=None):
+        req = urllib.request.Request(self.base_url + path, data=data, method=method, headers=headers or {})
+        try:
+            with self.opener.open(req, timeout=120) as response:
+                return response.status, response.headers, response.read()
+        except urllib.error.HTTPError as e:
+            return e.code, e.headers, e.read()
+
+    def get(self, path, headers=None):
+        return self.request('GET', path, headers=headers)
+
+    def post_form(self, path, fields):
+        body = urllib.parse.urlencode(fields, doseq=True).encode()
+        return self.request('POST', path, body, {'Content-Type': 'application/x-www-form-urlencoded'})
+
+    def post_json(self, path, payload):
+        return self.request('POST', path, json.dumps(payload).encode(), {'Content-Type': 'application/json'})
+
+    def post_file(self, path, field, filename, content, content_type, headers=None):
+        boundary = uuid.uuid4().hex
+        body = (f'--{boundary}\r\nContent-Disposition: form-data; name="{field}"; filename="{filename}"\r\n'
+                f'Content-Type: {content_type}\r\n\r\n').encode() + content + f'\r\n--{boundary}--\r\n'.encode()
+        headers = dict(headers or {}, **{'Content-Type': f'multipart/form-data; boundary={boundary}'})
+        return self.request('POST', path, body, headers)
+
+    def csrf_token(self, path):
+        status, _, body = self.get(path)
+        match = CSRF_RE.search(body.decode(errors='replace'))
+        if status != 200 or not match:
+            raise StepFailed(f'no form at {path} ({status})')
+        return match.group(1)
+
+
+class StepFailed(Exception):
+    pass
+
+
+class Stats:
+    def __init__(self):
+        self.samples = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.error_examples = {}
+        self.lock = threading.Lock()
+
+    def record(self, step, seconds, error=None):
+        with self.lock:
+            self.samples[step].append(seconds)
+            if error:
+                self.errors[step] += 1
+                self.error_examples.setdefault(step, error)
+
+
+def percentile(sorted_samples, fraction):
+    return sorted_samples[min(len(sorted_samples) - 1, int(len(sorted_samples) * fraction))]
+
+
+def receipt_image(rng):
+    """A small PNG that is different every time, so the analysis cache never hides Gemini"""
+    image = Image.new('RGB', (400, 600), tuple(rng.randint(200, 255) for _ in range(3)))
+    draw = ImageDraw.Draw(image)
+    for line in range(12):
+        draw.text((20, 30 + line * 40), f'ITEM {rng.randint(0, 10 ** 9)}  {rng.randint(1, 99)}.00', fill=(0, 0, 0))
+    buffer = io.BytesIO()
+    image.save(buffer, 'PNG')
+    return buffer.getvalue()
+
+
+class VirtualUser(threading.Thread):
+    def __init__(self, base_url, user, group_id, members, stats, deadline, args, seed):
+        super().__init__(daemon=True)
+        self.client = Client(base_url)
+        self.base_url = base_url
+        self.user, self.group_id, self.members = user, group_id, members
+        self.stats, self.deadline, self.args = stats, deadline, args
+        self.rng = random.Random(seed)
+
+    def step(self, name, fn):
+        start = time.perf_counter()
+        try:
+            result = fn()
+        except (StepFailed, OSError, ValueError) as e:
+            self.stats.record(name, time.perf_counter() - start, str(e) or type(e).__name__)
+            raise StepFailed(name)
+        self.stats.record(name, time.perf_counter() - start)
+        return result
+
+    def expect(self, response, status, what):
+        if response[0] != status:
+            raise StepFailed(f'{what}: expected {status}, got {response[0]}')
+        return response
+
+    def login(self):
+        token = self.client.csrf_token('/login')
+        response = self.client.post_form('/login', {'csrf_token': token, 'username': self.user['username'],
+                                                    'password': 'benchmark'})
+        if response[0] != 302 or '/dashboard' not in response[1].get('Location', ''):
+            raise StepFailed(f'login failed ({response[0]})')
+
+    def add_expense(self):
+        path = f'/groups/{self.group_id}/add_expense'
+        token = self.client.csrf_token(path)
+        response = self.client.post_form(path, {
+            'csrf_token': token, 'description': 'Load test', 'amount': f'{self.rng.randint(100, 5000) / 100:.2f}',
+            'paid_by': self.user['id'], 'split_type': 'equal', 'split_among': self.members,
+        })
+        self.expect(response, 302, 'add expense')
+
+    def quick_settle(self):
+        payee_id = self.rng.choice([m for m in self.members if m != self.user['id']])
+        self.expect(self.client.post_json('/api/quick-settle', {'group_id': self.group_id, 'payee_id': payee_id,
+                                                                'amount': 1.0}), 200, 'quick-settle')
+
+    def scan_receipt(self):
+        status, _, body = self.client.post_file(f'/groups/{self.group_id}/scan_receipt', 'receipt_file',
+                                                'receipt.png', receipt_image(self.rng), 'image/png',
+                                                {'Accept': 'application/json'})
+        if status != 202:
+            raise StepFailed(f'upload: expected 202, got {status}')
+        return json.loads(body)['status_url']
+
+    def wait_for_analysis(self, status_url):
+        while time.time() < self.deadline + 120:
+            status, _, body = self.client.get(status_url)
+            job = json.loads(body) if status == 200 else {}
+            if job.get('status') == 'done':
+                return job['redirect_url']
+            if status != 200 or job.get('status') == 'failed':
+                raise StepFailed(f"analysis failed: {job.get('error', status)}")
+            time.sleep(self.args.poll_interval)
+        raise StepFailed('analysis timed out')
+
+    def submit_items(self):
+        fields = {'bill_payer': self.user['id']}
+        for i in range(6):
+            fields[f'item_{i}_user'] = self.rng.choice(self.members)
+        self.expect(self.client.post_form(f'/groups/{self.group_id}/select_items', fields), 302, 'submit items')
+
+    def password_reset(self):
+        # Anonymous browser, like someone locked out of their account
+        client = Client(self.base_url)
+        token = client.csrf_token('/forgot-password')
+        self.expect(client.post_form('/forgot-password', {'csrf_token': token, 'email': self.user['email']}),
+                    302, 'password reset')
+
+    def run(self):
+        try:
+            self.step('login', self.login)
+        except StepFailed:
+            return
+        journey = 0
+        while time.time() < self.deadline:
+            journey += 1
+            try:
+                self.step('dashboard', lambda: self.expect(self.client.get('/dashboard'), 200, 'dashboard'))
+                self.step('group_detail', lambda: self.expect(self.client.get(f'/groups/{self.group_id}'), 200, 'group'))
+                self.step('add_expense', self.add_expense)
+                self.step('quick_settle', self.quick_settle)
+                if journey % self.args.receipt_every == 0:
+                    status_url = self.step('scan_receipt', self.scan_receipt)
+                    redirect_url = self.step('receipt_analysis', lambda: self.wait_for_analysis(status_url))
+                    self.step('select_items', lambda: self.expect(self.client.get(redirect_url), 200, 'select items'))
+                    self.step('submit_items', self.submit_items)
+                if journey % self.args.reset_every == 0:
+                    self.step('password_reset', self.password_reset)
+            except StepFailed:
+                pass
+            if self.args.think_ms:
+                time.sleep(self.rng.uniform(0, 2 * self.args.think_ms) / 1000)
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def pick_users(db_path, count, seed):
+    """count (user, group, members) triples, each user once, in groups of 2+ members"""
+    conn = sqlite3.connect(db_path)
+    conn.row_factory = sqlite3.Row
+    members = defaultdict(list)
+    for row in conn.execute('SELECT group_id, user_id FROM group_members ORDER BY group_id, user_id'):
+        members[row['group_id']].append(row['user_id'])
+    users = {row['id']: dict(row) for row in conn.execute('SELECT id, username, email FROM users')}
+    conn.close()
+
+    rng = random.Random(seed)
+    memberships = [(user_id, group_id) for group_id, ids in members.items() if len(ids) > 1 for user_id in ids]
+    rng.shuffle(memberships)
+    picked, seen = [], set()
+    for user_id, group_id in memberships:
+        if user_id not in seen:
+            seen.add(user_id)
+            picked.append((users[user_id], group_id, members[group_id]))
+    if len(picked) < count:
+        raise SystemExit(f'Only {len(picked)} seeded users are in a group; use a bigger --tier or lower --concurrency')
+    return picked[:count]
+
+
+def start_gunicorn(args, port, env):
+    command = ['gunicorn', '--chdir', BENCH_DIR, '--bind', f'127.0.0.1:{port}', '--workers', str(args.workers),
+               '--worker-class', args.worker_class, '--threads', str(args.threads),
+               '--timeout', '120', *args.gunicorn_arg, 'loadtest_app:app']
+    server = subprocess.Popen(command, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    deadline = time.time() + 60
+    while time.time() < deadline:
+        if server.poll() is not None:
+            raise SystemExit(f'gunicorn exited:\n{server.stderr.read()}')
+        try:
+            with urllib.request.urlopen(f'http://127.0.0.1:{port}/login', timeout=2):
+                return server
+        except OSError:
+            time.sleep(0.2)
+    server.terminate()
+    raise SystemExit('gunicorn did not come up within 60s')
+
+
+def report(stats, elapsed, smtp_messages):
+    results = {}
+    print(f"\n{'step':<18} {'count':>7} {'req/s':>8} {'errors':>7} {'err %':>6} "
+          f"{'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'max ms':>8}")
+    for step in STEPS:
+        samples = sorted(stats.samples.get(step, []))
+        if not samples:
+            continue
+        row = {
+            'count': len(samples),
+            'throughput_rps': len(samples) / elapsed,
+            'errors': stats.errors[step],
+            'error_rate': stats.errors[step] / len(samples),
+            'p50_ms': percentile(samples, 0.50) * 1000,
+            'p95_ms': percentile(samples, 0.95) * 1000,
+            'p99_ms': percentile(samples, 0.99) * 1000,
+            'max_ms': samples[-1] * 1000,
+        }
+        results[step] = row
+        print(f"{step:<18} {row['count']:>7} {row['throughput_rps']:>8.1f} {row['errors']:>7} "
+              f"{row['error_rate']:>6.1%} {row['p50_ms']:>8.1f} {row['p95_ms']:>8.1f} "
+              f"{row['p99_ms']:>8.1f} {row['max_ms']:>8.1f}")
+    total = sum(row['count'] for row in results.values())
+    print(f"\n{total} requests in {elapsed:.1f}s ({total / elapsed:.1f} steps/s), {smtp_messages} mails delivered")
+    for step, error in stats.error_examples.items():
+        print(f"First {step} error: {error}")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--tier', choices=['small', 'medium', 'large'], default='small')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--worker-class', choices=['sync', 'gthread'], default='sync')
+    parser.add_argument('--threads', type=int, default=1, help='Threads per gthread worker')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--duration', type=float, default=60, help='Seconds of load after all users logged in')
+    parser.add_argument('--think-ms', type=float, default=0, help='Mean pause between journeys')
+    parser.add_argument('--receipt-every', type=int, default=5, help='Scan a receipt every Nth journey')
+    parser.add_argument('--reset-every', type=int, default=10, help='Request a password reset every Nth journey')
+    parser.add_argument('--poll-interval', type=float, default=0.25)
+    parser.add_argument('--gemini-latency-ms', type=float, default=1500)
+    parser.add_argument('--gemini-jitter-ms', type=float, default=500)
+    parser.add_argument('--gemini-error-rate', type=float, default=0.0)
+    parser.add_argument('--smtp-latency-ms', type=float, default=0, help='Delay before the SMTP sink accepts a mail')
+    parser.add_argument('--gunicorn-arg', action='append', default=[], help='Extra gunicorn argument (repeatable)')
+    parser.add_argument('--output', help='Write per-step results as JSON to this file')
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix='smartsplit-loadtest-')
+    db_path = os.path.join(work_dir, 'loadtest.db')
+    # datagen imports the app, so point it at the scratch database first
+    os.environ['DATABASE'] = db_path
+    sys.path.insert(0, BENCH_DIR)
+    import datagen
+    print(f"Seeding {args.tier} dataset into {db_path} ...")
+    datagen.generate(db_path, seed=args.seed, **datagen.TIERS[args.tier])
+    users = pick_users(db_path, args.concurrency, args.seed)
+
+    smtp = SMTPSink(args.smtp_latency_ms / 1000)
+    threading.Thread(target=smtp.serve_forever, daemon=True).start()
+
+    port = free_port()
+    env = dict(os.environ,
+               DATABASE=db_path,
+               LOADTEST_UPLOAD_FOLDER=os.path.join(work_dir, 'uploads'),
+               SECRET_KEY='loadtest',
+               MAIL_SERVER='127.0.0.1', MAIL_PORT=str(smtp.server_address[1]),
+               MAIL_USE_TLS='False', MAIL_USE_SSL='False', MAIL_USERNAME='', MAIL_PASSWORD='',
+               MAIL_DEFAULT_SENDER='loadtest@example.com',
+               FAKE_GEMINI_LATENCY_MS=str(args.gemini_latency_ms),
+               FAKE_GEMINI_JITTER_MS=str(args.gemini_jitter_ms),
+               FAKE_GEMINI_ERROR_RATE=str(args.gemini_error_rate))
+    print(f"Starting gunicorn with {args.workers} {args.worker_class} workers"
+          f"{f' x {args.threads} threads' if args.worker_class == 'gthread' else ''} on port {port} ...")
+    server = start_gunicorn(args, port, env)
+
+    try:
+        stats = Stats()
+        base_url = f'http://127.0.0.1:{port}'
+        deadline = time.time() + args.duration
+        print(f"Running {args.concurrency} virtual users for {args.duration:.0f}s ...")
+        started = time.time()
+        threads = [VirtualUser(base_url, user, group_id, members, stats, deadline, args, args.seed + i)
+                   for i, (user, group_id, members) in enumerate(users)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.time() - started
+    finally:
+        server.terminate()
+        server.wait()
+        smtp.shutdown()
+
+    results = report(stats, elapsed, smtp.messages)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'args': vars(args), 'elapsed_s': elapsed, 'smtp_messages': smtp.messages,
+                       'steps': results}, f, indent=2)
+        print(f"Wrote {args.output}")
+
+
+if __name__ == '__main__':
+    main()
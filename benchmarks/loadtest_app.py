@@ -0,0 +1,73 @@
+"""
+WSGI entry point for load tests: the real app with Gemini replaced by a local fake.
+
+    gunicorn --chdir benchmarks loadtest_app:app
+
+The fake answers every receipt with canned JSON after FAKE_GEMINI_LATENCY_MS
+(plus up to FAKE_GEMINI_JITTER_MS), and fails FAKE_GEMINI_ERROR_RATE of the
+calls, so receipt jobs exercise the same code paths as production without
+network access or an API key. Uploads go to LOADTEST_UPLOAD_FOLDER when set.
+Mail goes wherever MAIL_SERVER/MAIL_PORT point; benchmarks/loadtest.py runs
+a local SMTP sink for it.
+"""
+
+import json
+import os
+import random
+import sys
+import time
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as smart_split  # noqa: E402
+
+LATENCY_MS = float(os.environ.get('FAKE_GEMINI_LATENCY_MS', 1500))
+JITTER_MS = float(os.environ.get('FAKE_GEMINI_JITTER_MS', 500))
+ERROR_RATE = float(os.environ.get('FAKE_GEMINI_ERROR_RATE', 0))
+
+CANNED_RECEIPT = {
+    'store_name': 'Load Test Bistro',
+    'total_amount': 42.5,
+    'currency': 'EUR',
+    'items': [
+        {'name': 'Margherita', 'price': 9.5},
+        {'name': 'Tiramisu', 'price': 6.0},
+        {'name': 'Tiramisu', 'price': 6.0},
+        {'name': 'Coke', 'price': 3.0},
+        {'name': 'Coke', 'price': 3.0},
+        {'name': 'Lasagne', 'price': 15.0},
+    ],
+}
+
+
+class FakeGenerativeModel:
+    def __init__(self, model_name):
+        self.model_name = model_name
+
+    def generate_content(self, parts):
+        time.sleep((LATENCY_MS + random.uniform(0, JITTER_MS)) / 1000)
+        if random.random() < ERROR_RATE:
+            raise RuntimeError('Fake Gemini error')
+        return SimpleNamespace(text='```json\n' + json.dumps(CANNED_RECEIPT) + '\n```')
+
+
+class FakeGenAI:
+    """Just the parts of google.generativeai that analyze_receipt_with_gemini() uses"""
+    GenerativeModel = FakeGenerativeModel
+
+    @staticmethod
+    def configure(api_key=None):
+        pass
+
+    @staticmethod
+    def upload_file(path):
+        return SimpleNamespace(name=os.path.basename(path))
+
+
+smart_split.genai = FakeGenAI
+smart_split.GEMINI_API_KEY = 'fake-key'
+if os.environ.get('LOADTEST_UPLOAD_FOLDER'):
+    smart_split.app.config['UPLOAD_FOLDER'] = os.environ['LOADTEST_UPLOAD_FOLDER']
+
+app = smart_split.app
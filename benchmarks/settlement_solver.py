@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+"""
+Settlement solver benchmark.
+
+Generates seeded random balance sets (in cents, summing to zero) made of
+several independent zero-sum clusters, as happens when sub-groups of friends
+mostly pay for each other, and compares the greedy matcher with the optimal
+zero-sum-subset solver: transfer counts, solve times and how often the optimal
+solver ran into its time budget (and so fell back to greedy).
+
+Usage: python benchmarks/settlement_solver.py [--sizes 4 8 12 16 20] [--trials 50] [--seed 42]
+"""
+
+import argparse
+import os
+import random
+import statistics
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import app as smart_split  # noqa: E402
+
+
+def random_balances(rng, size):
+    """size non-zero balances split into random zero-sum clusters of 2-5 members"""
+    balances = {}
+    user_id = 1
+    remaining = size
+    while remaining:
+        cluster = remaining if remaining <= 5 else rng.randint(2, min(5, remaining - 2))
+        amounts = [rng.choice((-1, 1)) * rng.randint(1, 20000) for _ in range(cluster - 1)]
+        amounts.append(-sum(amounts))
+        if amounts[-1] == 0:
+            continue
+        for amount in amounts:
+            balances[user_id] = amount
+            user_id += 1
+        remaining -= cluster
+    return balances
+
+
+def run(solver, balances):
+    start = time.perf_counter()
+    transfers = solver(balances)
+    return transfers, (time.perf_counter() - start) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[4, 8, 12, 16, 20])
+    parser.add_argument('--trials', type=int, default=50)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    print(f"{'balances':>9} {'greedy tx':>10} {'optimal tx':>11} {'saved':>6} "
+          f"{'greedy ms':>10} {'optimal ms':>11} {'optimal p95 ms':>15} {'over budget':>12}")
+
+    with smart_split.app.app_context():
+        for size in args.sizes:
+            greedy_counts, optimal_counts = [], []
+            greedy_times, optimal_times = [], []
+            over_budget = 0
+            for _ in range(args.trials):
+                balances = random_balances(rng, size)
+                greedy, greedy_ms = run(smart_split.greedy_settlements, balances)
+                optimal, optimal_ms = run(smart_split.optimal_settlements, balances)
+                greedy_counts.append(len(greedy))
+                optimal_counts.append(len(optimal))
+                greedy_times.append(greedy_ms)
+                optimal_times.append(optimal_ms)
+                if optimal_ms >= smart_split.app.config['SETTLEMENT_TIME_BUDGET_MS']:
+                    over_budget += 1
+
+            p95 = sorted(optimal_times)[int(len(optimal_times) * 0.95) - 1]
+            print(f"{size:>9} {statistics.mean(greedy_counts):>10.2f} {statistics.mean(optimal_counts):>11.2f} "
+                  f"{sum(greedy_counts) - sum(optimal_counts):>6} {statistics.mean(greedy_times):>10.3f} "
+                  f"{statistics.mean(optimal_times):>11.3f} {p95:>15.3f} {over_budget:>12}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+"""
+Benchmark suite for the hot routes and balance helpers.
+
+For each size tier a database is generated with benchmarks/datagen.py (same
+seed, same rows), then helpers are called directly and routes are driven
+through Flask's test client logged in as user1, who is a member of every
+group. Gemini and mail are stubbed, so nothing leaves the machine. Every
+benchmark reports median/p95/mean milliseconds and the number of SQL
+statements one call runs. Before timing, each tier also checks that the
+hot-path queries use indexes (check_query_plans) and that a ledger export
+streams instead of being buffered.
+
+Results are written as JSON so two commits can be compared:
+
+    python benchmarks/suite.py --output before.json
+    git checkout other-branch
+    python benchmarks/suite.py --output after.json --compare before.json
+
+Usage: python benchmarks/suite.py [--tiers small medium] [--repeat 30] [--seed 42] [--output results.json] [--compare baseline.json]
+"""
+
+import argparse
+import json
+import os
+import platform
+import sqlite3
+import statistics
+import subprocess
+import tempfile
+import time
+from datetime import datetime
+
+import datagen
+
+smart_split = datagen.smart_split
+
+CANNED_RECEIPT = {
+    'store_name': 'Benchmark Bistro',
+    'total_amount': 86.40,
+    'currency': 'EUR',
+    'items': [{'name': f'Item {i}', 'price': 3.60} for i in range(24)],
+}
+
+
+def stub_external_services():
+    """Keep Gemini and SMTP out of the measurements"""
+    smart_split.analyze_receipt_with_gemini = lambda file_path: dict(CANNED_RECEIPT)
+    smart_split.mail.state.suppress = True
+    smart_split.app.config['WTF_CSRF_ENABLED'] = False
+
+
+def count_statements():
+    """Record every SQL statement run through get_db_connection()"""
+    statements = []
+    get_db_connection = smart_split.get_db_connection
+
+    def traced_connection():
+        conn = get_db_connection()
+        conn.set_trace_callback(statements.append)
+        return conn
+
+    smart_split.get_db_connection = traced_connection
+    return statements
+
+
+def measure(fn, repeat, statements):
+    samples = []
+    queries = 0
+    fn()  # Warm the caches and the connection pool
+    for _ in range(repeat):
+        del statements[:]
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1000)
+        queries = len(statements)
+    samples.sort()
+    return {
+        'n': repeat,
+        'median_ms': round(statistics.median(samples), 3),
+        'p95_ms': round(samples[max(0, int(len(samples) * 0.95) - 1)], 3),
+        'mean_ms': round(statistics.mean(samples), 3),
+        'min_ms': round(samples[0], 3),
+        'queries': queries,
+    }
+
+
+def get(client, path):
+    def call():
+        response = client.get(path)
+        assert response.status_code == 200, (path, response.status_code)
+    return call
+
+
+def select_receipt_items(client, group_id, member_ids, post):
+    """One GET or POST of the item selection page with the canned analysis in the session"""
+    form = {'bill_payer': str(member_ids[0])}
+    for i in range(len(CANNED_RECEIPT['items'])):
+        form[f'item_{i}_user'] = str(member_ids[i % len(member_ids)])
+
+    def call():
+        with client.session_transaction() as session:
+            session['receipt_analysis'] = CANNED_RECEIPT
+        if post:
+            response = client.post(f'/groups/{group_id}/select_items', data=form)
+            assert response.status_code == 302, response.status_code
+        else:
+            response = client.get(f'/groups/{group_id}/select_items')
+            assert response.status_code == 200, response.status_code
+    return call
+
+
+def check_streamed_export(client, group_id):
+    """An export must start streaming before its rows are read, with no ETag computed over the body"""
+    produced = []
+    export_chunks = smart_split.export_chunks
+
+    def counted_chunks(cursor, chunk_size):
+        for rows in export_chunks(cursor, chunk_size):
+            produced.append(len(rows))
+            yield rows
+
+    smart_split.export_chunks = counted_chunks
+    try:
+        response = client.get(f'/groups/{group_id}/export/expenses.csv', buffered=False)
+        assert response.status_code == 200, response.status_code
+        assert response.is_streamed, 'export response is not streamed'
+        assert 'ETag' not in response.headers, 'ETag computed over the streamed export'
+        assert not produced, f'{len(produced)} export chunks produced before the body was read'
+        body = b''.join(response.response)
+        response.close()
+        assert produced and body.count(b'\n') == sum(produced) + 1, 'export body does not match the rows read'
+    finally:
+        smart_split.export_chunks = export_chunks
+
+
+def run_tier(tier, sizes, repeat, seed, statements, work_dir):
+    datagen.generate(os.path.join(work_dir, f'{tier}.db'), seed=seed, **sizes)
+    group_id = 1
+    with smart_split.app.app_context():
+        conn = smart_split.get_db_connection()
+        problems = smart_split.check_query_plans(conn)
+        assert not problems, f'full table scans in hot-path queries: {problems}'
+        member_ids = [row['user_id'] for row in conn.execute(
+            'SELECT user_id FROM group_members WHERE group_id = ? ORDER BY user_id', (group_id,))]
+        conn.close()
+        balances = smart_split.calculate_balances(group_id)
+
+    client = smart_split.app.test_client()
+    response = client.post('/login', data={'username': 'user1', 'password': datagen.PASSWORD})
+    assert response.status_code == 302, 'login failed'
+    check_streamed_export(client, group_id)
+
+    benchmarks = [
+        ('helper', 'calculate_balances', lambda: smart_split.calculate_balances(group_id)),
+        ('helper', 'simplify_debts', lambda: smart_split.simplify_debts(balances)),
+        ('helper', 'get_user_balances_cents', lambda: smart_split.get_user_balances_cents(1)),
+        ('route', 'GET /dashboard', get(client, '/dashboard')),
+        ('route', 'GET /api/dashboard/summary', get(client, '/api/dashboard/summary')),
+        ('route', 'GET /groups/<id>', get(client, f'/groups/{group_id}')),
+        ('route', 'GET /groups/<id>/balance-details', get(client, f'/groups/{group_id}/balance-details')),
+        ('route', 'GET /api/groups/<id>/history', get(client, f'/api/groups/{group_id}/history')),
+        ('route', 'GET /groups/<id>/select_items', select_receipt_items(client, group_id, member_ids, post=False)),
+        ('route', 'POST /groups/<id>/select_items', select_receipt_items(client, group_id, member_ids, post=True)),
+    ]
+
+    results = []
+    for kind, name, fn in benchmarks:
+        if kind == 'helper':
+            with smart_split.app.app_context():
+                result = measure(fn, repeat, statements)
+        else:
+            result = measure(fn, repeat, statements)
+        results.append(dict(tier=tier, kind=kind, name=name, **result))
+        print(f"{tier:>8} {name:<40} {result['median_ms']:>10.3f} {result['p95_ms']:>10.3f} {result['queries']:>8}")
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=datagen.ROOT,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline_path):
+    with open(baseline_path) as f:
+        baseline = {(r['tier'], r['name']): r for r in json.load(f)['results']}
+    print(f"\n{'tier':>8} {'benchmark':<40} {'before ms':>10} {'after ms':>10} {'change':>8}")
+    for result in results:
+        before = baseline.get((result['tier'], result['name']))
+        if not before:
+            continue
+        change = (result['median_ms'] - before['median_ms']) / before['median_ms'] if before['median_ms'] else 0.0
+        print(f"{result['tier']:>8} {result['name']:<40} {before['median_ms']:>10.3f} "
+              f"{result['median_ms']:>10.3f} {change:>+8.0%}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--tiers', nargs='+', choices=datagen.TIERS, default=['small', 'medium'])
+    parser.add_argument('--repeat', type=int, default=30)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', help='Write results as JSON to this file')
+    parser.add_argument('--compare', metavar='BASELINE', help='Compare medians with an earlier --output file')
+    args = parser.parse_args()
+
+    stub_external_services()
+    statements = count_statements()
+    work_dir = tempfile.mkdtemp(prefix='smartsplit-bench-')
+
+    print(f"{'tier':>8} {'benchmark':<40} {'median ms':>10} {'p95 ms':>10} {'queries':>8}")
+    results = []
+    for tier in args.tiers:
+        results.extend(run_tier(tier, datagen.TIERS[tier], args.repeat, args.seed, statements, work_dir))
+
+    report = {
+        'meta': {
+            'commit': git_commit(),
+            'created_at': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'seed': args.seed,
+            'repeat': args.repeat,
+            'tiers': {tier: datagen.TIERS[tier] for tier in args.tiers},
+        },
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"\nWrote {args.output}")
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == '__main__':
+    main()
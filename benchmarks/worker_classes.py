@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+"""
+Sync vs gthread gunicorn workers on the I/O-bound journey.
+
+Runs benchmarks/loadtest.py twice with the same seed, dataset and virtual
+users: once with --workers sync workers, once with the same number of
+gthread workers running --threads threads each. The SMTP sink waits
+--smtp-latency-ms before accepting a mail and the fake Gemini waits
+--gemini-latency-ms, so password resets and receipt uploads spend most of
+their time waiting like they do against a real relay and API. Prints
+throughput and p95 latency per step side by side.
+
+Usage: python benchmarks/worker_classes.py [--tier medium] [--workers 2] [--threads 4] [--concurrency 16] [--duration 30]
+                                           [--smtp-latency-ms 300] [--output results.json]
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def run_loadtest(args, worker_class, threads, output):
+    command = [sys.executable, os.path.join(BENCH_DIR, 'loadtest.py'),
+               '--tier', args.tier, '--seed', str(args.seed),
+               '--workers', str(args.workers), '--worker-class', worker_class, '--threads', str(threads),
+               '--concurrency', str(args.concurrency), '--duration', str(args.duration),
+               '--receipt-every', str(args.receipt_every), '--reset-every', str(args.reset_every),
+               '--smtp-latency-ms', str(args.smtp_latency_ms), '--gemini-latency-ms', str(args.gemini_latency_ms),
+               '--output', output]
+    print(f"\n=== {worker_class} ===", flush=True)
+    subprocess.run(command, check=True)
+    with open(output) as f:
+        return json.load(f)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--tier', choices=['small', 'medium', 'large'], default='medium')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--threads', type=int, default=4, help='Threads per gthread worker')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--duration', type=float, default=30)
+    parser.add_argument('--receipt-every', type=int, default=3)
+    parser.add_argument('--reset-every', type=int, default=2)
+    parser.add_argument('--smtp-latency-ms', type=float, default=300)
+    parser.add_argument('--gemini-latency-ms', type=float, default=1500)
+    parser.add_argument('--output', help='Write both runs as JSON to this file')
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix='smartsplit-workers-')
+    runs = {
+        'sync': run_loadtest(args, 'sync', 1, os.path.join(work_dir, 'sync.json')),
+        'gthread': run_loadtest(args, 'gthread', args.threads, os.path.join(work_dir, 'gthread.json')),
+    }
+
+    sync, gthread = runs['sync'], runs['gthread']
+    print(f"\n{args.workers} sync workers vs {args.workers} gthread workers x {args.threads} threads, "
+          f"{args.concurrency} users, SMTP {args.smtp_latency_ms:.0f}ms, Gemini {args.gemini_latency_ms:.0f}ms")
+    print(f"{'step':<18} {'sync req/s':>11} {'gthread req/s':>14} {'speedup':>8} "
+          f"{'sync p95 ms':>12} {'gthread p95 ms':>15}")
+    for step, before in sync['steps'].items():
+        after = gthread['steps'].get(step)
+        if not after:
+            continue
+        speedup = after['throughput_rps'] / before['throughput_rps'] if before['throughput_rps'] else 0.0
+        print(f"{step:<18} {before['throughput_rps']:>11.1f} {after['throughput_rps']:>14.1f} {speedup:>7.2f}x "
+              f"{before['p95_ms']:>12.1f} {after['p95_ms']:>15.1f}")
+    totals = {name: sum(row['count'] for row in run['steps'].values()) / run['elapsed_s'] for name, run in runs.items()}
+    print(f"{'all steps':<18} {totals['sync']:>11.1f} {totals['gthread']:>14.1f} "
+          f"{totals['gthread'] / totals['sync']:>7.2f}x")
+    errors = {name: sum(row['errors'] for row in run['steps'].values()) for name, run in runs.items()}
+    print(f"errors: sync {errors['sync']}, gthread {errors['gthread']}")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(runs, f, indent=2)
+        print(f"Wrote {args.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -25,5 +25,5 @@ if [ "$FLASK_ENV" = "development" ]; then
     exec python app.py
 else
     echo "🏭 Starting in PRODUCTION mode with Gunicorn..."
-    exec gunicorn --bind 0.0.0.0:3000 --workers 4 --timeout 120 --access-logfile - --error-logfile - app:app
+    exec gunicorn -c gunicorn.conf.py app:app
 fi 
\ No newline at end of file
@@ -0,0 +1,34 @@
+"""
+Gunicorn settings for Smart Split; every value can be overridden from the environment.
+
+    gunicorn -c gunicorn.conf.py app:app
+"""
+
+import os
+
+bind = os.environ.get('GUNICORN_BIND', '0.0.0.0:3000')
+workers = int(os.environ.get('GUNICORN_WORKERS', 4))
+
+# gthread workers serve GUNICORN_THREADS requests each, so a request waiting on SMTP or
+# on an upload no longer blocks a whole process; set GUNICORN_WORKER_CLASS=sync to go back
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'gthread')
+threads = int(os.environ.get('GUNICORN_THREADS', 4))
+
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 120))
+graceful_timeout = int(os.environ.get('GUNICORN_GRACEFUL_TIMEOUT', 30))
+keepalive = int(os.environ.get('GUNICORN_KEEPALIVE', 5))
+accesslog = os.environ.get('GUNICORN_ACCESS_LOG', '-')
+errorlog = os.environ.get('GUNICORN_ERROR_LOG', '-')
+
+# Import the app once in the master and fork the workers from it, so they share its
+# memory copy-on-write and start without paying the import time again
+preload_app = os.environ.get('GUNICORN_PRELOAD', 'True').lower() == 'true'
+
+
+def when_ready(server):
+    # Runs in the master before the first worker is forked. The app imports Gemini, qrcode
+    # and Pillow lazily; with a preloaded app it is cheaper to load them once here than in
+    # every worker on its first receipt or QR request.
+    if preload_app:
+        import app
+        app.warm_lazy_imports()
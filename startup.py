@@ -7,6 +7,7 @@ This script ensures proper initialization before starting the Flask app.
 import os
 import sys
 import logging
+import time
 from app import init_db, ensure_upload_folder
 
 # Configure logging
@@ -15,6 +16,7 @@ logger = logging.getLogger(__name__)
 
 def initialize_application():
     """Initialize the application before starting the server."""
+    started = time.perf_counter()
     try:
         logger.info("🚀 Starting Smart Split application initialization...")
         
@@ -58,7 +60,7 @@ def initialize_application():
         logger.info("🗄️  Initializing database...")
         init_db()
         
-        logger.info("✅ Application initialization completed successfully!")
+        logger.info(f"✅ Application initialization completed in {time.perf_counter() - started:.2f}s")
         
     except Exception as e:
         logger.error(f"❌ Application initialization failed: {e}")